@@ -1,18 +1,44 @@
 # Compare performance of any two model
 
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import cache, partial
 from pathlib import Path
-from typing import Union
+from typing import Any, Dict, List, Optional, Set, Tuple, Union
 
 import numpy as np
 import hydra
 import polars as pl
+import pyarrow.parquet as pq
 
 from dotenv import load_dotenv
-from omegaconf import DictConfig
+from omegaconf import DictConfig, OmegaConf
 from rich import print
 
-from utils import get_model, get_model_paths, get_data
-from sklearn.preprocessing import StandardScaler
+from metrics import bootstrap_metrics, get_metric_exprs
+from tree_predictor import TreeEnsemble
+from utils import (
+    FactorizedData,
+    apply_scaler,
+    fit_data_scaler,
+    fit_scaler,
+    get_data,
+    get_file_stamp,
+    get_labels,
+    get_model,
+    get_model_hash,
+    get_model_paths,
+    get_model_scaler,
+    get_scaler_path,
+    get_scalers,
+    is_factorized,
+    iter_batches,
+    load_scaler,
+    scan_data,
+    split_threads,
+)
 
 load_dotenv()
 
@@ -22,43 +48,78 @@ def get_preds(
     data_path: Union[str, Path],
     run_type: str,
     regression: bool,
+    **data_kwargs,
 ) -> pl.DataFrame:
     """A function that generates predictions using a trained model.
 
     Parameters:
         model_path (str): Path to the trained model file.
-        data_path (str): Path to the data file for prediction.
+        data_path (str): Path to the data file for prediction, or to a factorized dataset
+            (see `utils.FactorizedData`), which is predicted batch by batch.
         run_type (str): One of `full`, `geno_only`, `chem_only`
         regression (bool): Whether the model is regression or classification
+        **data_kwargs: Passed to `get_data`, e.g. the feature cache and memory-mapping
+            settings.
 
     Returns:
         pl.DataFrame: A DataFrame containing the actual Phenotype, predicted Phenotype, and Condition.
     """
     # print("We got here!")
     model = get_model(path_of_model)
-    data = pl.read_ipc(data_path)
 
-    match run_type:
-        case "full" | "geno_only" | "chem_only":
-            X, y = get_data(data_path=data_path, run_type=run_type, return_as_Xy=True)
-        case "dummy":
-            X, y = get_data(
-                data_path=data_path, run_type="full", return_as_Xy=True
-            )  # dummy is the same as full, because it doesn't care about features
+    if is_factorized(data_path):
+        # Feature rows are assembled from the strain and condition tables batch by batch
+        feature_run_type = "full" if run_type == "dummy" else run_type
+        data = FactorizedData.load(data_path)
+        batch_size = data_kwargs.get("batch_size", 100_000)
+
+        scaler_path = get_scaler_path(path_of_model)
+        if scaler_path.exists():
+            scaler = load_scaler(scaler_path)
+        else:
+            scaler = fit_data_scaler(data_path, feature_run_type, batch_size)
+        preds = np.concatenate(
+            [
+                model.predict(apply_scaler(X, scaler))
+                for X, _ in data.iter_batches(feature_run_type, batch_size)
+            ]
+        )
+        y, conditions = data.phenotype, data.labels()["Condition"]
+
+    else:
+        conditions = scan_data(data_path).select("Condition").collect()["Condition"]
+
+        match run_type:
+            case "full" | "geno_only" | "chem_only":
+                X, y = get_data(
+                    data_path=data_path,
+                    run_type=run_type,
+                    return_as_Xy=True,
+                    **data_kwargs,
+                )
+            case "dummy":
+                X, y = get_data(
+                    data_path=data_path,
+                    run_type="full",
+                    return_as_Xy=True,
+                    **data_kwargs,
+                )  # dummy is the same as full, because it doesn't care about features
 
-    X = StandardScaler().fit_transform(X)
-    preds = model.predict(X)
+        X = apply_scaler(X, get_model_scaler(path_of_model, X))
+        preds = model.predict(X)
 
     if not regression:
         preds = np.where(preds > 0.5, 1, 0)
 
-    return pl.DataFrame(
-        {"Phenotype": y, "Preds": preds, "Condition": data["Condition"]}
-    )
+    return pl.DataFrame({"Phenotype": y, "Preds": preds, "Condition": conditions})
 
 
 def get_preds_kfold(
-    paths_of_model: Union[str, Path.glob], data_path, run_type, regression: bool
+    paths_of_model: Union[str, Path.glob],
+    data_path,
+    run_type,
+    regression: bool,
+    **data_kwargs,
 ) -> pl.DataFrame:
     """A function that generates predictions using a trained model.
 
@@ -67,13 +128,21 @@ def get_preds_kfold(
         data_path (str): Path to the data file for prediction.
         run_type (str): One of `full`, `geno_only`, `chem_only`
         regression (bool): Whether the model is regression or classification
+        **data_kwargs: Passed to `get_data`, e.g. the feature cache and memory-mapping
+            settings.
 
     Returns:
         pl.DataFrame: A DataFrame containing the actual Phenotype, predicted Phenotype, and Condition.
     """
     preds = []
     for i, path_of_model in enumerate(paths_of_model):
-        result = get_preds(path_of_model, data_path, run_type, regression)
+        result = get_preds(
+            path_of_model,
+            data_path,
+            run_type,
+            regression,
+            **data_kwargs,
+        )
         result = result.with_columns(pl.lit(i).alias("Fold"))
         preds.append(result)
     return pl.concat(preds)
@@ -89,35 +158,339 @@ def eval_model(conf: DictConfig, pred_df: pl.DataFrame) -> pl.DataFrame:
 
     Returns:
         pl.DataFrame: A DataFrame containing the accuracy, f1 score, auc roc score,
-            and mathews correlation coefficient for each condition and fold.
+            and mathews correlation coefficient for each condition and fold. With
+            `conf.bootstrap.n_resamples`, each metric is followed by the `_low` and `_high`
+            bounds of its bootstrap confidence interval (see `metrics.bootstrap_metrics`).
     """
 
-    result_df = pred_df.group_by("Condition", "Fold", maintain_order=True).map_groups(
-        lambda x: pl.DataFrame(
-            {
-                "Condition": x["Condition"].unique(maintain_order=True),
-                "Fold": x["Fold"].unique(maintain_order=True),
-                # "accuracy": accuracy_score(x["Phenotype"], x["Preds"]),
-                # "f1": f1_score(x["Phenotype"], x["Preds"]),
-                # "auc_roc": roc_auc_score(x["Phenotype"], x["Preds"]),
-                # "mathews": matthews_corrcoef(x["Phenotype"], x["Preds"]),
-            }
-            | {
-                metric: hydra.utils.call(
-                    conf.metrics.get(metric), x["Phenotype"], x["Preds"]
-                )
-                for metric in conf.metrics
-            }
+    exprs, unmapped = get_metric_exprs(conf.metrics)
+
+    # Metrics with a polars kernel are computed for all the groups at once
+    result_df = pred_df.group_by("Condition", "Fold", maintain_order=True).agg(exprs)
+
+    if unmapped:
+        unmapped_df = pred_df.group_by(
+            "Condition", "Fold", maintain_order=True
+        ).map_groups(
+            lambda x: pl.DataFrame(
+                {
+                    "Condition": x["Condition"].unique(maintain_order=True),
+                    "Fold": x["Fold"].unique(maintain_order=True),
+                }
+                | {
+                    metric: hydra.utils.call(
+                        conf.metrics.get(metric), x["Phenotype"], x["Preds"]
+                    )
+                    for metric in unmapped
+                }
+            )
         )
+        result_df = result_df.join(unmapped_df, on=["Condition", "Fold"], how="left")
+
+    bootstrap = conf.get("bootstrap") or {}
+    if not bootstrap.get("n_resamples", 0):
+        return result_df.select("Condition", "Fold", *conf.metrics)
+
+    ci_df = bootstrap_metrics(
+        pred_df,
+        conf.metrics,
+        n_resamples=bootstrap.n_resamples,
+        confidence=bootstrap.get("confidence", 0.95),
+        seed=bootstrap.get("seed"),
     )
+    result_df = result_df.join(ci_df, on=["Condition", "Fold"], how="left")
+    columns = [
+        column
+        for metric in conf.metrics
+        for column in (metric, f"{metric}_low", f"{metric}_high")
+        if column in result_df.columns
+    ]
+    return result_df.select("Condition", "Fold", *columns)
+
+
+def load_eval_data(
+    data_path: Union[str, Path], run_type: str, **data_kwargs
+) -> Tuple[np.ndarray, np.ndarray, pl.Series]:
+    """Loads the features of a dataset once for evaluating any number of models on it.
+
+    Parameters:
+        data_path (str): Path to the data file, or to a factorized dataset (see
+            `utils.FactorizedData`).
+        run_type (str): One of `full`, `geno_only`, `chem_only`, `dummy`
+        **data_kwargs: Passed to `get_data`, e.g. the feature cache and memory-mapping
+            settings.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, pl.Series]: The (unscaled) features, the Phenotype and
+            the Condition of each row.
+    """
+    # dummy is the same as full, because it doesn't care about features
+    run_type = "full" if run_type == "dummy" else run_type
+
+    if is_factorized(data_path):
+        data = FactorizedData.load(data_path)
+        return data.assemble(run_type), data.phenotype, data.labels()["Condition"]
+
+    conditions = get_labels(data_path)["Condition"]
+    X, y = get_data(
+        data_path=data_path,
+        run_type=run_type,
+        return_as_Xy=True,
+        **data_kwargs,
+    )
+
+    return X, y, conditions
+
+
+def get_ensemble(models: List[Any]) -> Optional[TreeEnsemble]:
+    """Flattens the trees of the fold models of a model name (see `tree_predictor`).
+
+    Parameters:
+        models (List): The trained models.
+
+    Returns:
+        Optional[TreeEnsemble]: The ensemble of the models, None if there are none.
+    """
+    if not models:
+        return None
+    return TreeEnsemble(models)
+
+
+def predict_folds(
+    models: List[Any],
+    X: np.ndarray,
+    regression: bool,
+    n_jobs: int = -1,
+    scalers: Optional[List[Optional[Tuple[np.ndarray, np.ndarray]]]] = None,
+    ensemble: Optional[TreeEnsemble] = None,
+) -> List[np.ndarray]:
+    """Predicts the same data with several models (e.g. the models of each fold) concurrently.
+
+    LightGBM releases the GIL while predicting, so the models run on threads that share `X`,
+    with the cores split between them. Models with a scaler predict a scaled copy of `X`, so
+    up to `n_jobs` copies exist at a time. With an `ensemble` of the models, the models whose
+    scalers have the same parameters (e.g. all saved without one) walk their trees together
+    instead; fold models with their own scalers still predict one at a time.
+
+    Parameters:
+        models (List): The trained models.
+        X (np.ndarray): The unscaled features.
+        regression (bool): Whether the models are regression or classification
+        n_jobs (int): Number of models predicting at the same time, -1 for all of them.
+        scalers (List, optional): The scaler of every model (see `get_scalers`). Defaults to
+            None, no scaling.
+        ensemble (TreeEnsemble, optional): The models flattened by `get_ensemble`. Defaults
+            to None, `predict` of each model.
 
-    return result_df
+    Returns:
+        List[np.ndarray]: The predictions of each model.
+    """
+    n_jobs, num_threads = split_threads(n_jobs, len(models))
+    scalers = [None] * len(models) if scalers is None else scalers
+
+    if ensemble is not None:
+        # Models with equal scalers (e.g. one fitted on the evaluated data) share their input
+        groups: Dict[Optional[Tuple[bytes, bytes]], List[int]] = {}
+        for i, scaler in enumerate(scalers):
+            key = (
+                None
+                if scaler is None
+                else tuple(np.asarray(p).tobytes() for p in scaler)
+            )
+            groups.setdefault(key, []).append(i)
+
+        def _predict_group(boosters: List[int]) -> np.ndarray:
+            scaler = scalers[boosters[0]]
+            if scaler is not None:
+                X_group = apply_scaler(np.array(X, dtype=np.float32), scaler)
+            else:
+                X_group = X
+            preds = ensemble.predict(X_group, boosters=boosters)
+            return preds if regression else np.where(preds > 0.5, 1, 0)
+
+        fold_preds = [None] * len(models)
+        with ThreadPoolExecutor(max_workers=min(n_jobs, len(groups))) as executor:
+            for boosters, preds in zip(
+                groups.values(), executor.map(_predict_group, groups.values())
+            ):
+                for column, i in enumerate(boosters):
+                    fold_preds[i] = preds[:, column]
+        return fold_preds
+
+    def _predict(model, scaler) -> np.ndarray:
+        if scaler is not None:
+            X_model = apply_scaler(np.array(X, dtype=np.float32), scaler)
+        else:
+            X_model = X
+
+        preds = model.predict(X_model, num_threads=num_threads)
+        return preds if regression else np.where(preds > 0.5, 1, 0)
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        return list(executor.map(_predict, models, scalers))
+
+
+def stream_preds(
+    models: Dict[str, List[Any]],
+    data_path: Union[str, Path],
+    out_paths: Dict[str, Path],
+    run_type: str,
+    regression: bool,
+    batch_size: int = 100_000,
+    n_jobs: int = -1,
+    scalers: Optional[Dict[str, List[Optional[Tuple[np.ndarray, np.ndarray]]]]] = None,
+    ensembles: Optional[Dict[str, TreeEnsemble]] = None,
+    model_paths: Optional[Dict[str, List[Path]]] = None,
+) -> None:
+    """Predicts a dataset batch by batch and appends the predictions to parquet files, so that
+    only one batch of features is in memory at a time.
+
+    Parameters:
+        models (Dict[str, List]): The fold models of each model name.
+        data_path (str): Path to the data file, or to a factorized dataset.
+        out_paths (Dict[str, Path]): The predictions file of each model name, with the
+            columns of `get_preds_kfold`.
+        run_type (str): One of `full`, `geno_only`, `chem_only`, `dummy`
+        regression (bool): Whether the models are regression or classification
+        batch_size (int): Number of rows per batch.
+        n_jobs (int): Number of fold models predicting at the same time, -1 for all of them.
+        scalers (Dict[str, List], optional): The scalers of the fold models of each model
+            name (see `get_scalers`). Defaults to None, no scaling.
+        ensembles (Dict[str, TreeEnsemble], optional): The fold models of the model names
+            to predict with `tree_predictor` (see `get_ensemble`). Defaults to None.
+        model_paths (Dict[str, List[Path]], optional): The paths of the fold models of each
+            model name, written to a `Model` column. Defaults to None, no such column.
+
+    Returns:
+        None
+    """
+    # dummy is the same as full, because it doesn't care about features
+    run_type = "full" if run_type == "dummy" else run_type
+    scalers = {} if scalers is None else scalers
+    ensembles = {} if ensembles is None else ensembles
+
+    writers = {}
+    try:
+        for X, labels in iter_batches(
+            data_path, run_type, batch_size, columns=("Phenotype", "Condition")
+        ):
+            for model_name, fold_models in models.items():
+                fold_preds = predict_folds(
+                    fold_models,
+                    X,
+                    regression,
+                    n_jobs=n_jobs,
+                    scalers=scalers.get(model_name),
+                    ensemble=ensembles.get(model_name),
+                )
+                for i, preds in enumerate(fold_preds):
+                    batch = labels.select(
+                        pl.col("Phenotype"),
+                        pl.Series("Preds", preds),
+                        pl.col("Condition"),
+                        pl.lit(i).alias("Fold"),
+                    )
+                    if model_paths is not None:
+                        batch = batch.with_columns(
+                            pl.lit(str(model_paths[model_name][i])).alias("Model")
+                        )
+                    batch = batch.to_arrow()
+
+                    if model_name not in writers:
+                        writers[model_name] = pq.ParquetWriter(
+                            out_paths[model_name], batch.schema
+                        )
+                    writers[model_name].write_table(batch)
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+
+MANIFEST_NAME = "eval_manifest.json"
+
+
+def get_settings_hash(conf: DictConfig) -> str:
+    """Returns the SHA-256 digest of the settings that change the predictions or metrics of
+    a (model, data) pair."""
+    settings = {
+        key: conf.get(key) for key in ("run_type", "regression", "metrics", "bootstrap")
+    }
+    return hashlib.sha256(
+        OmegaConf.to_yaml(OmegaConf.create(settings)).encode()
+    ).hexdigest()
+
+
+def load_manifest(manifest_path: Path) -> Dict[str, Any]:
+    """Loads the evaluation manifest, empty if there is none yet (see `get_results`)."""
+    if not manifest_path.exists():
+        return {}
+    return json.loads(manifest_path.read_text())
+
+
+def save_manifest(manifest: Dict[str, Any], manifest_path: Path) -> None:
+    """Writes the evaluation manifest, atomically so that an interrupted run keeps the last
+    one."""
+    tmp_path = manifest_path.with_name(f".{manifest_path.name}.{os.getpid()}.tmp")
+    tmp_path.write_text(json.dumps(manifest, indent=2))
+    tmp_path.replace(manifest_path)
+
+
+def reusable_models(
+    previous: Optional[Dict[str, Any]],
+    entry: Dict[str, Any],
+    pred_path: Path,
+    metric_path: Path,
+) -> Set[str]:
+    """Finds the fold models of a (model, data) pair that were evaluated already.
+
+    Parameters:
+        previous (Dict, optional): The manifest entry of the pair from the last run.
+        entry (Dict): The manifest entry of the pair now.
+        pred_path (Path): The predictions file of the pair.
+        metric_path (Path): The metrics file of the pair.
+
+    Returns:
+        Set[str]: The paths of the fold models, unchanged at the same path, whose rows of
+            the predictions file (by their `Model`) can be kept. Empty if the data, the
+            settings or the files changed.
+    """
+    if (
+        previous is None
+        or previous["data"] != entry["data"]
+        or previous["settings"] != entry["settings"]
+        or not pred_path.exists()
+        or not metric_path.exists()
+        or "Model" not in pl.read_parquet_schema(pred_path)
+    ):
+        return set()
+
+    previous_models = {(model["path"], model["hash"]) for model in previous["models"]}
+    return {
+        model["path"]
+        for model in entry["models"]
+        if (model["path"], model["hash"]) in previous_models
+    }
 
 
 def get_results(conf: DictConfig):
     """Runs the models in the `run_path` directory on the data in the `data_paths` dictionary, and
     saves the results to the `out_path` directory.
 
+    Every dataset and model is loaded only once, and only when it has to predict, and all
+    the fold models of a model name are predicted together on the resident standardized
+    data. The predictions (with the `Model`
+    path of every row) and metrics of a (model, data) pair are written as soon as it is
+    evaluated.
+
+    With `incremental`, `eval_manifest.json` in `out_path` records the hashes of the data,
+    of the settings and of every fold model of each pair, updated after each pair is
+    written, so an interrupted run resumes from the last pair. Fold models that are
+    unchanged keep their predictions, only the new or changed ones are predicted and merged
+    in, and datasets whose outputs are all up to date are not loaded. The data is recorded
+    by its size and modification time (see `utils.get_file_stamp`), as hashing it would
+    read it on every run. Other runs delete the manifest, as they rewrite the outputs it
+    describes.
+
     Parameters:
         conf (DictConfig): A configuration object with the following required
             keys:
@@ -129,6 +502,13 @@ def get_results(conf: DictConfig):
                 - run_type (str): The suffix of the model name to distinguish between
                     different runs (e.g. 'full', 'geno_only', 'chem_only', 'dummy').
                 - regression (bool): Whether the model is regression or classification.
+                - n_jobs (int): Number of fold models predicting at the same time.
+                - streaming (bool): Whether to predict the data files batch by batch
+                    (see `stream_preds`) instead of loading them. Only the new or changed
+                    fold models are streamed, and merged with the kept predictions.
+                - tree_predictor (bool): Whether to predict the LightGBM models with
+                    `tree_predictor.TreeEnsemble` instead of `Booster.predict`.
+                - incremental (bool): Whether to skip the fold models evaluated already.
 
     Returns:
         None
@@ -145,21 +525,204 @@ def get_results(conf: DictConfig):
 
     print(model_paths)
 
-    for model_name, model_path in model_paths.items():
-        for data_name, data_path in conf.data_paths.items():
-            print(model_name, data_name)
-            result_df = get_preds_kfold(
-                model_path, data_path, conf.run_type, conf.regression
-            )
-            metric_df = eval_model(conf, result_df)
+    incremental = conf.get("incremental", False)
+    manifest_path = out_path / MANIFEST_NAME
+    manifest = load_manifest(manifest_path) if incremental else {}
+    if not incremental:
+        manifest_path.unlink(missing_ok=True)
+    else:
+        settings_hash = get_settings_hash(conf)
+        model_hashes = {
+            model_name: [
+                {"path": str(path), "hash": get_model_hash(path)} for path in paths
+            ]
+            for model_name, paths in model_paths.items()
+        }
+
+    # Models are loaded, and their ensembles built, only once they have to predict
+    load_model = cache(get_model)
+
+    @cache
+    def load_ensemble(paths: Tuple[Path, ...]) -> Optional[TreeEnsemble]:
+        if not conf.get("tree_predictor", False):
+            return None
+        return get_ensemble([load_model(path) for path in paths])
+
+    def _write_pair(
+        pred_path: Path,
+        metric_path: Path,
+        result_df: Optional[pl.DataFrame],
+        entry: Optional[Dict[str, Any]],
+    ) -> None:
+        """Writes the outputs of a pair, the predictions unless they are streamed already,
+        then its manifest entry."""
+        if result_df is None:  # Only the predictions are read back, not the features
+            result_df = pl.read_parquet(pred_path)
+        else:
+            result_df.write_parquet(pred_path)
+        eval_model(conf, result_df).write_csv(metric_path)
+
+        if entry is not None:
+            manifest[pred_path.stem.removeprefix("predictions_")] = entry
+            save_manifest(manifest, manifest_path)
+
+    for data_name, data_path in conf.data_paths.items():
+        pred_paths = {
+            model_name: out_path
+            / f"predictions_{model_name}_{data_name}_{model_type}.parquet"
+            for model_name in model_paths
+        }
+        metric_paths = {
+            model_name: out_path / f"metrics_{model_name}_{data_name}_{model_type}.csv"
+            for model_name in model_paths
+        }
+
+        # The fold models of every model name whose predictions are kept, by path
+        reused: Dict[str, Set[str]] = {}
+        entries: Dict[str, Dict[str, Any]] = {}
+        if incremental:
+            data_stamp = get_file_stamp(data_path)  # Not hashed, data files are large
+            for model_name in model_paths:
+                entries[model_name] = {
+                    "data": data_stamp,
+                    "settings": settings_hash,
+                    "models": model_hashes[model_name],
+                }
+                reused[model_name] = reusable_models(
+                    manifest.get(f"{model_name}_{data_name}_{model_type}"),
+                    entries[model_name],
+                    pred_paths[model_name],
+                    metric_paths[model_name],
+                )
 
-            result_df.write_parquet(
-                out_path / f"predictions_{model_name}_{data_name}_{model_type}.parquet"
+        # The paths of the fold models of every model name that have to predict
+        pending = {
+            model_name: [
+                path for path in paths if str(path) not in reused.get(model_name, set())
+            ]
+            for model_name, paths in model_paths.items()
+        }
+        for model_name in [name for name, paths in pending.items() if not paths]:
+            print(f"{model_name} {data_name} is up to date")
+            del pending[model_name]
+        if not pending:
+            continue  # The data isn't even loaded
+
+        if conf.get("streaming", False):
+            print(list(pending), data_name)
+            fit_on_data = cache(
+                partial(
+                    fit_data_scaler,
+                    data_path,
+                    "full" if conf.run_type == "dummy" else conf.run_type,
+                    conf.data_loading.batch_size,
+                )
+            )  # Fitted at most once, and only for models saved without a scaler
+            # Only the new fold models are predicted, next to the predictions they join
+            new_paths = {
+                model_name: pred_paths[model_name].with_suffix(".new.parquet")
+                for model_name in pending
+            }
+            stream_preds(
+                {
+                    model_name: [load_model(path) for path in paths]
+                    for model_name, paths in pending.items()
+                },
+                data_path,
+                new_paths,
+                conf.run_type,
+                conf.regression,
+                batch_size=conf.data_loading.batch_size,
+                n_jobs=conf.get("n_jobs", -1),
+                scalers={
+                    model_name: get_scalers(paths, fit_on_data)
+                    for model_name, paths in pending.items()
+                },
+                ensembles={
+                    model_name: load_ensemble(tuple(paths))
+                    for model_name, paths in pending.items()
+                },
+                model_paths=pending,
             )
+            for model_name in pending:
+                folds = {str(path): i for i, path in enumerate(model_paths[model_name])}
+                result_df = pl.read_parquet(new_paths[model_name])
+                if reused.get(model_name):
+                    result_df = pl.concat(
+                        [
+                            pl.read_parquet(pred_paths[model_name]).filter(
+                                pl.col("Model").is_in(list(reused[model_name]))
+                            ),
+                            result_df,
+                        ],
+                        how="vertical_relaxed",
+                    )
+                result_df = result_df.with_columns(
+                    pl.col("Model").replace(folds, return_dtype=pl.Int32).alias("Fold")
+                ).sort("Fold", maintain_order=True)
+                _write_pair(
+                    pred_paths[model_name],
+                    metric_paths[model_name],
+                    result_df,
+                    entries.get(model_name),
+                )
+                new_paths[model_name].unlink()
+            continue
+
+        X, y, conditions = load_eval_data(
+            data_path,
+            conf.run_type,
+            **conf.data_cache,
+            **conf.data_loading,
+        )
+        fit_on_data = cache(partial(fit_scaler, X))
 
-            metric_df.write_csv(
-                out_path / f"metrics_{model_name}_{data_name}_{model_type}.csv"
+        for model_name, new_paths in pending.items():
+            print(model_name, data_name)
+            paths = [str(path) for path in model_paths[model_name]]
+            kept = reused.get(model_name, set())
+            fold_preds = dict(
+                zip(
+                    [str(path) for path in new_paths],
+                    predict_folds(
+                        [load_model(path) for path in new_paths],
+                        X,
+                        conf.regression,
+                        n_jobs=conf.get("n_jobs", -1),
+                        scalers=get_scalers(new_paths, fit_on_data),
+                        ensemble=load_ensemble(tuple(new_paths)),
+                    ),
+                )
             )
+            previous_df = pl.read_parquet(pred_paths[model_name]) if kept else None
+
+            fold_dfs = []
+            for i, path in enumerate(paths):
+                if path in kept:
+                    fold_df = previous_df.filter(pl.col("Model") == path).drop(
+                        "Fold", "Model"
+                    )
+                else:
+                    fold_df = pl.DataFrame(
+                        {
+                            "Phenotype": y,
+                            "Preds": fold_preds[path],
+                            "Condition": conditions,
+                        }
+                    )
+                fold_dfs.append(
+                    fold_df.with_columns(
+                        pl.lit(i).alias("Fold"), pl.lit(path).alias("Model")
+                    )
+                )
+            _write_pair(
+                pred_paths[model_name],
+                metric_paths[model_name],
+                pl.concat(fold_dfs),
+                entries.get(model_name),
+            )
+
+        del X  # Only one dataset is kept in memory
 
 
 @hydra.main(config_path="../configs/", version_base="1.3", config_name="eval")
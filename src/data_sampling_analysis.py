@@ -9,37 +9,190 @@ import pickle
 
 from warnings import warn
 
+import queue
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Tuple, Union
+from functools import cached_property, partial
+from typing import Dict, Iterator, List, Optional, Tuple, Union
 from dotenv import load_dotenv
 from omegaconf import DictConfig
 import lightgbm as lgb
 
 # from sklearn.metrics import roc_auc_score
 # from sklearn.model_selection import KFold, train_test_split
-from sklearn.preprocessing import StandardScaler
 from rich.console import Console
 
-from scipy.spatial.distance import pdist, squareform
+from utils import (
+    FactorizedData,
+    apply_scaler,
+    compact_genotypes,
+    fit_scaler,
+    get_data,
+    get_strain_distances,
+    is_factorized,
+    run_folds,
+    split_threads,
+)
 
 load_dotenv()
 
 console = Console(record=True)
 
 
+def strain_genotypes(
+    df: Union[pl.DataFrame, FactorizedData],
+) -> Tuple[List[str], np.ndarray]:
+    """Returns the unique strains of a dataset and their genotype rows.
+
+    Args:
+        df (Union[pl.DataFrame, FactorizedData]): A long (Strain, Condition) table, or a
+            factorized dataset, whose strain table is returned as is.
+
+    Returns:
+        Tuple[List[str], np.ndarray]: The strains and the strain x marker genotype matrix.
+    """
+    if isinstance(df, FactorizedData):
+        return df.strains, df.genotypes
+
+    strain_df = df.select(pl.col("Strain"), cs.starts_with("Y")).unique(
+        "Strain", maintain_order=True
+    )
+    return strain_df["Strain"].to_list(), strain_df.drop("Strain").to_numpy()
+
+
+def representative_strains(
+    strains: List[str], distances: np.ndarray, num_groups: Union[float, int]
+) -> List[str]:
+    """Returns the strains closest on average to all the others.
+
+    Args:
+        strains (List[str]): The strains, in the order of the rows of `distances`.
+        distances (np.ndarray): The strain x strain distance matrix (see
+            `utils.get_strain_distances`).
+        num_groups (Union[float, int]): The number of strains, or their fraction.
+
+    Returns:
+        List[str]: The most representative strains, the most representative first.
+    """
+    n_strains = int(
+        num_groups * len(strains) if isinstance(num_groups, float) else num_groups
+    )
+    avg_dist_btw_strains = distances.mean(axis=1)
+    order = np.argsort(avg_dist_btw_strains, kind="stable")[:n_strains]
+    return [strains[i] for i in order]
+
+
+class SamplerIndex:
+    """The standardized features of a training set, computed once, and the rows of every
+    Condition and Strain, so that samples are arrays of row indices. `scaler` holds the
+    training statistics, which the validation rows are standardized with too.
+
+    Samples are trained on without copying the features, as subsets of one LightGBM Dataset
+    binned once on all the rows (see `dataset`).
+
+    Args:
+        df (Union[pl.DataFrame, FactorizedData]): The training data. For a factorized
+            dataset the feature rows are assembled once.
+        distance_cache_dir (str, optional): Where the strain distances of the
+            `intelligent_strain` strategy are cached (see `utils.get_strain_distances`).
+            Defaults to None.
+    """
+
+    def __init__(
+        self,
+        df: Union[pl.DataFrame, FactorizedData],
+        distance_cache_dir: Optional[str] = None,
+    ):
+        if isinstance(df, FactorizedData):
+            X, labels = df.assemble("full"), df.labels()
+        else:
+            X = df.drop(["Condition", "Strain", "Phenotype"]).to_numpy()
+            labels = df.select("Condition", "Strain", "Phenotype")
+
+        self.scaler = fit_scaler(X)
+        self.X = apply_scaler(X, self.scaler)
+        self.y = labels["Phenotype"].to_numpy()
+        self.condition_rows = _group_rows(labels["Condition"])
+        self.strain_rows = _group_rows(labels["Strain"])
+
+        # Only the strain table is kept, not the training data, for `strain_distances`
+        self.strains, self.genotypes = strain_genotypes(df)
+        self.distance_cache_dir = distance_cache_dir
+        self._dataset = None
+
+    def __len__(self) -> int:
+        return len(self.y)
+
+    @cached_property
+    def strain_distances(self) -> Tuple[List[str], np.ndarray]:
+        """The unique strains and their distance matrix, computed on first use."""
+        return self.strains, get_strain_distances(
+            self.strains, self.genotypes, cache_dir=self.distance_cache_dir
+        )
+
+    def dataset(self, params: Optional[dict] = None) -> lgb.Dataset:
+        """The LightGBM Dataset of all the rows, binned on the first call. Take the
+        `subset` of a sample to train on it.
+
+        Args:
+            params (dict, optional): Dataset parameters, only used on the first call.
+
+        Returns:
+            lgb.Dataset: The constructed Dataset.
+        """
+        if self._dataset is None:
+            # Trials may change e.g. min_data_in_leaf, which pre-filtering would fix
+            params = {**(params or {}), "feature_pre_filter": False}
+            self._dataset = lgb.Dataset(
+                self.X, self.y, params=params, free_raw_data=False
+            ).construct()
+        return self._dataset
+
+
+def _group_rows(keys: pl.Series) -> Dict[str, np.ndarray]:
+    """Returns the rows of every distinct key, in order of appearance."""
+    # Group ids from the values themselves, Categorical codes depend on the string cache
+    uniques, first_rows, codes = np.unique(
+        keys.to_numpy(), return_index=True, return_inverse=True
+    )
+    order = np.argsort(codes, kind="stable")
+    groups = np.split(order, np.cumsum(np.bincount(codes))[:-1])
+    uniques = uniques.tolist()
+    return {uniques[i]: groups[i] for i in np.argsort(first_rows)}
+
+
+def _sample_groups(
+    group_rows: Dict[str, np.ndarray],
+    groups_considered: List[str],
+    n_samples: int,
+    num_groups: Union[float, int],
+    rng: np.random.Generator,
+) -> np.ndarray:
+    """Samples `n_samples` rows of the considered groups, with replacement (and a warning)
+    only if they have fewer rows."""
+    candidates = np.concatenate([group_rows[group] for group in groups_considered])
+
+    if len(candidates) < n_samples:
+        warn(
+            f"Sampling with replacement is done. The number of groups {num_groups} is not enough for the number of samples {n_samples}"
+        )
+        return rng.choice(candidates, n_samples, replace=True)
+    return rng.choice(candidates, n_samples, replace=False)
+
+
 def data_sampler(
     # config: DictConfig,
-    df: pl.DataFrame,
+    index: SamplerIndex,
     n_samples: int,
     grouping: bool = False,
     grouping_strategy: str = None,
     num_groups: Union[float, int] = 0.1,
     seed: int = 42,
-) -> Tuple[pl.DataFrame, np.array]:
-    """Samples data from a DataFrame based on the specified criteria.
+) -> np.ndarray:
+    """Samples rows of a dataset based on the specified criteria.
 
     Args:
-        df (pl.DataFrame): The DataFrame to sample from.
+        index (SamplerIndex): The rows to sample from.
         n_samples (int): The number of samples to extract.
         grouping (bool, optional): Whether to group the samples. Defaults to False.
         grouping_strategy (str, optional): The strategy for grouping the samples. Defaults to None.
@@ -47,7 +200,8 @@ def data_sampler(
         seed (int, optional): The seed for random number generation. Defaults to 42.
 
     Returns:
-        Tuple[pl.DataFrame, np.array]: A tuple containing the sampled data and the corresponding labels.
+        np.ndarray: The sorted indices of the sampled rows (repeated when sampled with
+            replacement), see `SamplerIndex.dataset` and `SamplerIndex.X`.
 
     Raises:
         AssertionError: If the number of samples is invalid.
@@ -55,162 +209,257 @@ def data_sampler(
         ValueError: If the grouping_strategy is invalid.
     """
     assert (
-        n_samples > 0 and isinstance(n_samples, int) and n_samples <= len(df)
+        n_samples > 0 and isinstance(n_samples, int) and n_samples <= len(index)
     ), "Invalid number of samples"
 
     assert isinstance(num_groups, (float, int)), "`num_groups` must be float or int"
 
-    # if grouping_strategy is not None:
-    #     assert (
-    #         grouping
-    #     ), "Chemical aware strategy can only be used when grouping is True"
+    rng = np.random.default_rng(seed)
 
     if not grouping:
-        samples = df.sample(n=n_samples, seed=seed)
-        X, y = samples.drop(["Condition", "Strain", "Phenotype"]), samples["Phenotype"]
+        return np.sort(rng.choice(len(index), n_samples, replace=False))
+
+    match grouping_strategy:
+        case "condition" | "strain":
+            group_rows = (
+                index.condition_rows
+                if grouping_strategy == "condition"
+                else index.strain_rows
+            )
+
+            if isinstance(num_groups, int):
+                assert (
+                    num_groups > 0 and num_groups < len(group_rows)
+                ), f"Number of groups must be between 0 and the number of unique {grouping_strategy}s"
+
+            else:
+                assert 0 < num_groups < 1, "Number of groups must be between 0 and 1"
+                num_groups = int(np.ceil(len(group_rows) * num_groups))
+                # This is not ideal because sometimes the requested number of groups may not be enough for the number of samples
+                # In this case, I'm sampling with replacement
+
+            groups_considered = rng.choice(
+                list(group_rows), num_groups, replace=False
+            ).tolist()
+
+        case "intelligent_strain":
+            # Obtain samples from strains that are most representative
+            group_rows = index.strain_rows
+            groups_considered = representative_strains(
+                *index.strain_distances, num_groups
+            )
+
+        case _:
+            raise ValueError("Invalid grouping_strategy")
+
+    return np.sort(
+        _sample_groups(group_rows, groups_considered, n_samples, num_groups, rng)
+    )
 
-    else:
-        match grouping_strategy:
-            case "condition":
-                unique_conditions = df["Condition"].value_counts()
-
-                if isinstance(num_groups, int):
-                    assert (
-                        num_groups > 0 and num_groups < len(unique_conditions)
-                    ), "Number of groups must be between 0 and the number of unique conditions"
-
-                else:
-                    assert (
-                        0 < num_groups < 1
-                    ), "Number of groups must be between 0 and 1"
-                    num_groups = np.ceil(len(unique_conditions) * num_groups)
-                    # This is not ideal because sometimes the requested number of groups may not be enough for the number of samples
-                    # In this case, I'm sampling with replacement
-
-                conditions_considered = unique_conditions.sample(num_groups, seed=seed)[
-                    "Condition"
-                ].to_list()
-
-                if (
-                    unique_conditions.filter(
-                        pl.col("Condition").is_in(conditions_considered)
-                    ).sum()["count"][0]
-                    < n_samples
-                ):
-                    warn(
-                        f"Sampling with replacement is done. The number of groups {num_groups} is not enough for the number of samples {n_samples}"
-                    )
-                    samples = df.filter(
-                        pl.col("Condition").is_in(conditions_considered)
-                    ).sample(n=n_samples, seed=seed, with_replacement=True)
-
-                else:
-                    samples = df.filter(
-                        pl.col("Condition").is_in(conditions_considered)
-                    ).sample(n=n_samples, seed=seed)
-
-                X, y = (
-                    samples.drop(["Condition", "Strain", "Phenotype"]),
-                    samples["Phenotype"],
-                )
-
-            case "strain":
-                unique_strains = df["Strain"].value_counts()
-
-                if isinstance(num_groups, int):
-                    assert (
-                        num_groups > 0 and num_groups < len(unique_strains)
-                    ), "Number of groups must be between 0 and the number of unique strains"
-
-                else:
-                    assert (
-                        0 < num_groups < 1
-                    ), "Number of groups must be between 0 and 1"
-                    num_groups = np.ceil(len(unique_strains) * num_groups)
-                    # This is not ideal because sometimes the requested number of groups may not be enough for the number of samples
-                    # In this case, I'm sampling with replacement
-
-                strains_considered = unique_strains.sample(num_groups, seed=seed)[
-                    "Strain"
-                ].to_list()
-
-                if (
-                    unique_strains.filter(
-                        pl.col("Strain").is_in(strains_considered)
-                    ).sum()["count"][0]
-                    < n_samples
-                ):
-                    warn(
-                        f"Sampling with replacement is done. The number of groups {num_groups} is not enough for the number of samples {n_samples}"
-                    )
-                    samples = df.filter(
-                        pl.col("Strain").is_in(strains_considered)
-                    ).sample(n=n_samples, seed=seed, with_replacement=True)
-
-                else:
-                    samples = df.filter(
-                        pl.col("Strain").is_in(strains_considered)
-                    ).sample(n=n_samples, seed=seed)
-
-                X, y = (
-                    samples.drop(["Condition", "Strain", "Phenotype"]),
-                    samples["Phenotype"],
-                )
-
-            case "intelligent_strain":
-                # A little more involved
-                # Obtain samples from strains that are most representative
-                # print("Sampling from representative strains")
-                unique_strains = df["Strain"].value_counts()
-                # strains = df["Strain"].unique(maintain_order=True).to_numpy()
-                strain_data = (
-                    df.select(cs.starts_with("Y"))
-                    # .unique(maintain_order=True)
-                    .to_numpy()
-                )
-                avg_dist_btw_strains = squareform(
-                    pdist(strain_data, metric="cityblock")
-                ).mean(axis=0)
-
-                representative_strains = np.argsort(avg_dist_btw_strains)[
-                    : int(
-                        num_groups * len(avg_dist_btw_strains)
-                        if isinstance(num_groups, float)
-                        else num_groups
-                    )
-                ]
-
-                if (
-                    unique_strains.filter(
-                        pl.col("Strain").is_in(representative_strains)
-                    ).sum()["count"][0]
-                    < n_samples
-                ):
-                    warn(
-                        f"Sampling with replacement is done. The number of groups {num_groups} is not enough for the number of samples {n_samples}"
-                    )
-                    samples = df.filter(
-                        pl.col("Strain").is_in(representative_strains)
-                    ).sample(n=n_samples, seed=seed, with_replacement=True)
-                else:
-                    samples = df.filter(
-                        pl.col("Strain").is_in(representative_strains)
-                    ).sample(n=n_samples, seed=seed)
-
-                X, y = (
-                    samples.drop(["Condition", "Strain", "Phenotype"]),
-                    samples["Phenotype"],
-                )
-            case _:
-                ValueError("Invalid grouping_strategy")
-
-    return X, y.to_numpy()
+
+def sample_capacity(
+    index: SamplerIndex,
+    grouping: bool = False,
+    grouping_strategy: str = None,
+    num_groups: Union[float, int] = 0.1,
+) -> int:
+    """The most rows `data_sampler` draws without replacement, whichever groups the seed
+    picks: all the rows, or those of the smallest groups it may consider.
+
+    Args:
+        index (SamplerIndex): The rows to sample from.
+        grouping (bool, optional): Whether to group the samples. Defaults to False.
+        grouping_strategy (str, optional): The strategy for grouping the samples. Defaults to None.
+        num_groups (Union[float, int], optional): The number of groups to consider. Defaults to 0.1.
+
+    Returns:
+        int: The number of rows.
+
+    Raises:
+        ValueError: If the grouping_strategy is invalid.
+    """
+    if not grouping:
+        return len(index)
+
+    match grouping_strategy:
+        case "condition" | "strain":
+            group_rows = (
+                index.condition_rows
+                if grouping_strategy == "condition"
+                else index.strain_rows
+            )
+            if isinstance(num_groups, float):
+                num_groups = int(np.ceil(len(group_rows) * num_groups))
+            sizes = np.sort([len(rows) for rows in group_rows.values()])
+            return int(sizes[:num_groups].sum())
+
+        case "intelligent_strain":
+            strains = representative_strains(*index.strain_distances, num_groups)
+            return sum(len(index.strain_rows[strain]) for strain in strains)
+
+        case _:
+            raise ValueError("Invalid grouping_strategy")
+
+
+class ValidationDatasets:
+    """The test rows, standardized with the statistics of the training rows (`index.scaler`),
+    as LightGBM Datasets binned like the training rows.
+
+    The rows are standardized once per study and shared by every model. Referencing the
+    Dataset of `index`, which every sample is a subset of, `lgb.train` does not bin them
+    again. `lgb.train` does update the parameters and the reference of its validation
+    Dataset, so models trained concurrently `borrow` one each. A Dataset is only built when
+    all the others are in use, so there are at most as many as concurrent models.
+
+    Args:
+        test_df (pl.DataFrame): The test DataFrame.
+        index (SamplerIndex): The training data the samples are drawn from.
+    """
+
+    def __init__(self, test_df: pl.DataFrame, index: SamplerIndex):
+        X_test = test_df.drop(["Condition", "Strain", "Phenotype"]).to_numpy()
+        self.X = apply_scaler(X_test, index.scaler)
+        self.y = test_df["Phenotype"].to_numpy()
+        self.index = index
+        self._free = queue.SimpleQueue()
+        self._free.put(self._build())  # Binned before any model is trained
+
+    def _build(self) -> lgb.Dataset:
+        return lgb.Dataset(
+            self.X,
+            self.y,
+            reference=self.index.dataset({"verbose": -1}),
+            free_raw_data=False,
+        ).construct()
+
+    @contextmanager
+    def borrow(self) -> Iterator[lgb.Dataset]:
+        """A constructed validation Dataset that no other model uses until it is returned."""
+        try:
+            dataset = self._free.get_nowait()
+        except queue.Empty:
+            dataset = self._build()
+        try:
+            yield dataset
+        finally:
+            self._free.put(dataset)
+
+
+def _train_repeat(
+    i: int,
+    index: SamplerIndex,
+    val_datasets: ValidationDatasets,
+    sampler_params: dict,
+    config: DictConfig,
+    num_threads: int,
+) -> float:
+    """Trains a model on the `i`-th sample and returns its best validation score."""
+    seed = i if config.repeat_samples else config.seed
+
+    # A subset of the Dataset binned once, on the rows standardized once
+    sampled_rows = data_sampler(index, seed=seed, **sampler_params)
+    train_dataset = index.dataset({"verbose": -1}).subset(sampled_rows)
+
+    model_params = {
+        "objective": config.model_params.objective,
+        "verbose": -10,
+        "early_stopping_rounds": 10,
+        "lambda_l1": config.model_params.lambda_l1,
+        "lambda_l2": config.model_params.lambda_l2,
+        "num_leaves": config.model_params.num_leaves,
+        "feature_fraction": config.model_params.feature_fraction,
+        "bagging_fraction": config.model_params.bagging_fraction,
+        "bagging_freq": config.model_params.bagging_freq,
+        "min_child_samples": config.model_params.min_child_samples,
+        "learning_rate": config.model_params.learning_rate,
+        "metrics": config.model_params.metrics,
+        "num_threads": num_threads,
+        "random_seed": i
+        if not config.model_params.seed
+        else config.model_params.seed,  # Change seed every iteration
+    }
+
+    n_estimators = config.model_params.n_estimators
+
+    with val_datasets.borrow() as val_dataset:
+        model = lgb.train(
+            params=model_params,
+            train_set=train_dataset,
+            num_boost_round=n_estimators,
+            valid_sets=[val_dataset],
+            # valid_names=["val"],
+            # feval=eval_metric
+        )
+
+    # console.print(model.best_score["valid_0"])
+
+    return model.best_score["valid_0"][config.model_params.metrics]
+
+
+def score_samples(
+    index: SamplerIndex,
+    val_datasets: ValidationDatasets,
+    sampler_params: dict,
+    config: DictConfig,
+) -> float:
+    """Trains a model on each of the `config.repeat_num` samples drawn with
+    `sampler_params` and returns their mean validation score. The models are trained
+    `config.n_jobs` at a time.
+
+    Parameters
+    ----------
+    index : SamplerIndex
+        The training data to sample from.
+    val_datasets : ValidationDatasets
+        The validation Datasets.
+    sampler_params : dict
+        Arguments of `data_sampler`, but the index and the seed.
+    config : DictConfig
+        The configuration dictionary.
+
+    Returns
+    -------
+    float
+        The mean score over the repeats.
+    """
+    # Concurrent repeats share the threads LightGBM would use for a single model
+    n_jobs, num_threads = split_threads(
+        config.get("n_jobs", 1), config.repeat_num, config.model_params.num_threads
+    )
+    scores = run_folds(
+        partial(
+            _train_repeat,
+            index=index,
+            val_datasets=val_datasets,
+            sampler_params=sampler_params,
+            config=config,
+            num_threads=num_threads,
+        ),
+        [(i,) for i in range(config.repeat_num)],
+        n_jobs=n_jobs,
+        backend="threading",  # LightGBM releases the GIL, the index Dataset is shared
+    )
+
+    return float(np.mean(scores))
+
+
+def suggest_grouping(trial: optuna.Trial, config: DictConfig) -> dict:
+    """Suggests how the samples are grouped, the `data_sampler` parameters but
+    `n_samples`."""
+    return {
+        "grouping": trial.suggest_categorical("grouping", [True, False]),
+        "grouping_strategy": trial.suggest_categorical(
+            "grouping_strategy",
+            list(config.get("grouping_strategies", ["condition", "strain"])),
+        ),
+        "num_groups": trial.suggest_float("num_groups", 0.1, 0.9),
+    }
 
 
 def tune_sampler(
     trial: optuna.Trial,
-    train_df: pl.DataFrame,
-    test_df: pl.DataFrame,
+    index: SamplerIndex,
+    val_datasets: ValidationDatasets,
     config: DictConfig,
 ):
     """Tunes the data_sampler parameters using Optuna's trial object.
@@ -219,10 +468,10 @@ def tune_sampler(
     ----------
     trial : optuna.Trial
         The Optuna trial object.
-    train_df : pl.DataFrame
-        The input DataFrame.
-    test_df : pl.DataFrame
-        The test DataFrame.
+    index : SamplerIndex
+        The training data to sample from.
+    val_datasets : ValidationDatasets
+        The validation Datasets shared by the trials.
     config : DictConfig
         The configuration dictionary.
 
@@ -233,80 +482,157 @@ def tune_sampler(
     mean_score : float
         The mean score over the cross-validation folds.
     """
-    X_test, y_test = (
-        test_df.drop(["Condition", "Strain", "Phenotype"]).to_numpy(),
-        test_df["Phenotype"].to_numpy(),
-    )
-    X_test = StandardScaler().fit_transform(X_test)
-    val_dataset = lgb.Dataset(X_test, y_test, free_raw_data=False)
 
-    max_samples = train_df.shape[0]  # Max should be # of the training samples
+    max_samples = len(index)  # Max should be # of the training samples
 
-    sampler_params = {
-        "df": train_df,
-        "n_samples": trial.suggest_int(
-            "n_samples",
-            10,
-            max_samples,
-        ),
-        "grouping": trial.suggest_categorical("grouping", [True, False]),
-        "grouping_strategy": trial.suggest_categorical(
-            "grouping_strategy",
-            [
-                "condition",
-                "strain",
-            ],
-        ),
-        "num_groups": trial.suggest_float("num_groups", 0.1, 0.9),
-        # "seed": config.seed,
-    }
+    n_samples = trial.suggest_int("n_samples", 10, max_samples)
+    sampler_params = {"n_samples": n_samples, **suggest_grouping(trial, config)}
 
-    scores = []
+    return n_samples, score_samples(index, val_datasets, sampler_params, config)
 
-    for i in range(config.repeat_num):
-        sampler_params["seed"] = i if config.repeat_samples else config.seed
 
-        sampled_X, sampled_y = data_sampler(**sampler_params)
-        sampled_X = StandardScaler().fit_transform(sampled_X.to_numpy())
+def fidelity_rungs(
+    min_samples: int, max_samples: int, reduction_factor: int
+) -> List[int]:
+    """The sample sizes of successive halving, `min_samples` growing `reduction_factor`
+    times per rung up to `max_samples`, which is always the last."""
+    rungs, n_samples = [], min(min_samples, max_samples)
+    while n_samples < max_samples:
+        rungs.append(n_samples)
+        n_samples *= reduction_factor
+    return rungs + [max_samples]
 
-        train_dataset = lgb.Dataset(sampled_X, sampled_y, free_raw_data=False)
 
-        model_params = {
-            "objective": config.model_params.objective,
-            "verbose": -10,
-            "early_stopping_rounds": 10,
-            "lambda_l1": config.model_params.lambda_l1,
-            "lambda_l2": config.model_params.lambda_l2,
-            "num_leaves": config.model_params.num_leaves,
-            "feature_fraction": config.model_params.feature_fraction,
-            "bagging_fraction": config.model_params.bagging_fraction,
-            "bagging_freq": config.model_params.bagging_freq,
-            "min_child_samples": config.model_params.min_child_samples,
-            "learning_rate": config.model_params.learning_rate,
-            "metrics": config.model_params.metrics,
-            "random_seed": i
-            if not config.model_params.seed
-            else config.model_params.seed,  # Change seed every iteration
-        }
+class LearningCurve:
+    """The mean scores of the sampled configurations by sample size, one table per grouping
+    strategy.
 
-        n_estimators = config.model_params.n_estimators
+    The tables are written to `learning_curve_{strategy}.csv` in `savedir` ("random" for
+    the ungrouped samples) as the rows come in and read back when the study is resumed, so
+    that a configuration is never trained twice at the same sample size. They belong to the
+    study of `savedir`, the model and repeat settings are not part of the key.
 
-        model = lgb.train(
-            params=model_params,
-            train_set=train_dataset,
-            num_boost_round=n_estimators,
-            valid_sets=[val_dataset],
-            # valid_names=["val"],
-            # feval=eval_metric
+    Parameters
+    ----------
+    savedir : str
+        The directory of the tables.
+    strategies : List[str]
+        The grouping strategies of the study.
+    """
+
+    SCHEMA = {
+        "trial": pl.Int64,
+        "num_groups": pl.Float64,
+        "n_samples": pl.Int64,
+        "score": pl.Float64,
+    }
+
+    def __init__(self, savedir: str, strategies: List[str]):
+        self.savedir = Path(savedir)
+        self.rows: Dict[str, List[dict]] = {}
+        self.scores: Dict[Tuple[str, Optional[float], int], float] = {}
+
+        for strategy in [*strategies, "random"]:
+            path = self.path(strategy)
+            rows = (
+                pl.read_csv(path, schema=self.SCHEMA).to_dicts()
+                if path.exists()
+                else []
+            )
+            self.rows[strategy] = rows
+            for row in rows:
+                key = (strategy, row["num_groups"], row["n_samples"])
+                self.scores[key] = row["score"]
+
+    def path(self, strategy: str) -> Path:
+        return self.savedir / f"learning_curve_{strategy}.csv"
+
+    @staticmethod
+    def key(sampler_params: dict) -> Tuple[str, Optional[float], int]:
+        """The grouping of the samples and their number. Ungrouped samples do not depend on
+        the strategy or the number of groups."""
+        if not sampler_params["grouping"]:
+            return "random", None, sampler_params["n_samples"]
+        return (
+            sampler_params["grouping_strategy"],
+            float(sampler_params["num_groups"]),
+            sampler_params["n_samples"],
         )
 
-        # console.print(model.best_score["valid_0"])
+    def get(self, sampler_params: dict) -> Optional[float]:
+        return self.scores.get(self.key(sampler_params))
+
+    def add(self, sampler_params: dict, score: float, trial: int):
+        """Records a score and rewrites the table of its strategy."""
+        strategy, num_groups, n_samples = key = self.key(sampler_params)
+        self.scores[key] = score
+        self.rows[strategy].append(
+            {
+                "trial": trial,
+                "num_groups": num_groups,
+                "n_samples": n_samples,
+                "score": score,
+            }
+        )
+        pl.DataFrame(self.rows[strategy], schema=self.SCHEMA).write_csv(
+            self.path(strategy)
+        )
+
+
+def tune_sampler_fidelity(
+    trial: optuna.Trial,
+    index: SamplerIndex,
+    val_datasets: ValidationDatasets,
+    config: DictConfig,
+    curve: LearningCurve,
+) -> float:
+    """Scores a grouping of the samples on growing sample sizes, stopping as soon as the
+    study's successive halving pruner finds it is not among the best at a size.
+
+    Parameters
+    ----------
+    trial : optuna.Trial
+        The Optuna trial object.
+    index : SamplerIndex
+        The training data to sample from.
+    val_datasets : ValidationDatasets
+        The validation Datasets shared by the trials.
+    config : DictConfig
+        The configuration dictionary, with `multi_fidelity`.
+    curve : LearningCurve
+        Where the scores of every sample size are recorded, and looked up.
+
+    Returns
+    -------
+    float
+        The mean score on the largest sample of the grouping (see `sample_capacity`).
 
-        score = model.best_score["valid_0"][config.model_params.metrics]
+    Raises
+    ------
+    optuna.TrialPruned
+        If the grouping is not promoted to the next sample size.
+    """
+    sampler_params = suggest_grouping(trial, config)
 
-        scores.append(score)
+    # The last rung samples as many rows as the grouping has, never with replacement
+    rungs = fidelity_rungs(
+        config.multi_fidelity.min_samples,
+        max(sample_capacity(index, **sampler_params), 1),
+        config.multi_fidelity.reduction_factor,
+    )
+    for n_samples in rungs:
+        sampler_params["n_samples"] = n_samples
+        score = curve.get(sampler_params)
+        if score is None:
+            score = score_samples(index, val_datasets, sampler_params, config)
+            curve.add(sampler_params, score, trial.number)
 
-    return sampler_params["n_samples"], np.mean(scores)
+        trial.set_user_attr("n_samples", n_samples)
+        trial.report(score, step=n_samples)
+        if trial.should_prune():
+            raise optuna.TrialPruned()
+
+    return score
 
 
 def verify_path(path: str):
@@ -338,14 +664,49 @@ def main(conf: DictConfig):
 
     verify_path(conf.data.savedir)  # Create directory if it doesn't exist
 
-    train_df = pl.read_ipc(conf.data.train_data)
-    test_df = pl.read_ipc(conf.data.test_data)
+    # Genotypes are kept as int8 until the training rows are standardized, once
+    if is_factorized(conf.data.train_data):
+        train_df = FactorizedData.load(conf.data.train_data)
+    else:
+        train_df = compact_genotypes(pl.read_ipc(conf.data.train_data))
+    test_df = compact_genotypes(get_data(conf.data.test_data, run_type="full"))
+
+    # Standardized once, the trials sample row indices
+    index = SamplerIndex(train_df, distance_cache_dir=conf.get("distance_cache_dir"))
+    val_datasets = ValidationDatasets(test_df, index)
+    del train_df, test_df  # The index and the Datasets hold what the trials need
 
     storage_path = conf.data.savedir + "tune_study_journal.txt"
     storage = optuna.storages.JournalStorage(
         optuna.storages.JournalFileStorage(storage_path)
     )
 
+    if conf.get("multi_fidelity", {}).get("enabled", False):
+        # Successive halving over n_samples, every grouping starting on the smallest
+        curve = LearningCurve(conf.data.savedir, list(conf.grouping_strategies))
+        sampler_study = optuna.create_study(
+            storage=storage,
+            study_name="sampler_study_fidelity",
+            direction=conf.multi_fidelity.direction,
+            pruner=optuna.pruners.SuccessiveHalvingPruner(
+                min_resource=conf.multi_fidelity.min_samples,
+                reduction_factor=conf.multi_fidelity.reduction_factor,
+            ),
+            sampler=optuna.samplers.TPESampler(),
+            load_if_exists=True,
+        )
+
+        sampler_study.optimize(
+            lambda trial: tune_sampler_fidelity(
+                trial, index, val_datasets, conf, curve
+            ),
+            n_trials=conf.n_trials,
+        )
+
+        with open(conf.data.savedir + "sampler_study_fidelity.pkl", "wb") as f:
+            pickle.dump(sampler_study.best_trial, f)
+        return
+
     sampler_study = optuna.create_study(
         storage=storage,
         study_name="sampler_study",
@@ -356,7 +717,7 @@ def main(conf: DictConfig):
     )
 
     sampler_study.optimize(
-        lambda trial: tune_sampler(trial, train_df, test_df, conf),
+        lambda trial: tune_sampler(trial, index, val_datasets, conf),
         n_trials=conf.n_trials,
         # catch=(ValueError)
     )
@@ -0,0 +1,409 @@
+# Metrics as polars expressions, so that every (Condition, Fold) group is scored in one pass,
+# and as NumPy kernels scoring every group of many bootstrap resamples at once
+
+import warnings
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import polars as pl
+from numpy import ndarray
+from omegaconf import DictConfig
+
+
+def _confusion(y_true: pl.Expr, y_pred: pl.Expr) -> Tuple[pl.Expr, ...]:
+    """True positives, false positives, false negatives and true negatives of binary labels."""
+    true, pred = y_true == 1, y_pred == 1
+    return (
+        (true & pred).sum().cast(pl.Float64),
+        (~true & pred).sum().cast(pl.Float64),
+        (true & ~pred).sum().cast(pl.Float64),
+        (~true & ~pred).sum().cast(pl.Float64),
+    )
+
+
+def accuracy(y_true: pl.Expr, y_pred: pl.Expr) -> pl.Expr:
+    """Fraction of correctly predicted labels, as `sklearn.metrics.accuracy_score`."""
+    return (y_true == y_pred).mean()
+
+
+def f1(y_true: pl.Expr, y_pred: pl.Expr) -> pl.Expr:
+    """F1 score of the positive (1) class, as `sklearn.metrics.f1_score`.
+
+    0 if there are neither true nor predicted positives.
+    """
+    tp, fp, fn, _ = _confusion(y_true, y_pred)
+    denominator = 2 * tp + fp + fn
+    return pl.when(denominator > 0).then(2 * tp / denominator).otherwise(0.0)
+
+
+def mcc(y_true: pl.Expr, y_pred: pl.Expr) -> pl.Expr:
+    """Matthews correlation coefficient, as `sklearn.metrics.matthews_corrcoef`.
+
+    0 if any of the sums of the confusion matrix is 0.
+    """
+    tp, fp, fn, tn = _confusion(y_true, y_pred)
+    denominator = ((tp + fp) * (tp + fn) * (tn + fp) * (tn + fn)).sqrt()
+    return (
+        pl.when(denominator > 0).then((tp * tn - fp * fn) / denominator).otherwise(0.0)
+    )
+
+
+def roc_auc(y_true: pl.Expr, y_score: pl.Expr) -> pl.Expr:
+    """Area under the ROC curve from the ranks of the scores (Mann-Whitney U statistic).
+
+    Ties get their average rank, which gives the same value as
+    `sklearn.metrics.roc_auc_score`. Null if only one class is present, where sklearn raises.
+    """
+    positive = (y_true == 1).cast(pl.Float64)
+    n_pos = positive.sum()
+    n_neg = positive.count() - n_pos
+    rank_sum = (y_score.rank(method="average") * positive).sum()
+    return (
+        pl.when((n_pos > 0) & (n_neg > 0))
+        .then((rank_sum - n_pos * (n_pos + 1) / 2) / (n_pos * n_neg))
+        .otherwise(None)
+    )
+
+
+def mse(y_true: pl.Expr, y_pred: pl.Expr) -> pl.Expr:
+    """Mean squared error, as `sklearn.metrics.mean_squared_error`."""
+    return ((y_true - y_pred) ** 2).mean()
+
+
+def r2(y_true: pl.Expr, y_pred: pl.Expr) -> pl.Expr:
+    """Coefficient of determination, as `sklearn.metrics.r2_score`.
+
+    For a constant `y_true` it is 1 for perfect predictions and 0 otherwise.
+    """
+    ss_res = ((y_true - y_pred) ** 2).sum()
+    ss_tot = ((y_true - y_true.mean()) ** 2).sum()
+    return (
+        pl.when(ss_tot > 0)
+        .then(1 - ss_res / ss_tot)
+        .when(ss_res == 0)
+        .then(1.0)
+        .otherwise(0.0)
+    )
+
+
+def pearson(y_true: pl.Expr, y_pred: pl.Expr) -> pl.Expr:
+    """Pearson correlation, as `utils.get_corr(..., method="pearson")`."""
+    return pl.corr(y_true, y_pred, method="pearson")
+
+
+def spearman(y_true: pl.Expr, y_pred: pl.Expr) -> pl.Expr:
+    """Spearman rank correlation, as `utils.get_corr(..., method="spearman")`."""
+    return pl.corr(y_true, y_pred, method="spearman")
+
+
+# Metric configs (see configs/metrics/) that have a polars equivalent, by _target_
+KERNELS: Dict[str, Callable[[pl.Expr, pl.Expr], pl.Expr]] = {
+    "sklearn.metrics.accuracy_score": accuracy,
+    "sklearn.metrics.f1_score": f1,
+    "sklearn.metrics.matthews_corrcoef": mcc,
+    "sklearn.metrics.roc_auc_score": roc_auc,
+    "sklearn.metrics.mean_squared_error": mse,
+    "sklearn.metrics.r2_score": r2,
+}
+CORR_KERNELS: Dict[str, Callable[[pl.Expr, pl.Expr], pl.Expr]] = {
+    "pearson": pearson,
+    "spearman": spearman,
+}
+
+
+def get_kernel(metric: DictConfig) -> Optional[Callable[[pl.Expr, pl.Expr], pl.Expr]]:
+    """Returns the polars equivalent of a metric config, None if it has none.
+
+    Metrics with arguments other than the defaults of the kernels (e.g. `average` for
+    `f1_score`) have no equivalent.
+    """
+    return _lookup(metric, KERNELS, CORR_KERNELS)
+
+
+def _lookup(
+    metric: DictConfig, kernels: Dict, corr_kernels: Dict
+) -> Optional[Callable]:
+    kwargs = {key: value for key, value in metric.items() if key != "_target_"}
+
+    if metric._target_ == "utils.get_corr" and kwargs.keys() == {"method"}:
+        return corr_kernels.get(kwargs["method"])
+    if not kwargs:
+        return kernels.get(metric._target_)
+
+    return None
+
+
+def get_metric_exprs(
+    metrics: DictConfig, y_true: str = "Phenotype", y_pred: str = "Preds"
+) -> Tuple[List[pl.Expr], List[str]]:
+    """Splits the configured metrics into polars expressions and metrics without a kernel.
+
+    Parameters
+    ----------
+    metrics : DictConfig
+        The metric configs by name, e.g. configs/metrics/clf.yaml.
+    y_true : str, optional
+        Column of the true values, by default "Phenotype".
+    y_pred : str, optional
+        Column of the predictions, by default "Preds".
+
+    Returns
+    -------
+    Tuple[List[pl.Expr], List[str]]
+        Aggregation expressions aliased to the metric names, and the names of the metrics
+        that must be computed with `hydra.utils.call`.
+    """
+    true, pred = pl.col(y_true).cast(pl.Float64), pl.col(y_pred).cast(pl.Float64)
+
+    exprs, unmapped = [], []
+    for name, metric in metrics.items():
+        kernel = get_kernel(metric)
+        if kernel is None:
+            unmapped.append(name)
+        else:
+            exprs.append(kernel(true, pred).alias(name))
+
+    return exprs, unmapped
+
+
+# Batched kernels. The rows of every group are contiguous, `starts` being the first row of
+# each group, and every row of `y_true` and `y_pred` is a resample: (resamples, rows) arrays
+# are scored into (resamples, groups) arrays
+
+
+def _group_sums(x: ndarray, starts: ndarray) -> ndarray:
+    return np.add.reduceat(x, starts, axis=1)
+
+
+def _group_sizes(x: ndarray, starts: ndarray) -> ndarray:
+    return np.diff(starts, append=x.shape[1])
+
+
+def _center(x: ndarray, starts: ndarray) -> ndarray:
+    """`x` minus the mean of its group."""
+    sizes = _group_sizes(x, starts)
+    return x - np.repeat(_group_sums(x, starts) / sizes, sizes, axis=1)
+
+
+def _group_ranks(x: ndarray, starts: ndarray) -> ndarray:
+    """Ranks within the groups of every resample, ties getting their average rank.
+
+    All the groups of all the resamples are ranked in one sort, by (group, value). A run of
+    tied values spans from the last run start to the next run end, found with running
+    maxima and minima of the positions.
+    """
+    n_resamples, n_rows = x.shape
+    sizes = _group_sizes(x, starts)
+    # The group of every value, distinct across resamples, and the position it starts at
+    groups = np.arange(n_resamples)[:, None] * len(starts) + np.repeat(
+        np.arange(len(starts)), sizes
+    )
+    group_starts = (
+        np.arange(n_resamples)[:, None] * n_rows + np.repeat(starts, sizes)
+    ).ravel()
+
+    order = np.lexsort((x.ravel(), groups.ravel()))
+    values, groups = x.ravel()[order], groups.ravel()[order]
+    positions = np.arange(len(order))
+
+    run_start = np.ones(len(order), dtype=bool)
+    run_start[1:] = (values[1:] != values[:-1]) | (groups[1:] != groups[:-1])
+    run_end = np.append(run_start[1:], True)
+    first = np.maximum.accumulate(np.where(run_start, positions, 0))
+    last = np.minimum.accumulate(np.where(run_end, positions, len(order) - 1)[::-1])[
+        ::-1
+    ]
+
+    # Groups keep their positions in the sort, so `group_starts` is in sorted order too
+    ranks = np.empty(len(order))
+    ranks[order] = (first + last) / 2 - group_starts + 1
+    return ranks.reshape(x.shape)
+
+
+def _divide(numerator: ndarray, denominator: ndarray, default: float) -> ndarray:
+    """`numerator / denominator`, `default` where the denominator is not positive."""
+    out = np.full(np.broadcast(numerator, denominator).shape, default)
+    return np.divide(numerator, denominator, out=out, where=denominator > 0)
+
+
+def _batched_confusion(
+    y_true: ndarray, y_pred: ndarray, starts: ndarray
+) -> Tuple[ndarray, ...]:
+    true, pred = y_true == 1, y_pred == 1
+    return tuple(
+        _group_sums(cell.astype(np.float64), starts)
+        for cell in (true & pred, ~true & pred, true & ~pred, ~true & ~pred)
+    )
+
+
+def batched_accuracy(y_true: ndarray, y_pred: ndarray, starts: ndarray) -> ndarray:
+    """See `accuracy`."""
+    correct = (y_true == y_pred).astype(np.float64)
+    return _group_sums(correct, starts) / _group_sizes(y_true, starts)
+
+
+def batched_f1(y_true: ndarray, y_pred: ndarray, starts: ndarray) -> ndarray:
+    """See `f1`."""
+    tp, fp, fn, _ = _batched_confusion(y_true, y_pred, starts)
+    return _divide(2 * tp, 2 * tp + fp + fn, 0.0)
+
+
+def batched_mcc(y_true: ndarray, y_pred: ndarray, starts: ndarray) -> ndarray:
+    """See `mcc`."""
+    tp, fp, fn, tn = _batched_confusion(y_true, y_pred, starts)
+    denominator = np.sqrt((tp + fp) * (tp + fn) * (tn + fp) * (tn + fn))
+    return _divide(tp * tn - fp * fn, denominator, 0.0)
+
+
+def batched_roc_auc(y_true: ndarray, y_score: ndarray, starts: ndarray) -> ndarray:
+    """See `roc_auc`, NaN if only one class is present."""
+    positive = (y_true == 1).astype(np.float64)
+    n_pos = _group_sums(positive, starts)
+    n_neg = _group_sizes(y_true, starts) - n_pos
+    rank_sum = _group_sums(_group_ranks(y_score, starts) * positive, starts)
+    return _divide(rank_sum - n_pos * (n_pos + 1) / 2, n_pos * n_neg, np.nan)
+
+
+def batched_mse(y_true: ndarray, y_pred: ndarray, starts: ndarray) -> ndarray:
+    """See `mse`."""
+    return _group_sums((y_true - y_pred) ** 2, starts) / _group_sizes(y_true, starts)
+
+
+def batched_r2(y_true: ndarray, y_pred: ndarray, starts: ndarray) -> ndarray:
+    """See `r2`."""
+    ss_res = _group_sums((y_true - y_pred) ** 2, starts)
+    ss_tot = _group_sums(_center(y_true, starts) ** 2, starts)
+    constant = np.where(ss_res == 0, 1.0, 0.0)
+    return np.where(ss_tot > 0, 1 - _divide(ss_res, ss_tot, 0.0), constant)
+
+
+def batched_pearson(y_true: ndarray, y_pred: ndarray, starts: ndarray) -> ndarray:
+    """See `pearson`, NaN if either side is constant."""
+    true, pred = _center(y_true, starts), _center(y_pred, starts)
+    denominator = np.sqrt(_group_sums(true**2, starts) * _group_sums(pred**2, starts))
+    return _divide(_group_sums(true * pred, starts), denominator, np.nan)
+
+
+def batched_spearman(y_true: ndarray, y_pred: ndarray, starts: ndarray) -> ndarray:
+    """See `spearman`, NaN if either side is constant."""
+    return batched_pearson(
+        _group_ranks(y_true, starts), _group_ranks(y_pred, starts), starts
+    )
+
+
+BATCHED_KERNELS: Dict[str, Callable[[ndarray, ndarray, ndarray], ndarray]] = {
+    "sklearn.metrics.accuracy_score": batched_accuracy,
+    "sklearn.metrics.f1_score": batched_f1,
+    "sklearn.metrics.matthews_corrcoef": batched_mcc,
+    "sklearn.metrics.roc_auc_score": batched_roc_auc,
+    "sklearn.metrics.mean_squared_error": batched_mse,
+    "sklearn.metrics.r2_score": batched_r2,
+}
+BATCHED_CORR_KERNELS: Dict[str, Callable[[ndarray, ndarray, ndarray], ndarray]] = {
+    "pearson": batched_pearson,
+    "spearman": batched_spearman,
+}
+
+
+def get_batched_kernel(
+    metric: DictConfig,
+) -> Optional[Callable[[ndarray, ndarray, ndarray], ndarray]]:
+    """Returns the batched NumPy equivalent of a metric config, None if it has none (see
+    `get_kernel`)."""
+    return _lookup(metric, BATCHED_KERNELS, BATCHED_CORR_KERNELS)
+
+
+def bootstrap_metrics(
+    pred_df: pl.DataFrame,
+    metrics: DictConfig,
+    n_resamples: int = 1000,
+    confidence: float = 0.95,
+    seed: Optional[int] = None,
+    block_size: int = 1 << 24,
+    y_true: str = "Phenotype",
+    y_pred: str = "Preds",
+    by: Tuple[str, ...] = ("Condition", "Fold"),
+) -> pl.DataFrame:
+    """Percentile bootstrap confidence intervals of the metrics of every group.
+
+    The rows of every group are resampled with replacement `n_resamples` times. The
+    resampled row indices are drawn as a matrix, for as many resamples as fit in
+    `block_size` entries at a time, and every metric scores all the groups and resamples of
+    the matrix at once.
+
+    Parameters
+    ----------
+    pred_df : pl.DataFrame
+        The true values and predictions, with the `by` columns.
+    metrics : DictConfig
+        The metric configs by name, those without a batched kernel get no interval.
+    n_resamples : int, optional
+        Number of resamples of every group, by default 1000.
+    confidence : float, optional
+        Confidence level of the intervals, by default 0.95.
+    seed : Optional[int], optional
+        Seed of the resamples, by default None.
+    block_size : int, optional
+        Number of resampled rows drawn at a time, which bounds the memory used. By default
+        1 << 24.
+    y_true : str, optional
+        Column of the true values, by default "Phenotype".
+    y_pred : str, optional
+        Column of the predictions, by default "Preds".
+    by : Tuple[str, ...], optional
+        The columns of the groups, by default ("Condition", "Fold").
+
+    Returns
+    -------
+    pl.DataFrame
+        The `by` columns, in order of appearance, and the `{metric}_low` and
+        `{metric}_high` bounds of every metric with a batched kernel.
+    """
+    kernels = {
+        name: kernel
+        for name, metric in metrics.items()
+        if (kernel := get_batched_kernel(metric)) is not None
+    }
+
+    groups = (
+        pred_df.with_row_index("row")
+        .group_by(*by, maintain_order=True)
+        .agg(pl.col("row"))
+    )
+    sizes = groups["row"].list.len().to_numpy()
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]]).astype(np.intp)
+    order = groups["row"].explode().to_numpy()
+    true = pred_df[y_true].cast(pl.Float64).to_numpy()[order]
+    pred = pred_df[y_pred].cast(pl.Float64).to_numpy()[order]
+
+    # Every position of a group is resampled from the rows of that group
+    position_start = np.repeat(starts, sizes)
+    position_size = np.repeat(sizes, sizes)
+
+    rng = np.random.default_rng(seed)
+    stats: Dict[str, List[ndarray]] = {name: [] for name in kernels}
+    batch_size = max(1, block_size // max(len(order), 1))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        for start in range(0, n_resamples, batch_size):
+            n_batch = min(batch_size, n_resamples - start)
+            offsets = (rng.random((n_batch, len(order))) * position_size).astype(
+                np.intp
+            )
+            rows = position_start + offsets
+            true_batch, pred_batch = true[rows], pred[rows]
+            for name, kernel in kernels.items():
+                stats[name].append(kernel(true_batch, pred_batch, starts))
+
+    alpha = (1 - confidence) / 2
+    bounds = {}
+    for name, values in stats.items():
+        with warnings.catch_warnings():  # Groups where the metric is never defined
+            warnings.simplefilter("ignore", RuntimeWarning)
+            low, high = np.nanquantile(
+                np.concatenate(values), [alpha, 1 - alpha], axis=0
+            )
+        bounds |= {f"{name}_low": low, f"{name}_high": high}
+
+    return groups.drop("row").with_columns(
+        pl.Series(name, values) for name, values in bounds.items()
+    )
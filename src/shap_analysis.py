@@ -1,66 +1,297 @@
+from concurrent.futures import ProcessPoolExecutor
+from functools import cache, partial
+from multiprocessing import get_context
 from pathlib import Path
-from typing import List
+from typing import Dict, List, Optional, Tuple
 from dotenv import load_dotenv
 import hydra
+import lightgbm as lgb
+import numpy as np
 import polars as pl
+from numpy import ndarray
 from rich import print
 from omegaconf import DictConfig
-from sklearn.preprocessing import StandardScaler
-from utils import get_model, get_model_paths
+from utils import (
+    apply_scaler,
+    fit_data_scaler,
+    get_feature_blocks,
+    get_feature_names,
+    get_labels,
+    get_model,
+    get_model_paths,
+    get_scalers,
+    iter_batches,
+    split_threads,
+)
 
 load_dotenv()
 
 
+def use_native_contrib(conf: DictConfig) -> bool:
+    """Whether the SHAP values of LightGBM models are computed with `pred_contrib=True`
+    rather than with `conf.explainer`, see `configs/interpret.yaml`."""
+    return conf.get("native_contrib", True) and conf.explainer._target_ in (
+        "shap.TreeExplainer",
+        "shap.explainers.Tree",
+    )
+
+
+class ShapAggregator:
+    """Running mean of the absolute SHAP values of every feature, fed chunk by chunk of rows,
+    so memory is O(features) whatever the number of rows.
+
+    Rows can be weighted (e.g. by `stratified_sample`). With `n_bootstrap` replicates, every
+    row also gets a Poisson(1) count per replicate (Poisson bootstrap), which gives the
+    replicate means without keeping the rows, and from them the standard error of the mean.
+
+    Feature blocks are summarised by the absolute sum of the SHAP values of their features,
+    the SHAP value of the block, and are kept as extra columns after the features. Groups
+    of rows (e.g. the Conditions) get their own means from the same chunks, by summing the
+    rows of every group of the chunk (segment sums).
+
+    Parameters
+    ----------
+    n_features : int
+        Number of features.
+    n_bootstrap : int, optional
+        Number of bootstrap replicates, by default 0 (no error estimate).
+    seed : Optional[int], optional
+        Seed of the bootstrap counts. Aggregators with the same seed fed chunks of the same
+        sizes draw the same counts, so their replicates can be combined. By default None.
+    blocks : Optional[ndarray], optional
+        (features, blocks) indicator of the block of every feature, by default no blocks.
+    n_groups : Optional[Dict[str, int]], optional
+        Number of groups of every grouping of the rows, by default no groupings.
+    """
+
+    def __init__(
+        self,
+        n_features: int,
+        n_bootstrap: int = 0,
+        seed: Optional[int] = None,
+        blocks: Optional[ndarray] = None,
+        n_groups: Optional[Dict[str, int]] = None,
+    ):
+        self.blocks = np.zeros((n_features, 0)) if blocks is None else blocks
+        n_columns = n_features + self.blocks.shape[1]
+
+        self.sum = np.zeros(n_columns)
+        self.weight = 0.0
+        self.boot_sum = np.zeros((n_bootstrap, n_columns))
+        self.boot_weight = np.zeros(n_bootstrap)
+        self.group_sum = {
+            name: np.zeros((n, n_columns)) for name, n in (n_groups or {}).items()
+        }
+        self.group_weight = {name: np.zeros(n) for name, n in (n_groups or {}).items()}
+        self.rng = np.random.default_rng(seed)
+
+    def update(
+        self,
+        shap_values: ndarray,
+        weights: Optional[ndarray] = None,
+        groups: Optional[Dict[str, ndarray]] = None,
+    ) -> None:
+        """Adds a chunk of (rows, features) SHAP values, with optional row weights and the
+        group of every row for each grouping."""
+        abs_values = np.abs(np.hstack([shap_values, shap_values @ self.blocks]))
+        weights = np.ones(len(abs_values)) if weights is None else weights
+
+        self.sum += weights @ abs_values
+        self.weight += weights.sum()
+        if len(self.boot_weight):
+            counts = self.rng.poisson(1.0, (len(self.boot_weight), len(abs_values)))
+            boot_weights = counts * weights
+            self.boot_sum += boot_weights @ abs_values
+            self.boot_weight += boot_weights.sum(axis=1)
+
+        weighted = abs_values * weights[:, None]
+        for name, codes in (groups or {}).items():
+            order = np.argsort(codes, kind="stable")
+            present, starts = np.unique(codes[order], return_index=True)
+            self.group_sum[name][present] += np.add.reduceat(
+                weighted[order], starts, axis=0
+            )
+            self.group_weight[name][present] += np.add.reduceat(weights[order], starts)
+
+    @property
+    def mean(self) -> ndarray:
+        """The mean absolute SHAP value of every feature, then of every block."""
+        return self.sum / self.weight
+
+    @property
+    def replicates(self) -> ndarray:
+        """The mean absolute SHAP values of every bootstrap replicate, (replicates, columns)."""
+        return self.boot_sum / self.boot_weight[:, None]
+
+    def group_mean(self, name: str) -> ndarray:
+        """The mean absolute SHAP values of every group of a grouping, (groups, columns)."""
+        return self.group_sum[name] / self.group_weight[name][:, None]
+
+
+def factorize(labels: pl.Series) -> Tuple[ndarray, List[str]]:
+    """Returns the code of every label and the distinct labels, in order of appearance."""
+    # Codes from the values themselves, Categorical codes depend on the string cache
+    uniques, first_rows, codes = np.unique(
+        labels.cast(pl.Utf8).to_numpy(), return_index=True, return_inverse=True
+    )
+    order = np.argsort(first_rows)
+    ranks = np.empty_like(order)
+    ranks[order] = np.arange(len(order))
+    return ranks[codes], uniques[order].tolist()
+
+
+def stratified_sample(
+    conditions: pl.Series, per_condition: int, seed: Optional[int] = None
+) -> Tuple[ndarray, ndarray]:
+    """Samples up to `per_condition` rows of every Condition, without replacement.
+
+    Parameters
+    ----------
+    conditions : pl.Series
+        The Condition of every row.
+    per_condition : int
+        Number of rows sampled per Condition, all the rows of smaller conditions are kept.
+    seed : Optional[int], optional
+        Seed of the sample, by default None.
+
+    Returns
+    -------
+    Tuple[ndarray, ndarray]
+        The sorted sampled rows, and their weights (rows of the Condition / rows sampled
+        from it), so that weighted means over the sample estimate means over all the rows.
+    """
+    rng = np.random.default_rng(seed)
+    codes, _ = factorize(conditions)
+
+    rows, weights = [], []
+    for code in np.unique(codes):
+        condition_rows = np.flatnonzero(codes == code)
+        n_sampled = min(per_condition, len(condition_rows))
+        rows.append(rng.choice(condition_rows, n_sampled, replace=False))
+        weights.append(np.full(n_sampled, len(condition_rows) / n_sampled))
+
+    rows, weights = np.concatenate(rows), np.concatenate(weights)
+    order = np.argsort(rows)
+    return rows[order], weights[order]
+
+
 def get_shap_values(
-    conf: DictConfig, model_path: Path, data_path: Path, fold: int
-) -> pl.DataFrame:
-    """Compute SHAP values for a given model and dataset.
+    conf: DictConfig,
+    model: lgb.Booster,
+    data_path: Path,
+    scaler: Optional[Tuple[ndarray, ndarray]] = None,
+    rows: Optional[ndarray] = None,
+    weights: Optional[ndarray] = None,
+    groups: Optional[Dict[str, ndarray]] = None,
+    blocks: Optional[ndarray] = None,
+) -> ShapAggregator:
+    """Compute the mean absolute SHAP value of every feature for a given model, overall and
+    per group of rows.
+
+    The data is read `conf.data_loading.batch_size` rows at a time (see
+    `utils.iter_batches`), and every batch is standardized, explained and added to the
+    means before the next one is read, so memory is bounded by one batch of features.
+    `conf.explainer` gets the first standardized batch as its background data.
 
     Parameters
     ----------
-    model_path : Path
-        Path to the pickle file containing the model.
+    conf : DictConfig
+        Configuration object with the explainer and the `subsample` settings.
+    model : lgb.Booster
+        The model.
     data_path : Path
-        Path to the csv file containing the data.
-    fold : int
-        The number of the fold to compute SHAP values for.
+        Path to the data file, or to a factorized dataset.
+    scaler : Optional[Tuple[ndarray, ndarray]], optional
+        The scaler of the model (see `utils.get_scalers`), by default None (no scaling).
+    rows : Optional[ndarray], optional
+        The sorted rows to explain (see `stratified_sample`), by default all of them.
+    weights : Optional[ndarray], optional
+        The weight of every explained row (see `stratified_sample`), by default None.
+    groups : Optional[Dict[str, ndarray]], optional
+        The group code of every explained row (see `factorize`) of each grouping, by
+        default None.
+    blocks : Optional[ndarray], optional
+        (features, blocks) indicator of the block of every feature, by default None.
 
     Returns
     -------
-    pl.DataFrame
-        A DataFrame containing the mean absolute SHAP values for each feature,
-        sorted in descending order.
+    ShapAggregator
+        The mean absolute SHAP values, their bootstrap replicates and group means.
     """
-    model = get_model(model_path)
-    data = pl.read_ipc(data_path)
-    X = data.drop(["Condition", "Strain", "Phenotype"]).to_pandas()
-    X_std = StandardScaler().fit_transform(X)
-    y = data["Phenotype"].to_numpy()
-
-    # instantiate explainer
-    explainer = hydra.utils.instantiate(conf.explainer, model, X_std)
-
-    # compute shap values
-    shap_values = explainer.shap_values(X_std, y, approximate=True)
-    shap_df = pl.DataFrame(data=shap_values, schema=X.columns.to_list())
-    shap_mean = (
-        shap_df.with_columns(pl.all().abs().mean())
-        .unique()
-        .melt()
-        .with_columns(Fold=pl.lit(fold))
-        .rename({"value": "Value", "variable": "Feature"})
-        .sort("Value", descending=True)
+    batch_size = conf.data_loading.get("batch_size", 100_000)
+    subsample = conf.get("subsample", {})
+    aggregator = ShapAggregator(
+        model.num_feature(),
+        n_bootstrap=subsample.get("n_bootstrap", 0),
+        seed=subsample.get("seed"),
+        blocks=blocks,
+        n_groups={name: codes.max() + 1 for name, codes in (groups or {}).items()},
     )
 
-    return shap_mean
+    native = use_native_contrib(conf)
+    explainer = None
+
+    # dummy is the same as full, because it doesn't care about features
+    run_type = "full" if conf.run_type == "dummy" else conf.run_type
+    offset = 0
+    for X, labels in iter_batches(data_path, run_type, batch_size):
+        n_rows = len(X)
+        if rows is None:
+            chunk = slice(offset, offset + n_rows)
+        else:
+            # The sampled rows of the batch
+            start, stop = np.searchsorted(rows, [offset, offset + n_rows])
+            chunk = slice(start, stop)
+            X, labels = X[rows[chunk] - offset], labels[rows[chunk] - offset]
+        offset += n_rows
+        if not len(X):
+            continue
+        X_std = apply_scaler(X, scaler)  # In place, X is the batch's own array
+
+        # compute shap values
+        if native:
+            # LightGBM's TreeSHAP, the last column is the expected value
+            shap_values = model.predict(X_std, pred_contrib=True)[:, :-1]
+        else:
+            if explainer is None:
+                explainer = hydra.utils.instantiate(conf.explainer, model, X_std)
+            shap_values = explainer.shap_values(
+                X_std, labels["Phenotype"].to_numpy(), approximate=True
+            )
+        aggregator.update(
+            shap_values,
+            None if weights is None else weights[chunk],
+            {name: codes[chunk] for name, codes in (groups or {}).items()},
+        )
+
+    return aggregator
+
+
+def _shap_fold(conf: DictConfig, model_path: Path, *args, **kwargs) -> ShapAggregator:
+    """`get_shap_values` in a worker process, which reads the data itself."""
+    return get_shap_values(conf, get_model(model_path), *args, **kwargs)
 
 
 def get_shap_folds(
     conf: DictConfig, model_paths: List[Path], data_path: Path
-) -> pl.DataFrame:
+) -> Dict[str, pl.DataFrame]:
     """Compute SHAP values for multiple models from the same dataset and concatenate them. Useful
     for when when you have models trained on different folds of the underlying data.
 
+    Every fold streams the dataset batch by batch (see `get_shap_values`), standardized with
+    its own scaler, so the features are never loaded whole. With LightGBM's `pred_contrib`
+    (see `use_native_contrib`) the folds are computed one after another with all the cores.
+    Otherwise every fold runs `conf.explainer` in a worker process. The workers are spawned,
+    not forked, as polars' thread pool doesn't survive a fork.
+
+    With `conf.subsample.per_condition`, only a stratified sample of the rows is explained
+    (see `stratified_sample`), and with `conf.subsample.n_bootstrap` the standard error of
+    the fold-averaged values is estimated (see `ShapAggregator`).
+
+    The same pass summarises the feature blocks (`conf.feature_blocks`, see
+    `utils.get_feature_blocks`) and every group of the `conf.groups` columns (e.g.
+    Condition, Strain).
+
     Parameters
     ----------
     conf : DictConfig
@@ -72,23 +303,152 @@ def get_shap_folds(
 
     Returns
     -------
-    pl.DataFrame
-        A DataFrame containing the mean absolute SHAP values for each feature,
-        sorted in descending order, computed for each model and concatenated.
+    Dict[str, pl.DataFrame]
+        The tables by file name suffix. "" is a DataFrame containing the mean absolute SHAP
+        values for each feature, sorted in descending order, computed for each model and
+        concatenated. With bootstrap replicates, `Value_se` is their standard error.
+        "_blocks" is the same for the feature blocks, and "_{group}" and
+        "_{group}_blocks" hold the values of every group of a column.
     """
-    df_folds = []
-    for fold, model_path in enumerate(model_paths):
-        print(f"Fold: {fold}")
-        df_fold = get_shap_values(conf, model_path, data_path, fold)
-        df_folds.append(df_fold)
+    feature_names = get_feature_names(data_path, run_type=conf.run_type)
+    scalers = get_scalers(
+        model_paths,
+        cache(
+            partial(
+                fit_data_scaler,
+                data_path,
+                "full" if conf.run_type == "dummy" else conf.run_type,
+                conf.data_loading.get("batch_size", 100_000),
+            )
+        ),
+    )
+
+    subsample = conf.get("subsample", {})
+    group_columns = list(conf.get("groups", []))
+    labels = get_labels(
+        data_path, columns=list(dict.fromkeys(["Condition", *group_columns]))
+    )
+    rows, weights = None, None
+    if subsample.get("per_condition") is not None:
+        rows, weights = stratified_sample(
+            labels["Condition"], subsample.per_condition, subsample.get("seed")
+        )
+        labels = labels[rows]
+
+    group_codes, group_levels = {}, {}
+    for column in group_columns:
+        group_codes[column], group_levels[column] = factorize(labels[column])
+    del labels
+
+    block_names, blocks = [], None
+    if conf.get("feature_blocks", True):
+        feature_blocks = get_feature_blocks(feature_names)
+        block_names = sorted(set(feature_blocks))
+        blocks = np.array(
+            [[block == name for name in block_names] for block in feature_blocks],
+            dtype=np.float64,
+        )
+    summary = dict(rows=rows, weights=weights, groups=group_codes, blocks=blocks)
+
+    if use_native_contrib(conf):
+        fold_values = []
+        for fold, (model_path, scaler) in enumerate(zip(model_paths, scalers)):
+            print(f"Fold: {fold}")
+            fold_values.append(
+                get_shap_values(
+                    conf, get_model(model_path), data_path, scaler, **summary
+                )
+            )
+    else:
+        n_jobs, _ = split_threads(conf.get("n_jobs", -1), len(model_paths))
+        with ProcessPoolExecutor(
+            max_workers=n_jobs, mp_context=get_context("spawn")
+        ) as executor:
+            futures = [
+                executor.submit(
+                    _shap_fold, conf, model_path, data_path, scaler, **summary
+                )
+                for model_path, scaler in zip(model_paths, scalers)
+            ]
+            fold_values = [future.result() for future in futures]
+
+    n_features = len(feature_names)
+    tables = {
+        "": mean_table(
+            "Feature",
+            feature_names,
+            [values.mean[:n_features] for values in fold_values],
+        )
+    }
+    if block_names:
+        tables["_blocks"] = mean_table(
+            "Block", block_names, [values.mean[n_features:] for values in fold_values]
+        )
+
+    if subsample.get("n_bootstrap", 0) > 1:
+        # The folds drew the same counts, so a replicate of the average is the average of
+        # the replicates
+        replicates = np.mean([values.replicates for values in fold_values], axis=0)
+        std_error = replicates.std(axis=0, ddof=1)
+        for suffix, (column, names, columns) in {
+            "": ("Feature", feature_names, slice(None, n_features)),
+            "_blocks": ("Block", block_names, slice(n_features, None)),
+        }.items():
+            if suffix in tables:
+                tables[suffix] = tables[suffix].join(
+                    pl.DataFrame({column: names, "Value_se": std_error[columns]}),
+                    on=column,
+                    how="left",
+                )
+
+    for column in group_columns:
+        group_means = np.mean([values.group_mean(column) for values in fold_values], 0)
+        tables[f"_{column}"] = group_table(
+            column, group_levels[column], "Feature", feature_names, group_means
+        )
+        if block_names:
+            tables[f"_{column}_blocks"] = group_table(
+                column, group_levels[column], "Block", block_names, group_means
+            )
+
+    return tables
+
+
+def mean_table(
+    column: str, names: List[str], fold_means: List[ndarray]
+) -> pl.DataFrame:
+    """The fold-averaged mean absolute SHAP value of every feature (or block), in the order of
+    the first fold's ranking."""
+    df_folds = [
+        pl.DataFrame({column: names, "Value": values})
+        .with_columns(Fold=pl.lit(fold))
+        .sort("Value", descending=True)
+        for fold, values in enumerate(fold_means)
+    ]
 
     final_df = pl.concat(df_folds)
-    final_df = final_df.group_by("Feature", maintain_order=True).agg(
+    final_df = final_df.group_by(column, maintain_order=True).agg(
         pl.col("Value").mean()
     )
     return final_df
 
 
+def group_table(
+    group: str, levels: List[str], column: str, names: List[str], group_means: ndarray
+) -> pl.DataFrame:
+    """Long table of the (groups, features then blocks) mean absolute SHAP values, of the
+    features or the blocks in `names`, sorted by group and descending value."""
+    columns = (
+        slice(None, len(names)) if column == "Feature" else slice(-len(names), None)
+    )
+    return (
+        pl.DataFrame(group_means[:, columns], schema=names)
+        .with_columns(pl.Series(group, levels))
+        .melt(id_vars=group, variable_name=column, value_name="Value")
+        .sort([group, "Value"], descending=[False, True])
+    )
+
+
 @hydra.main(config_path="../configs/", version_base="1.3", config_name="interpret")
 def main(conf: DictConfig) -> None:
     """Main entry point for the script.
@@ -119,8 +479,9 @@ def main(conf: DictConfig) -> None:
     print(model_paths)
 
     for model_name, model_path in model_paths.items():
-        shap_df = get_shap_folds(conf, model_path, conf.data_paths.get(model_name))
-        shap_df.write_csv(out_path / f"shap_{model_name}_{model_type}.csv")
+        shap_dfs = get_shap_folds(conf, model_path, conf.data_paths.get(model_name))
+        for suffix, shap_df in shap_dfs.items():
+            shap_df.write_csv(out_path / f"shap_{model_name}_{model_type}{suffix}.csv")
 
 
 if __name__ == "__main__":
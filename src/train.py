@@ -3,8 +3,17 @@ import lightgbm as lgb
 from omegaconf import DictConfig
 import hydra
 from sklearn.model_selection import train_test_split
-from sklearn.preprocessing import StandardScaler
-from utils import get_data, get_model_paths
+from utils import (
+    ModelBundle,
+    ModelRegistry,
+    apply_scaler,
+    fit_scaler,
+    get_data,
+    get_feature_names,
+    get_file_hash,
+    get_model_paths,
+    register_model,
+)
 from rich.console import Console
 from dotenv import load_dotenv
 from pathlib import Path
@@ -53,6 +62,8 @@ def main(conf: DictConfig):
         prefix=conf.model_load_keys.prefix,
         suffix=conf.model_load_keys.suffix,
         model_names=conf.model_load_keys.model_names,
+        registry=conf.get("registry"),
+        scan=conf.model_load_keys.get("scan", True),
     )
     console.print(model_param_paths)
 
@@ -62,14 +73,19 @@ def main(conf: DictConfig):
         console.log("Processing data", style="bold red", justify="center")
 
         Xtrain, ytrain = get_data(
-            conf.data_paths.get(name), run_type=conf.run_type, return_as_Xy=True
+            conf.data_paths.get(name),
+            run_type=conf.run_type,
+            return_as_Xy=True,
+            **conf.data_cache,
+            **conf.data_loading,
         )
         Xtrain, Xtest, ytrain, ytest = train_test_split(
             Xtrain, ytrain, test_size=conf.testing.test_frac, random_state=conf.seed
         )
 
-        Xtrain = StandardScaler().fit_transform(Xtrain)
-        Xtest = StandardScaler().fit_transform(Xtest)
+        scaler = fit_scaler(Xtrain) if conf.scale_features else None
+        Xtrain, Xtest = apply_scaler(Xtrain, scaler), apply_scaler(Xtest, scaler)
+        data_hash = get_file_hash(conf.data_paths.get(name))  # Once for all the models
         console.log("Data processed", style="bold green", justify="center")
 
         for model_param_path in paths:
@@ -88,8 +104,28 @@ def main(conf: DictConfig):
                 ytest=ytest,
             )
 
-            with open(model_param_path.parent / f"{study_name}.pkl", "wb") as f:
-                pickle.dump(model, f)
+            ModelBundle.save(
+                model_param_path.parent / f"{study_name}.bundle",
+                model,
+                scaler,
+                run_type=conf.run_type,
+                data_hash=data_hash,
+                feature_names=get_feature_names(
+                    conf.data_paths.get(name), conf.run_type
+                ),
+            )
+
+            # Under the run of the parameters, as registered by tune_model
+            registry = conf.get("registry")
+            run = ModelRegistry(registry).get(model_param_path) if registry else None
+            run = run or {"savename": name, "seed": conf.seed}
+            register_model(
+                registry,
+                model_param_path.parent / f"{study_name}.bundle",
+                savename=run["savename"],
+                seed=run["seed"],
+                run_type=conf.run_type,
+            )
 
     return None
 
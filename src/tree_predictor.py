@@ -0,0 +1,281 @@
+# Vectorized prediction of LightGBM models from their trees flattened into NumPy arrays
+
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import lightgbm as lgb
+import numpy as np
+from numpy import ndarray
+
+NODE_FIELDS = (
+    "feature",
+    "threshold",
+    "nan_left",
+    "zero_missing",
+    "default_left",
+    "children",
+    "value",
+)
+ZERO_THRESHOLD = 1e-35  # kZeroThreshold in LightGBM, values this close to 0 are zero
+
+# Output transformations by objective, the raw score is returned for the others
+SIGMOID_OBJECTIVES = ("binary", "cross_entropy", "xentropy")
+EXP_OBJECTIVES = ("poisson", "gamma", "tweedie")
+
+
+class TreeEnsemble:
+    """The trees of one or more LightGBM boosters as flat node arrays, evaluated on blocks of
+    rows at once.
+
+    Every node of every tree is an entry of the arrays and leaves point to themselves. The
+    trees are walked together one level at a time, the shallow trees dropping out once
+    every row has reached their leaves. Decisions follow LightGBM's numerical splits,
+    including its handling of missing values, and the predictions match `Booster.predict`
+    (at the best iteration, if any) to float tolerance.
+
+    The fold models of a model are evaluated in the same walk, see `predict`. Categorical
+    splits, linear trees and multiclass models are not supported.
+
+    Parameters
+    ----------
+    boosters : Sequence[lgb.Booster]
+        The models, trained on the same features.
+    """
+
+    def __init__(self, boosters: Sequence[lgb.Booster]):
+        dumps = [booster.dump_model() for booster in boosters]
+        self.num_features = dumps[0]["max_feature_idx"] + 1
+        if any(dump["max_feature_idx"] + 1 != self.num_features for dump in dumps):
+            raise ValueError("The boosters must be trained on the same features.")
+
+        nodes: Dict[str, List[Any]] = {key: [] for key in NODE_FIELDS}
+        roots, depths, tree_booster = [], [], []
+        self.transforms, self.sigmoids, self.average_output = [], [], []
+        for i, dump in enumerate(dumps):
+            if dump["num_tree_per_iteration"] != 1:
+                raise ValueError("Multiclass models are not supported.")
+            transform, sigmoid = _parse_objective(dump.get("objective", "custom"))
+            self.transforms.append(transform)
+            self.sigmoids.append(sigmoid)
+            self.average_output.append(bool(dump.get("average_output", False)))
+
+            for tree in dump["tree_info"]:
+                root, depth = _flatten_tree(tree, nodes)
+                roots.append(root)
+                depths.append(depth)
+                tree_booster.append(i)
+
+        self.feature = np.array(nodes["feature"], dtype=np.intp)
+        self.threshold = np.array(nodes["threshold"], dtype=np.float64)
+        self.nan_left = np.array(nodes["nan_left"], dtype=bool)
+        self.zero_missing = np.array(nodes["zero_missing"], dtype=bool)
+        self.default_left = np.array(nodes["default_left"], dtype=bool)
+        self.children = np.array(nodes["children"], dtype=np.intp).ravel()
+        self.value = np.array(nodes["value"], dtype=np.float64)
+        self.roots = np.array(roots, dtype=np.intp)
+        self.depths = np.array(depths, dtype=np.intp)
+        self.tree_booster = np.array(tree_booster, dtype=np.intp)
+        self.num_boosters = len(dumps)
+
+    def predict(
+        self,
+        X: ndarray,
+        raw_score: bool = False,
+        average: bool = False,
+        boosters: Optional[Sequence[int]] = None,
+        block_size: int = 1 << 17,
+    ) -> ndarray:
+        """Predicts `X` with every booster.
+
+        Parameters
+        ----------
+        X : ndarray
+            The features, as passed to `Booster.predict`.
+        raw_score : bool, optional
+            Whether to return the raw scores instead of e.g. probabilities, by default False.
+        average : bool, optional
+            Whether to average the predictions of the boosters (e.g. the fold models), by
+            default False.
+        boosters : Optional[Sequence[int]], optional
+            The indices of the boosters to predict with, by default all of them.
+        block_size : int, optional
+            Number of (row, tree) pairs walked at a time, which bounds the memory used. By
+            default 1 << 17.
+
+        Returns
+        -------
+        ndarray
+            The predictions, (rows, boosters), or (rows,) if `average` is True.
+        """
+        boosters = np.arange(self.num_boosters) if boosters is None else boosters
+        boosters = np.asarray(boosters, dtype=np.intp)
+        if X.ndim != 2 or X.shape[1] != self.num_features:
+            raise ValueError(
+                f"Expected {self.num_features} features, got an array of shape {X.shape}."
+            )
+
+        # The trees of the selected boosters, deepest first, and the column of each one
+        trees = np.flatnonzero(np.isin(self.tree_booster, boosters))
+        trees = trees[np.argsort(-self.depths[trees], kind="stable")]
+        column_of = np.full(self.num_boosters, -1)
+        column_of[boosters] = np.arange(len(boosters))
+        indicator = np.zeros((len(trees), len(boosters)))
+        indicator[np.arange(len(trees)), column_of[self.tree_booster[trees]]] = 1.0
+
+        raw = np.empty((len(X), len(boosters)))
+        batch_size = max(1, block_size // max(len(trees), 1))
+        for start in range(0, len(X), batch_size):
+            X_batch = np.asarray(X[start : start + batch_size], dtype=np.float64)
+            leaves = self._walk(X_batch, trees)
+            raw[start : start + batch_size] = self.value.take(leaves) @ indicator
+
+        preds = np.empty_like(raw)
+        for column, booster in enumerate(boosters):
+            scores = raw[:, column]
+            if raw_score:
+                preds[:, column] = scores
+                continue
+
+            # Random forests average their trees, but not their raw scores, as LightGBM
+            if self.average_output[booster]:
+                scores = scores / np.count_nonzero(self.tree_booster == booster)
+            preds[:, column] = self._transform(booster, scores)
+
+        return preds.mean(axis=1) if average else preds
+
+    def _walk(self, X: ndarray, trees: ndarray) -> ndarray:
+        """Returns the leaf every row of `X` reaches in every tree, (rows, trees). `trees`
+        must be sorted from the deepest."""
+        X_flat = np.ascontiguousarray(X).ravel()
+        row_offsets = (np.arange(len(X)) * X.shape[1])[:, None]
+        has_nan = bool(np.isnan(X_flat).any())
+        has_zero_missing = bool(self.zero_missing.any())
+
+        nodes = np.tile(self.roots[trees], (len(X), 1))
+        depths = self.depths[trees]
+        for level in range(depths[0] if len(trees) else 0):
+            n_active = np.count_nonzero(
+                depths > level
+            )  # The others are at their leaves
+            active = nodes[:, :n_active]
+
+            fval = X_flat.take(row_offsets + self.feature.take(active))
+            go_left = fval <= self.threshold.take(active)
+            if has_nan:  # NumericalDecision in LightGBM
+                is_nan = np.isnan(fval)
+                go_left[is_nan] = self.nan_left.take(active[is_nan])
+            if has_zero_missing:
+                is_zero = (np.abs(fval) <= ZERO_THRESHOLD) & self.zero_missing.take(
+                    active
+                )
+                go_left[is_zero] = self.default_left.take(active[is_zero])
+
+            nodes[:, :n_active] = self.children.take(2 * active + go_left)
+
+        return nodes
+
+    def _transform(self, booster: int, scores: ndarray) -> ndarray:
+        match self.transforms[booster]:
+            case "sigmoid":
+                return 1 / (1 + np.exp(-self.sigmoids[booster] * scores))
+            case "exp":
+                return np.exp(scores)
+            case _:
+                return scores
+
+
+def _parse_objective(objective: str) -> Tuple[str, float]:
+    """Returns the output transformation and sigmoid parameter of an objective string, e.g.
+    "binary sigmoid:1"."""
+    name, *params = objective.split(" ")
+    params = dict(param.split(":", 1) for param in params if ":" in param)
+
+    if name in ("multiclass", "multiclassova", "softmax", "ovr", "multiclass_ova"):
+        raise ValueError("Multiclass models are not supported.")
+    if name in SIGMOID_OBJECTIVES:
+        return "sigmoid", float(params.get("sigmoid", 1.0))
+    if name in EXP_OBJECTIVES:
+        return "exp", 1.0
+    return "identity", 1.0
+
+
+def _flatten_tree(tree: Dict[str, Any], nodes: Dict[str, List[Any]]) -> Tuple[int, int]:
+    """Appends the nodes of a dumped tree to `nodes` and returns the index of its root and
+    the number of levels below it."""
+    root, depth = len(nodes["feature"]), 0
+    stack = [(tree["tree_structure"], None, 0)]  # (node, parent child slot, level)
+    while stack:
+        node, slot, level = stack.pop()
+        index = len(nodes["feature"])
+        if slot is not None:
+            nodes["children"][slot // 2][slot % 2] = index
+        depth = max(depth, level)
+
+        if "leaf_value" in node:
+            if "leaf_coeff" in node:
+                raise ValueError("Linear trees are not supported.")
+            # A leaf goes to itself whatever the feature
+            nodes["feature"].append(0)
+            nodes["threshold"].append(np.inf)
+            nodes["nan_left"].append(True)
+            nodes["zero_missing"].append(False)
+            nodes["default_left"].append(True)
+            nodes["children"].append([index, index])
+            nodes["value"].append(node["leaf_value"])
+            continue
+
+        if node["decision_type"] != "<=":
+            raise ValueError("Categorical splits are not supported.")
+        missing_type = node["missing_type"]
+        nodes["feature"].append(node["split_feature"])
+        nodes["threshold"].append(node["threshold"])
+        # NaN is missing for the NaN type, is 0 otherwise, which is missing for the Zero type
+        nodes["nan_left"].append(
+            node["default_left"] if missing_type != "None" else 0.0 <= node["threshold"]
+        )
+        nodes["zero_missing"].append(missing_type == "Zero")
+        nodes["default_left"].append(node["default_left"])
+        nodes["children"].append([-1, -1])  # (right, left), indexed by the decision
+        nodes["value"].append(0.0)
+        stack.append((node["right_child"], 2 * index, level + 1))
+        stack.append((node["left_child"], 2 * index + 1, level + 1))
+
+    return root, depth
+
+
+if __name__ == "__main__":
+    # Benchmark against Booster.predict on random data
+    #   python src/tree_predictor.py --model_paths run/*/Boosting.bundle
+
+    from argparse import ArgumentParser
+    from time import perf_counter
+
+    from utils import get_model
+
+    parser = ArgumentParser()
+    parser.add_argument("--model_paths", type=str, nargs="+")
+    parser.add_argument("--n_rows", type=int, default=100_000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    models = [get_model(path) for path in args.model_paths]
+    X = (
+        np.random.default_rng(args.seed)
+        .standard_normal((args.n_rows, models[0].num_feature()))
+        .astype(np.float32)
+    )
+
+    start = perf_counter()
+    expected = np.column_stack([model.predict(X) for model in models])
+    baseline = perf_counter() - start
+
+    start = perf_counter()
+    ensemble = TreeEnsemble(models)
+    compile_time = perf_counter() - start
+
+    start = perf_counter()
+    preds = ensemble.predict(X)
+    elapsed = perf_counter() - start
+
+    print(f"Booster.predict: {baseline:.3f}s for {len(models)} models")
+    print(f"TreeEnsemble:    {elapsed:.3f}s (+{compile_time:.3f}s to flatten)")
+    print(f"Max abs difference: {np.abs(preds - expected).max():.3g}")
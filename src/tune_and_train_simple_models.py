@@ -2,10 +2,9 @@
 import logging
 import pickle
 from pathlib import Path
-from typing import Callable
+from typing import Callable, Optional
 
 import hydra
-import numpy as np
 import optuna
 import polars as pl
 import polars.selectors as cs
@@ -26,8 +25,17 @@ from rich.console import Console  # noqa: E402
 from rich.logging import RichHandler  # noqa: E402
 
 # from sklearn.metrics import roc_auc_score
-from sklearn.model_selection import KFold, train_test_split  # noqa: E402
-from sklearn.preprocessing import StandardScaler  # noqa: E402
+from sklearn.model_selection import train_test_split  # noqa: E402
+from utils import (  # noqa: E402
+    apply_scaler,
+    compact_genotypes,
+    create_study,
+    cross_validate,
+    fit_scaler,
+    get_scaler_path,
+    optimize_study,
+    save_scaler,
+)
 
 load_dotenv()
 
@@ -79,21 +87,7 @@ def tune_LogRegression(trial: optuna.Trial, X, y, config: DictConfig):
         l1_ratio = trial.suggest_float("l1_ratio", 0.0, 1.0)
         params["l1_ratio"] = l1_ratio
 
-    splits = KFold(
-        n_splits=config.kfold_params.n_splits,
-        shuffle=config.kfold_params.shuffle,
-        random_state=config.kfold_params.seed,
-    )
-    scores = []
-    for train_idx, test_idx in splits.split(X, y):
-        X_train, y_train = X[train_idx], y[train_idx]
-        X_test, y_test = X[test_idx], y[test_idx]
-        model = LogisticRegression(**params)
-        model.fit(X_train, y_train)
-        y_pred = model.predict(X_test)
-        scores.append(hydra.utils.call(config.metric, _args_=(y_test, y_pred)))
-
-    return np.mean(scores)
+    return cross_validate(LogisticRegression(**params), X, y, config)
 
 
 def tune_SVM(trial: optuna.Trial, X, y, config: DictConfig):
@@ -120,21 +114,7 @@ def tune_SVM(trial: optuna.Trial, X, y, config: DictConfig):
         degree = trial.suggest_int("degree", 2, 7)
         params["degree"] = degree
 
-    splits = KFold(
-        n_splits=config.kfold_params.n_splits,
-        shuffle=config.kfold_params.shuffle,
-        random_state=config.kfold_params.seed,
-    )
-    scores = []
-    for train_idx, test_idx in splits.split(X, y):
-        X_train, y_train = X[train_idx], y[train_idx]
-        X_test, y_test = X[test_idx], y[test_idx]
-        model = SVC(**params)
-        model.fit(X_train, y_train)
-        y_pred = model.predict(X_test)
-        scores.append(hydra.utils.call(config.metric, _args_=(y_test, y_pred)))
-
-    return np.mean(scores)
+    return cross_validate(SVC(**params), X, y, config)
 
 
 def tune_RF(trial: optuna.Trial, X, y, config: DictConfig):
@@ -157,31 +137,19 @@ def tune_RF(trial: optuna.Trial, X, y, config: DictConfig):
     min_samples_leaf = trial.suggest_int("min_samples_leaf", 5, 100, log=True)
     # ccp_alpha = trial.suggest_float("ccp_alpha", 1e-7, 1.0 , log=True)
 
-    splits = KFold(
-        n_splits=config.kfold_params.n_splits,
-        shuffle=config.kfold_params.shuffle,
-        random_state=config.kfold_params.seed,
+    model = RandomForestClassifier(
+        n_estimators=n_estimators,
+        criterion=criterion,
+        max_samples=max_samples,
+        max_features=max_features,
+        max_depth=max_depth,
+        min_samples_leaf=min_samples_leaf,
+        # ccp_alpha=ccp_alpha,
+        # n_streams=16,
+        # random_state=config.seed,
     )
-    scores = []
-    for train_idx, test_idx in splits.split(X, y):
-        X_train, y_train = X[train_idx], y[train_idx]
-        X_test, y_test = X[test_idx], y[test_idx]
-        model = RandomForestClassifier(
-            n_estimators=n_estimators,
-            criterion=criterion,
-            max_samples=max_samples,
-            max_features=max_features,
-            max_depth=max_depth,
-            min_samples_leaf=min_samples_leaf,
-            # ccp_alpha=ccp_alpha,
-            # n_streams=16,
-            # random_state=config.seed,
-        )
-        model.fit(X_train, y_train)
-        y_pred = model.predict(X_test)
-        scores.append(hydra.utils.call(config.metric, _args_=(y_test, y_pred)))
 
-    return np.mean(scores)
+    return cross_validate(model, X, y, config)
 
 
 # Regression functions
@@ -205,21 +173,7 @@ def tune_ElasticNet(trial: optuna.Trial, X, y, config: DictConfig):
         # "n_jobs":
     }
 
-    splits = KFold(
-        n_splits=config.kfold_params.n_splits,
-        shuffle=config.kfold_params.shuffle,
-        random_state=config.kfold_params.seed,
-    )
-    scores = []
-    for train_idx, test_idx in splits.split(X, y):
-        X_train, y_train = X[train_idx], y[train_idx]
-        X_test, y_test = X[test_idx], y[test_idx]
-        model = ElasticNet(**params)
-        model.fit(X_train, y_train)
-        y_pred = model.predict(X_test)
-        scores.append(hydra.utils.call(config.metric, _args_=(y_test, y_pred)))
-
-    return np.mean(scores)
+    return cross_validate(ElasticNet(**params), X, y, config)
 
 
 def tune_SVR(trial: optuna.Trial, X, y, config: DictConfig):
@@ -250,21 +204,7 @@ def tune_SVR(trial: optuna.Trial, X, y, config: DictConfig):
         degree = trial.suggest_int("degree", 2, 7)
         params["degree"] = degree
 
-    splits = KFold(
-        n_splits=config.kfold_params.n_splits,
-        shuffle=config.kfold_params.shuffle,
-        random_state=config.kfold_params.seed,
-    )
-    scores = []
-    for train_idx, test_idx in splits.split(X, y):
-        X_train, y_train = X[train_idx], y[train_idx]
-        X_test, y_test = X[test_idx], y[test_idx]
-        model = SVR(**params)
-        model.fit(X_train, y_train)
-        y_pred = model.predict(X_test)
-        scores.append(hydra.utils.call(config.metric, _args_=(y_test, y_pred)))
-
-    return np.mean(scores)
+    return cross_validate(SVR(**params), X, y, config)
 
 
 def tune_Neighbours(trial: optuna.Trial, X, y, config: DictConfig):
@@ -285,24 +225,18 @@ def tune_Neighbours(trial: optuna.Trial, X, y, config: DictConfig):
         "metric": "euclidean",
     }
 
-    splits = KFold(
-        n_splits=config.kfold_params.n_splits,
-        shuffle=config.kfold_params.shuffle,
-        random_state=config.kfold_params.seed,
-    )
-
-    scores = []
-    for train_idx, test_idx in splits.split(X, y):
-        X_train, y_train = X[train_idx], y[train_idx]
-        X_test, y_test = X[test_idx], y[test_idx]
-        model = KNeighborsRegressor(**params)
-        model.fit(X_train, y_train)
-        y_pred = model.predict(X_test)
-        scores.append(hydra.utils.call(config.metric, _args_=(y_test, y_pred)))
+    return cross_validate(KNeighborsRegressor(**params), X, y, config)
 
 
 def run_study(
-    study_name: str, tune_objective: Callable, conf: DictConfig, X, y, n_jobs: int = 1
+    study_name: str,
+    tune_objective: Callable,
+    conf: DictConfig,
+    X,
+    y,
+    n_jobs: int = 1,
+    storage: Optional[str] = None,
+    n_workers: int = 1,
 ):
     """Runs an Optuna study to optimize hyperparameters for a given model.
 
@@ -314,21 +248,29 @@ def run_study(
         X: The training features.
         y: The training target variable.
         n_jobs (int, optional): The number of jobs to run in parallel. Defaults to 1.
+        storage (str, optional): Database URL or journal file to keep the study in. An
+            existing study is resumed. Defaults to None (in memory).
+        n_workers (int, optional): Number of processes running trials, each with `n_jobs`
+            threads. Defaults to 1.
 
     Returns:
         optuna.study.Study: The study object.
     """
     pruner = optuna.pruners.HyperbandPruner()
     sampler = optuna.samplers.TPESampler()
-    study = optuna.create_study(
+    study = create_study(
         study_name=study_name,
+        storage=storage,
         direction="maximize",
         pruner=pruner,
         sampler=sampler,
     )
-    study.optimize(
+    optimize_study(
+        study,
         lambda trial: tune_objective(trial, X, y, conf),
         n_trials=conf.n_trials,
+        storage=storage,
+        n_workers=n_workers,
         catch=(ValueError),
         n_jobs=n_jobs,  # Carefully use this parameter. Avoid when using multithreaded algorithms
     )
@@ -368,7 +310,7 @@ def main(conf: DictConfig):
 
     verify_path(conf.data.savedir)
 
-    df = pl.read_ipc(conf.data.path)
+    df = compact_genotypes(pl.read_ipc(conf.data.path))
 
     match conf.run_type:
         case "geno_only":
@@ -396,17 +338,18 @@ def main(conf: DictConfig):
         df.drop(
             ["Phenotype", "Condition", "Strain"],
         )
-        .with_columns(pl.all().cast(pl.Float32))
+        .with_columns(cs.float().cast(pl.Float32))
         .to_numpy()
-    )
+    )  # int8 for genotype-only data, mixed frames become a single float32 array
     y = df["Phenotype"].to_numpy()
 
     Xtrain, Xtest, ytrain, ytest = train_test_split(
         X, y, test_size=0.2, random_state=conf.kfold_params.seed
     )
 
-    Xtrain = StandardScaler().fit_transform(Xtrain)
-    Xtest = StandardScaler().fit_transform(Xtest)
+    # Test data is scaled like the training data, the scaler is saved with every model
+    scaler = fit_scaler(Xtrain)
+    Xtrain, Xtest = apply_scaler(Xtrain, scaler), apply_scaler(Xtest, scaler)
 
     console.log("Training models", style="bold green", justify="center")
 
@@ -420,6 +363,7 @@ def main(conf: DictConfig):
             X=Xtrain,
             y=ytrain,
             n_jobs=5,  # Carefully use this parameter. Avoid when using multithreaded algorithms
+            **conf.study,
         )
 
         # Train best model
@@ -428,6 +372,7 @@ def main(conf: DictConfig):
 
         # verify_path(conf.models.ElasticNet.model_savename)
         pickle.dump(best_model, open(conf.models.ElasticNet.model_savename, "wb"))
+        save_scaler(get_scaler_path(conf.models.ElasticNet.model_savename), scaler)
 
         console.log("Elastic Net Done", style="bold green", justify="center")
 
@@ -458,6 +403,7 @@ def main(conf: DictConfig):
             X=Xtrain,
             y=ytrain,
             n_jobs=5,
+            **conf.study,
         )
 
         # Train best model
@@ -466,6 +412,7 @@ def main(conf: DictConfig):
 
         # verify_path(conf.models.SVR.model_savename)
         pickle.dump(best_model, open(conf.models.SVR.model_savename, "wb"))
+        save_scaler(get_scaler_path(conf.models.SVR.model_savename), scaler)
 
         console.log("SVR Done", style="bold green", justify="center")
 
@@ -477,6 +424,7 @@ def main(conf: DictConfig):
             conf=conf,
             X=Xtrain,
             y=ytrain,
+            **conf.study,
         )
 
         # Train best model
@@ -485,6 +433,7 @@ def main(conf: DictConfig):
 
         # verify_path(conf.models.LogReg.model_savename)
         pickle.dump(best_model, open(conf.models.LogReg.model_savename, "wb"))
+        save_scaler(get_scaler_path(conf.models.LogReg.model_savename), scaler)
 
         console.log("Logistic Regression Done", style="bold green", justify="center")
 
@@ -495,12 +444,14 @@ def main(conf: DictConfig):
             conf=conf,
             X=Xtrain,
             y=ytrain,
+            **conf.study,
         )
         best_model = SVC(**svm_study.best_trial.params)
         best_model.fit(Xtrain, ytrain)
 
     # verify_path(conf.models.SVM.model_savename)
     pickle.dump(best_model, open(conf.models.SVM.model_savename, "wb"))
+    save_scaler(get_scaler_path(conf.models.SVM.model_savename), scaler)
 
     console.log("SVM Done", style="bold green", justify="center")
 
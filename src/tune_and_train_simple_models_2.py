@@ -2,11 +2,11 @@ import logging
 import pickle
 
 # from pathlib import Path
-from typing import Callable
+from typing import Callable, Optional
 
 import hydra
-import numpy as np
 import polars as pl
+import polars.selectors as cs
 import optuna
 from dotenv import load_dotenv
 from sklearn.discriminant_analysis import (
@@ -17,11 +17,20 @@ from sklearn.naive_bayes import GaussianNB
 from sklearn.neighbors import KNeighborsClassifier
 from sklearn.gaussian_process import GaussianProcessClassifier
 from sklearn.gaussian_process.kernels import RBF
-from sklearn.model_selection import KFold, train_test_split
-from sklearn.preprocessing import StandardScaler
+from sklearn.model_selection import train_test_split
 from omegaconf import DictConfig
 from rich.console import Console
 from rich.logging import RichHandler
+from utils import (
+    apply_scaler,
+    compact_genotypes,
+    create_study,
+    cross_validate,
+    fit_scaler,
+    get_scaler_path,
+    optimize_study,
+    save_scaler,
+)
 
 load_dotenv()
 
@@ -45,22 +54,7 @@ def tune_LDA(trial: optuna.Trial, X, y, config: DictConfig):
 
     params = {"solver": solver, "shrinkage": shrinkage}
 
-    splits = KFold(
-        n_splits=config.kfold_params.n_splits,
-        shuffle=config.kfold_params.shuffle,
-        random_state=config.kfold_params.seed,
-    )
-    scores = []
-    for train_idx, test_idx in splits.split(X, y):
-        X_train, y_train = X[train_idx], y[train_idx]
-        X_test, y_test = X[test_idx], y[test_idx]
-        model = LinearDiscriminantAnalysis(**params)
-        model.fit(X_train, y_train)
-        scores.append(
-            hydra.utils.call(config.metric, _args_=(y_test, model.predict(X_test)))
-        )
-
-    return np.mean(scores)
+    return cross_validate(LinearDiscriminantAnalysis(**params), X, y, config)
 
 
 def tune_QDA(trial: optuna.Trial, X, y, config: DictConfig):
@@ -69,22 +63,7 @@ def tune_QDA(trial: optuna.Trial, X, y, config: DictConfig):
 
     params = {"reg_param": reg_param}
 
-    splits = KFold(
-        n_splits=config.kfold_params.n_splits,
-        shuffle=config.kfold_params.shuffle,
-        random_state=config.kfold_params.seed,
-    )
-    scores = []
-    for train_idx, test_idx in splits.split(X, y):
-        X_train, y_train = X[train_idx], y[train_idx]
-        X_test, y_test = X[test_idx], y[test_idx]
-        model = QuadraticDiscriminantAnalysis(**params)
-        model.fit(X_train, y_train)
-        scores.append(
-            hydra.utils.call(config.metric, _args_=(y_test, model.predict(X_test)))
-        )
-
-    return np.mean(scores)
+    return cross_validate(QuadraticDiscriminantAnalysis(**params), X, y, config)
 
 
 def tune_NearestNeighbors(trial: optuna.Trial, X, y, config: DictConfig):
@@ -95,22 +74,7 @@ def tune_NearestNeighbors(trial: optuna.Trial, X, y, config: DictConfig):
 
     params = {"n_neighbors": n_neighbors, "weights": weights}
 
-    splits = KFold(
-        n_splits=config.kfold_params.n_splits,
-        shuffle=config.kfold_params.shuffle,
-        random_state=config.kfold_params.seed,
-    )
-    scores = []
-    for train_idx, test_idx in splits.split(X, y):
-        X_train, y_train = X[train_idx], y[train_idx]
-        X_test, y_test = X[test_idx], y[test_idx]
-        model = KNeighborsClassifier(**params)
-        model.fit(X_train, y_train)
-        scores.append(
-            hydra.utils.call(config.metric, _args_=(y_test, model.predict(X_test)))
-        )
-
-    return np.mean(scores)
+    return cross_validate(KNeighborsClassifier(**params), X, y, config)
 
 
 def tune_NaiveBayes(trial: optuna.Trial, X, y, config: DictConfig):
@@ -119,22 +83,7 @@ def tune_NaiveBayes(trial: optuna.Trial, X, y, config: DictConfig):
 
     params = {"var_smoothing": var_smoothing}
 
-    splits = KFold(
-        n_splits=config.kfold_params.n_splits,
-        shuffle=config.kfold_params.shuffle,
-        random_state=config.kfold_params.seed,
-    )
-    scores = []
-    for train_idx, test_idx in splits.split(X, y):
-        X_train, y_train = X[train_idx], y[train_idx]
-        X_test, y_test = X[test_idx], y[test_idx]
-        model = GaussianNB(**params)
-        model.fit(X_train, y_train)
-        scores.append(
-            hydra.utils.call(config.metric, _args_=(y_test, model.predict(X_test)))
-        )
-
-    return np.mean(scores)
+    return cross_validate(GaussianNB(**params), X, y, config)
 
 
 def tune_GaussianProcesses(trial: optuna.Trial, X, y, config: DictConfig):
@@ -143,39 +92,35 @@ def tune_GaussianProcesses(trial: optuna.Trial, X, y, config: DictConfig):
 
     params = {"kernel": kernel}
 
-    splits = KFold(
-        n_splits=config.kfold_params.n_splits,
-        shuffle=config.kfold_params.shuffle,
-        random_state=config.kfold_params.seed,
-    )
-    scores = []
-    for train_idx, test_idx in splits.split(X, y):
-        X_train, y_train = X[train_idx], y[train_idx]
-        X_test, y_test = X[test_idx], y[test_idx]
-        model = GaussianProcessClassifier(**params)
-        model.fit(X_train, y_train)
-        scores.append(
-            hydra.utils.call(config.metric, _args_=(y_test, model.predict(X_test)))
-        )
-
-    return np.mean(scores)
+    return cross_validate(GaussianProcessClassifier(**params), X, y, config)
 
 
 def run_study(
-    study_name: str, tune_objective: Callable, conf: DictConfig, X, y, n_jobs: int = 1
+    study_name: str,
+    tune_objective: Callable,
+    conf: DictConfig,
+    X,
+    y,
+    n_jobs: int = 1,
+    storage: Optional[str] = None,
+    n_workers: int = 1,
 ):
     """Runs an Optuna study to optimize hyperparameters for a given model."""
     pruner = optuna.pruners.HyperbandPruner()
     sampler = optuna.samplers.TPESampler()
-    study = optuna.create_study(
+    study = create_study(
         study_name=study_name,
+        storage=storage,
         direction="maximize",
         pruner=pruner,
         sampler=sampler,
     )
-    study.optimize(
+    optimize_study(
+        study,
         lambda trial: tune_objective(trial, X, y, conf),
         n_trials=conf.n_trials,
+        storage=storage,
+        n_workers=n_workers,
         catch=(ValueError,),
         n_jobs=n_jobs,
     )
@@ -188,21 +133,22 @@ def main(conf: DictConfig):
     """Main function to process data and tune models."""
     console.log("Processing data", style="bold red", justify="center")
 
-    df = pl.read_ipc(conf.data.path)
+    df = compact_genotypes(pl.read_ipc(conf.data.path))
 
     X = (
         df.drop(["Phenotype", "Condition", "Strain"])
-        .with_columns(pl.all().cast(pl.Float32))
+        .with_columns(cs.float().cast(pl.Float32))
         .to_numpy()
-    )
+    )  # int8 for genotype-only data, mixed frames become a single float32 array
     y = df["Phenotype"].to_numpy()
 
     Xtrain, Xtest, ytrain, ytest = train_test_split(
         X, y, test_size=0.2, random_state=conf.kfold_params.seed
     )
 
-    Xtrain = StandardScaler().fit_transform(Xtrain)
-    Xtest = StandardScaler().fit_transform(Xtest)
+    # Test data is scaled like the training data, the scaler is saved with every model
+    scaler = fit_scaler(Xtrain)
+    Xtrain, Xtest = apply_scaler(Xtrain, scaler), apply_scaler(Xtest, scaler)
 
     console.log("Training models", style="bold green", justify="center")
 
@@ -212,10 +158,12 @@ def main(conf: DictConfig):
         conf=conf,
         X=Xtrain,
         y=ytrain,
+        **conf.study,
     )
     best_model = LinearDiscriminantAnalysis(**lda_study.best_trial.params)
     best_model.fit(Xtrain, ytrain)
     pickle.dump(best_model, open(conf.models.LDA.model_savename, "wb"))
+    save_scaler(get_scaler_path(conf.models.LDA.model_savename), scaler)
 
     console.log("LDA Done", style="bold green", justify="center")
 
@@ -226,10 +174,12 @@ def main(conf: DictConfig):
         conf=conf,
         X=Xtrain,
         y=ytrain,
+        **conf.study,
     )
     best_model = QuadraticDiscriminantAnalysis(**qda_study.best_trial.params)
     best_model.fit(Xtrain, ytrain)
     pickle.dump(best_model, open(conf.models.QDA.model_savename, "wb"))
+    save_scaler(get_scaler_path(conf.models.QDA.model_savename), scaler)
 
     console.log("QDA Done", style="bold green", justify="center")
 
@@ -240,10 +190,12 @@ def main(conf: DictConfig):
         conf=conf,
         X=Xtrain,
         y=ytrain,
+        **conf.study,
     )
     best_model = GaussianNB(**nb_study.best_trial.params)
     best_model.fit(Xtrain, ytrain)
     pickle.dump(best_model, open(conf.models.NB.model_savename, "wb"))
+    save_scaler(get_scaler_path(conf.models.NB.model_savename), scaler)
 
     console.log("NB Done", style="bold green", justify="center")
 
@@ -255,10 +207,12 @@ def main(conf: DictConfig):
         conf=conf,
         X=Xtrain,
         y=ytrain,
+        **conf.study,
     )
     best_model = KNeighborsClassifier(**knn_study.best_trial.params)
     best_model.fit(Xtrain, ytrain)
     pickle.dump(best_model, open(conf.models.KNN.model_savename, "wb"))
+    save_scaler(get_scaler_path(conf.models.KNN.model_savename), scaler)
 
     console.log("KNN Done", style="bold green", justify="center")
 
@@ -2,8 +2,10 @@
 import logging
 import pickle
 import sys
+import threading
+from functools import partial
 from pathlib import Path
-from typing import Callable
+from typing import Callable, List, Optional, Tuple
 
 import hydra
 import lightgbm as lgb
@@ -15,9 +17,25 @@ from rich.console import Console
 from rich.logging import RichHandler
 from sklearn.dummy import DummyClassifier
 from sklearn.model_selection import KFold, train_test_split
-from sklearn.preprocessing import StandardScaler
 from train import train_booster
-from utils import get_data
+from utils import (
+    ModelBundle,
+    apply_scaler,
+    create_study,
+    enqueue_params,
+    fit_scaler,
+    get_best_trial,
+    get_data,
+    get_feature_names,
+    get_file_hash,
+    get_model_paths,
+    register_model,
+    get_own_trials,
+    import_trials,
+    optimize_study,
+    run_folds,
+    split_threads,
+)
 
 load_dotenv()
 
@@ -82,9 +100,179 @@ def create_dummy(
     return model
 
 
+# Parameters that change how LightGBM bins the features. Datasets have to be rebuilt when
+# any of them changes, all other parameters can change between trials.
+BINNING_PARAMS = (
+    "max_bin",
+    "max_bin_by_feature",
+    "min_data_in_bin",
+    "bin_construct_sample_cnt",
+    "use_missing",
+    "zero_as_missing",
+    "linear_tree",
+)
+
+
+class FoldDatasets:
+    """The train/validation `lgb.Dataset`s of every KFold split of the training data.
+
+    Binning the features is a full pass over the data, so the Datasets are constructed once
+    and shared by all the trials of a study instead of once per fold per trial. They are
+    rebuilt only when a trial changes one of the `BINNING_PARAMS`. The validation Datasets
+    reuse the bin mappers of their training Dataset.
+
+    Args:
+        Xtrain (numpy.ndarray): The input features.
+        ytrain (numpy.ndarray): The target variable.
+        config (DictConfig): The configuration dictionary.
+    """
+
+    def __init__(self, Xtrain, ytrain, config: DictConfig):
+        splits = KFold(
+            n_splits=config.kfold_params.n_splits,
+            shuffle=config.kfold_params.shuffle,
+            random_state=config.kfold_params.seed,
+        )
+        self.Xtrain, self.ytrain = Xtrain, ytrain
+        self.splits = list(splits.split(Xtrain, ytrain))
+        self._key = None
+        self._datasets = None
+
+    def get(self, params: dict) -> List[Tuple[lgb.Dataset, lgb.Dataset, np.ndarray]]:
+        """Returns (train Dataset, validation Dataset, validation indices) per fold, binned
+        according to `params`."""
+        key = tuple(params.get(name) for name in BINNING_PARAMS)
+
+        if key != self._key:  # Only one binning is kept in memory
+            # Without the pre-filter, min_data_in_leaf can change between trials
+            dataset_params = params | {"feature_pre_filter": False}
+            self._datasets = []
+            for train_idx, val_idx in self.splits:
+                train_dataset = lgb.Dataset(
+                    self.Xtrain[train_idx],
+                    label=self.ytrain[train_idx],
+                    params=dataset_params,
+                ).construct()
+                val_dataset = lgb.Dataset(
+                    self.Xtrain[val_idx],
+                    label=self.ytrain[val_idx],
+                    params=dataset_params,
+                    reference=train_dataset,
+                ).construct()
+                self._datasets.append((train_dataset, val_dataset, val_idx))
+            self._key = key
+
+        return self._datasets
+
+
+class FoldProgress:
+    """The boosting rounds trained so far by the folds of a trial, shared by their pruning
+    callbacks (see `pruning_callback`).
+
+    Every validation round of any fold is reported at the next step, so a step is the
+    number of rounds the trial has trained. Serial folds report cumulative steps, fold 1
+    picking up where fold 0 stopped, and concurrent folds interleave theirs. Either way
+    every fold can reach the rungs of the pruner, not only the first one.
+
+    Pruners are not thread-safe, so the reports and pruning decisions happen under `lock`,
+    and once a fold is pruned `pruned` is set, so that the other folds stop too.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pruned = threading.Event()
+        self.rounds = 0
+
+
+def pruning_callback(trial: optuna.Trial, progress: FoldProgress) -> Callable:
+    """A LightGBM callback that reports the validation metric of every boosting iteration to
+    the trial and stops training if the pruner decides the trial is not promising.
+
+    The first metric of the validation set is reported, negated if lower is better, so that
+    it is maximized like the objective, at the steps counted by `progress`.
+
+    Args:
+        trial (optuna.Trial): The Optuna trial object.
+        progress (FoldProgress): Shared by the folds of the trial.
+
+    Returns:
+        Callable: The callback.
+    """
+
+    def _callback(env: lgb.callback.CallbackEnv):
+        if progress.pruned.is_set():
+            raise optuna.TrialPruned("Another fold of the trial was pruned.")
+        if not env.evaluation_result_list:
+            return None
+
+        _, _, value, is_higher_better = env.evaluation_result_list[0][:4]
+        with progress.lock:
+            progress.rounds += 1
+            step = progress.rounds
+            trial.report(value if is_higher_better else -value, step)
+            should_prune = trial.should_prune()
+            if should_prune:
+                progress.pruned.set()
+
+        if should_prune:
+            raise optuna.TrialPruned(f"Trial was pruned at step {step}.")
+
+    _callback.order = 40  # After the early stopping callback (30)
+    return _callback
+
+
+def _train_fold(
+    fold: int,
+    train_dataset: lgb.Dataset,
+    val_dataset: lgb.Dataset,
+    val_idx: np.ndarray,
+    trial: optuna.Trial,
+    params: dict,
+    n_estimators: int,
+    Xtrain,
+    ytrain,
+    config: DictConfig,
+    Xtest=None,
+    ytest=None,
+    progress: Optional[FoldProgress] = None,
+) -> Tuple[List[float], int]:
+    """Trains a booster on one fold and scores it on the validation (and test) set. Also
+    returns the number of boosting rounds that were trained."""
+    model = lgb.train(
+        params,
+        train_dataset,
+        num_boost_round=n_estimators,
+        valid_sets=[val_dataset],
+        callbacks=[pruning_callback(trial, progress or FoldProgress())],
+        # verbose_eval=False
+    )
+
+    y_pred_val = model.predict(
+        Xtrain[val_idx],
+    )
+    scores = [
+        hydra.utils.call(config.metric, _args_=(ytrain[val_idx], y_pred_val))
+    ]  # Include score for validation set
+
+    # if separate test set is given
+    if (Xtest is not None) and (ytest is not None):
+        y_pred_test = model.predict(Xtest)
+        scores.append(
+            hydra.utils.call(config.metric, _args_=(ytest, y_pred_test))
+        )  # Include score for test set
+
+    return scores, model.current_iteration()
+
+
 # A function to tune a LightGBM model
 def tune_LGBM(
-    trial: optuna.Trial, Xtrain, ytrain, config: DictConfig, Xtest=None, ytest=None
+    trial: optuna.Trial,
+    Xtrain,
+    ytrain,
+    config: DictConfig,
+    Xtest=None,
+    ytest=None,
+    fold_datasets: Optional[FoldDatasets] = None,
 ):
     """Tunes the LightGBM model using Optuna's trial object.
 
@@ -95,6 +283,8 @@ def tune_LGBM(
         config (DictConfig): The configuration dictionary.
         Xtest (numpy.ndarray | DataFrame, optional): The test input features. Defaults to None.
         ytest (numpy.ndarray | DataFrame, optional): The test target variable. Defaults to None.
+        fold_datasets (FoldDatasets, optional): Datasets of the KFold splits of `Xtrain`, shared
+            between trials. Built for this trial only if None. Defaults to None.
 
     Returns:
         float: The average ROC AUC score over the cross-validation folds.
@@ -132,50 +322,110 @@ def tune_LGBM(
 
     n_estimators = trial.suggest_int("n_estimators", **config.model_params.n_estimators)
 
-    splits = KFold(
-        n_splits=config.kfold_params.n_splits,
-        shuffle=config.kfold_params.shuffle,
-        random_state=config.kfold_params.seed,
+    if fold_datasets is None:
+        fold_datasets = FoldDatasets(Xtrain, ytrain, config)
+
+    datasets = fold_datasets.get(params)
+    # Concurrent folds share the threads LightGBM would use for a single fold
+    n_jobs, params["num_threads"] = split_threads(
+        config.kfold_params.get("n_jobs", 1), len(datasets), params["num_threads"]
     )
 
-    scores = []  # List of scores
-    if (Xtest is not None) and (ytest is not None):
-        # test_scores = []
-        X_test, y_test = Xtest, ytest
-        # test_dataset = lgb.Dataset(X_test, label=y_test)
-
-    for train_idx, val_idx in splits.split(Xtrain, ytrain):
-        X_train, y_train = Xtrain[train_idx], ytrain[train_idx]
-        # console.print(Xtrain.dtype, X_test.dtype)
-        # if (Xtest is  None) and (ytest is None):
-        X_val, y_val = Xtrain[val_idx], ytrain[val_idx]
-        val_dataset = lgb.Dataset(X_val, label=y_val)
-        train_dataset = lgb.Dataset(X_train, label=y_train)
-        model = lgb.train(
-            params,
-            train_dataset,
-            num_boost_round=n_estimators,
-            valid_sets=[val_dataset],
-            # verbose_eval=False
-        )
+    # The pruner sets itself up on its first call, which must not happen in the fold threads
+    trial.should_prune()
 
-        y_pred_val = model.predict(
-            X_val,
-        )
-        scores.append(
-            hydra.utils.call(config.metric, _args_=(y_val, y_pred_val))
-        )  # Include score for validation set
+    results = run_folds(
+        partial(
+            _train_fold,
+            trial=trial,
+            params=params,
+            n_estimators=n_estimators,
+            Xtrain=Xtrain,
+            ytrain=ytrain,
+            config=config,
+            Xtest=Xtest,
+            ytest=ytest,
+            progress=FoldProgress(),
+        ),
+        [(fold, *fold_data) for fold, fold_data in enumerate(datasets)],
+        n_jobs=n_jobs,
+        backend="threading",  # LightGBM releases the GIL while training
+    )
+    scores = [fold_scores for fold_scores, _ in results]  # Validation (and test) scores
 
-        # if separate test set is given
-        if (Xtest is not None) and (ytest is not None):
-            y_pred_test = model.predict(X_test)
-            scores.append(
-                hydra.utils.call(config.metric, _args_=(y_test, y_pred_test))
-            )  # Include score for test set
+    trial.set_user_attr("fold_scores", scores)
+    trial.set_user_attr("boosting_rounds", [rounds for _, rounds in results])
 
     return np.mean(scores)
 
 
+def log_pruning_summary(study: optuna.Study, n_splits: int):
+    """Logs how many trials were pruned and the fraction of the boosting rounds they saved.
+
+    The boosting rounds of a trial are counted from its intermediate values (one per fold
+    and iteration), its budget is `n_splits` * n_estimators.
+
+    Args:
+        study (optuna.Study): The finished study.
+        n_splits (int): The number of cross-validation folds of each trial.
+    """
+    trials = [
+        trial for trial in get_own_trials(study) if "n_estimators" in trial.params
+    ]
+    if not trials:
+        return None
+
+    n_pruned = sum(trial.state == optuna.trial.TrialState.PRUNED for trial in trials)
+    trained = sum(len(trial.intermediate_values) for trial in trials)
+    budget = sum(n_splits * trial.params["n_estimators"] for trial in trials)
+    saved = 1 - trained / budget
+
+    study.set_user_attr("boosting_rounds", {"trained": trained, "budget": budget})
+    console.log(
+        f"Pruned {n_pruned} of {len(trials)} trials, trained {trained} of {budget} "
+        f"boosting rounds ({saved:.1%} saved by pruning and early stopping)",
+        justify="center",
+    )
+
+
+def warm_start_study(study: optuna.Study, conf: DictConfig):
+    """Seeds a study with the results of earlier runs, following `conf.warm_start`.
+
+    The best parameters of other runs (e.g. other seeds, or Bloom2013 when tuning Bloom2015)
+    are enqueued as the first trials, and the complete trials of earlier studies are added
+    to the study history so that TPE starts from their posterior instead of from scratch.
+
+    Args:
+        study (optuna.Study): The study to warm start.
+        conf (DictConfig): The configuration object.
+    """
+    warm_start = conf.get("warm_start")
+    if warm_start is None:
+        return None
+
+    n_enqueued = 0
+    if warm_start.run_path is not None:
+        param_paths = get_model_paths(
+            run_path=warm_start.run_path,
+            model_type=f"{study.study_name}_best_params",
+            suffix=warm_start.suffix,
+            prefix=warm_start.prefix,
+            model_names=warm_start.model_names,
+            registry=conf.get("registry"),
+        )
+        n_enqueued = enqueue_params(
+            study, [path for paths in param_paths.values() for path in paths]
+        )
+
+    n_imported = sum(import_trials(study, storage) for storage in warm_start.storages)
+
+    if n_enqueued or n_imported:
+        console.log(
+            f"Warm start: enqueued {n_enqueued} parameter sets, imported {n_imported} trials",
+            justify="center",
+        )
+
+
 def run_study(
     study_name: str,
     tune_objective: Callable,
@@ -184,6 +434,8 @@ def run_study(
     ytrain,
     Xtest=None,
     ytest=None,
+    storage: Optional[str] = None,
+    n_workers: int = 1,
 ):
     """Runs an Optuna study to optimize hyperparameters for a given model.
 
@@ -196,21 +448,35 @@ def run_study(
         ytrain: The training target variable.
         Xtest (optional): The test features. Defaults to None.
         ytest (optional): The test target variable. Defaults to None.
+        storage (str, optional): Database URL or journal file to keep the study in. An
+            existing study is resumed. Defaults to None (in memory).
+        n_workers (int, optional): Number of processes running trials. Defaults to 1.
 
     Returns:
         optuna.study.Study: The study object.
     """
-    pruner = optuna.pruners.HyperbandPruner()
+    # Resources are the rounds of all the folds (see `FoldProgress`). No trial is pruned
+    # before it trained the rounds early stopping needs in every fold
+    n_splits = conf.kfold_params.n_splits
+    pruner = optuna.pruners.HyperbandPruner(
+        min_resource=conf.model_params.early_stopping_rounds * n_splits,
+        max_resource=n_splits * conf.model_params.n_estimators.high,
+    )
     sampler = optuna.samplers.TPESampler()
-    study = optuna.create_study(
+    study = create_study(
         study_name=study_name,
+        storage=storage,
         direction="maximize",
         pruner=pruner,
         sampler=sampler,
     )
-    study.optimize(
+    warm_start_study(study, conf)
+    optimize_study(
+        study,
         lambda trial: tune_objective(trial, Xtrain, ytrain, conf, Xtest, ytest),
         n_trials=conf.n_trials,
+        storage=storage,
+        n_workers=n_workers,
         # catch=(ValueError)
     )
 
@@ -247,7 +513,13 @@ def main(conf: DictConfig):
 
     verify_path(conf.data.savedir)
 
-    Xtrain, ytrain = get_data(conf.data.path, run_type=conf.run_type, return_as_Xy=True)
+    Xtrain, ytrain = get_data(
+        conf.data.path,
+        run_type=conf.run_type,
+        return_as_Xy=True,
+        **conf.data_cache,
+        **conf.data_loading,
+    )
 
     # If no separate test set is given
     if conf.testing.test_dataset is None:
@@ -258,14 +530,18 @@ def main(conf: DictConfig):
             random_state=conf.seed,
         )
 
-        Xtrain = StandardScaler().fit_transform(Xtrain)
-        Xtest = StandardScaler().fit_transform(Xtest)
-
     else:
         Xtest, ytest = get_data(
-            conf.testing.test_dataset, run_type=conf.run_type, return_as_Xy=True
+            conf.testing.test_dataset,
+            run_type=conf.run_type,
+            return_as_Xy=True,
+            **conf.data_cache,
+            **conf.data_loading,
         )
-        Xtest = StandardScaler().fit_transform(Xtest)  # type: ignore
+
+    # Test data is scaled like the training data, the scaler is saved with the model
+    scaler = fit_scaler(Xtrain) if conf.scale_features else None
+    Xtrain, Xtest = apply_scaler(Xtrain, scaler), apply_scaler(Xtest, scaler)
 
     console.log("Data processed", style="bold green", justify="center")
 
@@ -285,6 +561,13 @@ def main(conf: DictConfig):
 
         with open(conf.data.savedir + savename, "wb") as f:
             pickle.dump(model, f)
+        register_model(
+            conf.get("registry"),
+            conf.data.savedir + savename,
+            savename=conf.data.savename,
+            seed=conf.seed,
+            run_type=conf.run_type,
+        )
 
         console.save_html(conf.data.savedir + f"/{savename}_run_report.html")
 
@@ -303,24 +586,48 @@ def main(conf: DictConfig):
     # Boosting
     boost_study = run_study(
         study_name=study_name,
-        tune_objective=tune_LGBM,
+        tune_objective=partial(
+            tune_LGBM, fold_datasets=FoldDatasets(Xtrain, ytrain, conf)
+        ),
         conf=conf,
         Xtrain=Xtrain,
         ytrain=ytrain,
         Xtest=Xtest,
         ytest=ytest,
+        **conf.study,
     )
+    log_pruning_summary(boost_study, conf.kfold_params.n_splits)
 
-    best_params = boost_study.best_trial.params
+    best_params = get_best_trial(boost_study).params
     with open(conf.data.savedir + f"/{study_name}_best_params.pkl", "wb") as f:
         pickle.dump(best_params, f)
+    register_model(
+        conf.get("registry"),
+        conf.data.savedir + f"/{study_name}_best_params.pkl",
+        savename=conf.data.savename,
+        seed=conf.seed,
+        run_type=conf.run_type,
+    )
 
     console.print(f"Best parameters: {best_params}", justify="center")
 
     model = train_booster(conf, best_params, Xtrain, ytrain, Xtest, ytest)
 
-    with open(conf.data.savedir + f"/{study_name}.pkl", "wb") as f:
-        pickle.dump(model, f)
+    ModelBundle.save(
+        conf.data.savedir + f"/{study_name}.bundle",
+        model,
+        scaler,
+        run_type=conf.run_type,
+        data_hash=get_file_hash(conf.data.path),
+        feature_names=get_feature_names(conf.data.path, conf.run_type),
+    )
+    register_model(
+        conf.get("registry"),
+        conf.data.savedir + f"/{study_name}.bundle",
+        savename=conf.data.savename,
+        seed=conf.seed,
+        run_type=conf.run_type,
+    )
 
     console.log("Tuning Done", style="bold green", justify="center")
 
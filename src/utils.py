@@ -1,124 +1,1967 @@
 # utility functions
 
+import hashlib
+import json
+import multiprocessing
+import os
+import hydra
 import lightgbm as lgb
+import numpy as np
+import optuna
 import polars as pl
 import polars.selectors as cs
 import pickle
+import shutil
+import sqlite3
+from contextlib import closing
+from functools import cached_property, lru_cache
+from numbers import Integral
 from pathlib import Path
-from typing import Dict, List, Union, Tuple, Any
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Union, Tuple, Any
+from joblib import Parallel, delayed
 from numpy import ndarray
+from omegaconf import DictConfig
+from sklearn.base import clone
+from sklearn.model_selection import KFold
+from sklearn.preprocessing import StandardScaler
+from warnings import warn
 
+from scipy.spatial.distance import pdist, squareform
 from scipy.stats import pearsonr, spearmanr
 
 
 # Getting stuff
+def get_file_hash(file_path: Union[Path, str]) -> str:
+    """Returns the SHA-256 digest of a file's contents.
+
+    The digest is memoised per (path, size, modification time), so hashing the same
+    unchanged file twice in one process only reads it once. For a directory (e.g. a
+    factorized dataset) the digest covers the names and contents of the files in it.
+
+    Parameters
+    ----------
+    file_path : Union[Path, str]
+        Path to the file.
+
+    Returns
+    -------
+    str
+        The hex digest of the file.
+    """
+    file_path = Path(file_path).resolve()
+    if file_path.is_dir():
+        digest = hashlib.sha256()
+        for file in sorted(f for f in file_path.rglob("*") if f.is_file()):
+            digest.update(str(file.relative_to(file_path)).encode())
+            digest.update(get_file_hash(file).encode())
+        return digest.hexdigest()
+
+    stat = file_path.stat()
+    return _file_hash(str(file_path), stat.st_size, stat.st_mtime_ns)
+
+
+@lru_cache(maxsize=None)
+def _file_hash(file_path: str, size: int, mtime_ns: int) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 24), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def get_file_stamp(file_path: Union[Path, str]) -> str:
+    """Returns a digest of a file's path, size and modification time. Unlike `get_file_hash`
+    it doesn't read the file, so it suits large data files, but touching a file changes it.
+    For a directory it covers every file in it.
+
+    Parameters
+    ----------
+    file_path : Union[Path, str]
+        Path to the file.
+
+    Returns
+    -------
+    str
+        The hex digest of the stamp.
+    """
+    file_path = Path(file_path).resolve()
+    files = (
+        sorted(f for f in file_path.rglob("*") if f.is_file())
+        if file_path.is_dir()
+        else [file_path]
+    )
+    digest = hashlib.sha256()
+    for file in files:
+        stat = file.stat()
+        digest.update(f"{file}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+
+def get_cache_paths(
+    cache_dir: Union[Path, str], data_hash: str, run_type: str, dtype: Any = None
+) -> Tuple[Path, Path]:
+    """Returns the paths of the cached feature matrix and target vector.
+
+    Entries are content-addressed, i.e. keyed by the hash of the data file, the `run_type` and
+    the dtype of the feature matrix.
+
+    Parameters
+    ----------
+    cache_dir : Union[Path, str]
+        Directory containing the cache.
+    data_hash : str
+        Hash of the data file (see `get_file_hash`).
+    run_type : str
+        One of `full`, `geno_only`, `chem_only`
+    dtype : Any, optional
+        dtype of the feature matrix. None means the dtype the data is stored in.
+
+    Returns
+    -------
+    Tuple[Path, Path]
+        Paths to the `.npy` files of the features and the target.
+    """
+    dtype_name = "native" if dtype is None else np.dtype(dtype).name
+    key = f"{data_hash[:16]}_{run_type}_{dtype_name}"
+    cache_dir = Path(cache_dir)
+    return cache_dir / f"{key}_X.npy", cache_dir / f"{key}_y.npy"
+
+
+def evict_cache(cache_dir: Union[Path, str], max_size_gb: float) -> None:
+    """Deletes the least recently used entries of the feature cache until it fits in
+    `max_size_gb`.
+
+    Parameters
+    ----------
+    cache_dir : Union[Path, str]
+        Directory containing the cache.
+    max_size_gb : float
+        Maximum size of the cache in gigabytes.
+    """
+    cache_entries: Dict[str, List[Path]] = {}
+    for file in Path(cache_dir).glob("*_[Xy].npy"):
+        cache_entries.setdefault(file.name[: -len("_X.npy")], []).append(file)
+
+    # Least recently used first. Hits touch the files, so mtime is the last access.
+    entries = sorted(
+        cache_entries.values(), key=lambda files: max(f.stat().st_mtime for f in files)
+    )
+    total_size = sum(f.stat().st_size for files in entries for f in files)
+    max_size = max_size_gb * 1024**3
+
+    for files in entries:
+        if total_size <= max_size:
+            break
+        for file in files:
+            total_size -= file.stat().st_size
+            file.unlink(missing_ok=True)
+
+
+def _get_format(data_path: Union[Path, str]) -> str:
+    if isinstance(data_path, Path):
+        return data_path.suffix.lstrip(".")
+    elif isinstance(data_path, str):
+        return data_path.split(".")[-1]
+    else:
+        raise ValueError(
+            f"path must be either Path or str but it is of type {type(data_path)}"
+        )
+
+
+def _feature_selectors(run_type: str) -> list:
+    # Genotype columns are based on yeast systemic names, chemical information is in the
+    # latent columns # TODO: Hardcoded for now. But should be flexible
+    match run_type:
+        case "geno_only":
+            return [cs.starts_with("Y")]
+        case "chem_only":
+            return [cs.contains("latent")]
+        case "full":
+            return [cs.starts_with("Y"), cs.contains("latent")]
+        case _:
+            raise ValueError(
+                "Invalid run_type. Must be one of ['geno_only', 'chem_only', 'full']"
+            )
+
+
+def scan_data(data_path: Union[Path, str], memory_map: bool = True) -> pl.LazyFrame:
+    """Lazily scans the data from a given path. Nothing is read until the frame is collected, so
+    only the columns (and rows) that are selected before collecting are ever loaded.
+
+    Parameters
+    ----------
+    data_path : Union[Path, str]
+        Path to the data file.
+    memory_map : bool, optional
+        Whether feather files are memory-mapped instead of read. Defaults to True.
+
+    Returns
+    -------
+    pl.LazyFrame
+        The lazy frame over the data.
+    """
+    match _get_format(data_path):
+        case "feather":
+            return pl.scan_ipc(data_path, memory_map=memory_map)
+        case "parquet":
+            return pl.scan_parquet(data_path)
+        case "csv":
+            return pl.scan_csv(data_path)
+        case _:
+            raise NotImplementedError(
+                "File format not supported yet. Most be one of 'feather', 'parquet', 'csv'"
+            )
+
+
+def iter_batches(
+    data_path: Union[Path, str],
+    run_type: str,
+    batch_size: int = 100_000,
+    dtype: Any = np.float32,
+    columns: Sequence[str] = ("Phenotype",),
+) -> Iterator[Tuple[ndarray[Any, Any], pl.DataFrame]]:
+    """Reads the features of a dataset in row batches, projecting only the feature columns of
+    `run_type` (plus `columns`) before anything is read.
+
+    Parameters
+    ----------
+    data_path : Union[Path, str]
+        Path to the data file.
+    run_type : str
+        One of `full`, `geno_only`, `chem_only`
+    batch_size : int, optional
+        Number of rows per batch. Defaults to 100_000.
+    dtype : Any, optional
+        dtype of the features. Defaults to float32.
+    columns : Sequence[str], optional
+        Other columns to return with every batch. Defaults to ("Phenotype",).
+
+    Yields
+    ------
+    Tuple[ndarray, pl.DataFrame]
+        The C-contiguous features of the batch and the requested `columns`.
+    """
+    if is_factorized(data_path):
+        data = FactorizedData.load(data_path)
+        labels = data.labels().select(columns)
+        for X, rows in data.iter_batches(run_type, batch_size, dtype):
+            yield X, labels[rows]
+        return
+
+    lf = scan_data(data_path)
+    features = lf.select(*_feature_selectors(run_type)).columns
+    n_rows = lf.select(pl.len()).collect().item()
+
+    for offset in range(0, n_rows, batch_size):
+        batch = lf.slice(offset, batch_size).select(*features, *columns).collect()
+        X = np.ascontiguousarray(_as_dtype(batch.select(features).to_numpy(), dtype))
+        yield X, batch.select(columns)
+
+
+def _as_dtype(X: ndarray[Any, Any], dtype: Any) -> ndarray[Any, Any]:
+    if dtype is None:
+        return X
+    X_cast = X.astype(dtype, copy=False)
+    if np.issubdtype(X_cast.dtype, np.integer) and not np.array_equal(X_cast, X):
+        raise ValueError(
+            f"The features can't be stored as {np.dtype(dtype).name} without loss. "
+            "Integer dtypes are only meant for the genotype (`geno_only`) features"
+        )
+    return X_cast
+
+
+def _read_Xy(
+    data_path: Union[Path, str], run_type: str, dtype: Any = None
+) -> Tuple[ndarray[Any, Any], ndarray[Any, Any]]:
+    df = get_data(data_path, run_type="full")
+    X = _as_dtype(df.select(*_feature_selectors(run_type)).to_numpy(), dtype)
+    return X, df["Phenotype"].to_numpy()
+
+
+def _scan_Xy(
+    data_path: Union[Path, str],
+    run_type: str,
+    dtype: Any,
+    batch_size: int,
+    out_path: Optional[Path] = None,
+) -> Tuple[ndarray[Any, Any], ndarray[Any, Any]]:
+    # Fills a preallocated array batch by batch, so the full DataFrame never exists
+    lf = scan_data(data_path)
+    n_features = len(lf.select(*_feature_selectors(run_type)).columns)
+    y = lf.select("Phenotype").collect()["Phenotype"].to_numpy()
+
+    shape = (len(y), n_features)
+    if out_path is None:
+        X = np.empty(shape, dtype=dtype)
+    else:
+        X = np.lib.format.open_memmap(out_path, mode="w+", dtype=dtype, shape=shape)
+
+    offset = 0
+    for X_batch, _ in iter_batches(data_path, run_type, batch_size, dtype, columns=()):
+        X[offset : offset + len(X_batch)] = X_batch
+        offset += len(X_batch)
+
+    return X, y
+
+
+def _cached_Xy(
+    data_path: Union[Path, str],
+    run_type: str,
+    dtype: Any,
+    cache_dir: Union[Path, str],
+    cache_max_size_gb: Optional[float],
+    memory_map: bool,
+    batch_size: int,
+) -> Tuple[ndarray[Any, Any], ndarray[Any, Any]]:
+    X_path, y_path = get_cache_paths(
+        cache_dir, get_file_hash(data_path), run_type, dtype
+    )
+
+    if not (X_path.exists() and y_path.exists()):
+        X_path.parent.mkdir(parents=True, exist_ok=True)
+        X_tmp_path, y_tmp_path = (
+            path.with_suffix(f".{os.getpid()}.tmp") for path in (X_path, y_path)
+        )
+
+        if memory_map:  # Batches are written straight into the cache file
+            X, y = _scan_Xy(data_path, run_type, dtype, batch_size, X_tmp_path)
+            X.flush()
+            del X
+        else:
+            X, y = _read_Xy(data_path, run_type, dtype)
+            with open(X_tmp_path, "wb") as f:
+                np.save(f, X)
+        with open(y_tmp_path, "wb") as f:
+            np.save(f, y)
+
+        # Atomic, concurrent runs never see half a file
+        os.replace(X_tmp_path, X_path)
+        os.replace(y_tmp_path, y_path)
+
+        if cache_max_size_gb is not None:
+            evict_cache(cache_dir, cache_max_size_gb)
+
+        if not memory_map:
+            return X, y
+
+    X_path.touch()  # Mark as recently used
+    y_path.touch()
+
+    return np.load(X_path, mmap_mode="r"), np.load(y_path, mmap_mode="r")
+
+
 def get_data(
-    data_path: Union[Path, str], run_type: str, return_as_Xy: bool = False
+    data_path: Union[Path, str],
+    run_type: str,
+    return_as_Xy: bool = False,
+    dtype: Any = None,
+    cache_dir: Optional[Union[Path, str]] = None,
+    cache_max_size_gb: Optional[float] = None,
+    memory_map: bool = False,
+    batch_size: int = 100_000,
 ) -> Union[pl.DataFrame, Tuple[ndarray[Any, Any], ndarray[Any, Any]]]:
     """Loads the data from a given path and returns it as a DataFrame.
 
     Parameters
     ----------
-    data_path : Union[Path, str]
-        Path to the data file.
+    data_path : Union[Path, str]
+        Path to the data file, or to a factorized dataset directory (see `FactorizedData`),
+        whose feature rows are assembled from the strain and condition tables.
+
+    run_type: str
+        One of `full`, `geno_only`, `chem_only`
+
+    return_as_Xy: bool
+        If you want the data to be returned as [Features, Observations]
+
+    dtype: Any, optional
+        dtype of the features when `return_as_Xy` is True. Defaults to the stored dtype, or
+        float32 when `memory_map` is True. `int8` keeps biallelic `geno_only` markers compact
+        (8x smaller than float64); a ValueError is raised if the cast would lose information.
+
+    cache_dir: Union[Path, str], optional
+        Directory of the on-disk feature cache. When given, [Features, Observations] are
+        saved there on the first call and memory-mapped (read-only) on later calls with the
+        same data file, `run_type` and `dtype`. Defaults to None (no caching).
+
+    cache_max_size_gb: float, optional
+        Size limit of the cache. Least recently used entries are evicted beyond it.
+
+    memory_map: bool
+        Only used when `return_as_Xy` is True. Scans the file lazily (memory-mapped for
+        feather), reads only the needed feature columns and copies them batch by batch into
+        one C-contiguous array, so the full DataFrame is never materialised. Peak memory is
+        the size of the returned array plus one batch.
+
+    batch_size: int
+        Number of rows read at a time when `memory_map` is True.
+
+    Returns
+    -------
+    Union[pl.DataFrame, Tuple[pl.DataFrame, pl.DataFrame]]
+        The loaded data as a DataFrame.
+    """
+
+    if is_factorized(data_path):
+        data = FactorizedData.load(data_path)
+        if not return_as_Xy:
+            return data.to_frame(run_type)
+        return data.assemble(
+            run_type, dtype=np.float32 if dtype is None else dtype
+        ), data.phenotype
+
+    if return_as_Xy:
+        if memory_map and dtype is None:
+            dtype = np.float32
+
+        if cache_dir is not None:
+            return _cached_Xy(
+                data_path,
+                run_type,
+                dtype,
+                cache_dir,
+                cache_max_size_gb,
+                memory_map,
+                batch_size,
+            )
+        if memory_map:
+            return _scan_Xy(data_path, run_type, dtype, batch_size)
+        return _read_Xy(data_path, run_type, dtype)
+
+    match _get_format(data_path):
+        case "feather":
+            df = pl.read_ipc(data_path)
+        case "parquet":
+            df = pl.read_parquet(data_path)
+        case "csv":
+            df = pl.read_csv(data_path)
+        case _:
+            raise NotImplementedError(
+                "File format not supported yet. Most be one of 'feather', 'parquet', 'csv'"
+            )
+
+    match run_type:
+        case "geno_only" | "chem_only":
+            df = df.select(
+                pl.col("Strain"),
+                *_feature_selectors(run_type),
+                pl.col("Condition"),
+                pl.col("Phenotype"),
+            )
+            return df
+        case "full":
+            return df
+        case _:
+            raise ValueError(
+                "Invalid run_type. Must be one of ['geno_only', 'chem_only', 'full']"
+            )
+
+
+def get_feature_names(data_path: Union[Path, str], run_type: str) -> List[str]:
+    """Returns the names of the features `get_data(..., return_as_Xy=True)` returns, in order,
+    without reading the data.
+
+    Parameters
+    ----------
+    data_path : Union[Path, str]
+        Path to the data file.
+    run_type : str
+        One of `full`, `geno_only`, `chem_only`
+
+    Returns
+    -------
+    List[str]
+        The feature names.
+    """
+    if is_factorized(data_path):
+        return FactorizedData.load(data_path).feature_names(run_type)
+    return scan_data(data_path).select(*_feature_selectors(run_type)).columns
+
+
+def get_labels(
+    data_path: Union[Path, str], columns: Sequence[str] = ("Condition",)
+) -> pl.DataFrame:
+    """Returns label columns (Strain, Condition, Phenotype) of every row of a dataset, in the
+    order of `get_data`, without reading the features."""
+    if is_factorized(data_path):
+        return FactorizedData.load(data_path).labels().select(columns)
+    return scan_data(data_path).select(columns).collect()
+
+
+def get_feature_blocks(feature_names: List[str]) -> List[str]:
+    """Returns the block of every feature, `genotype` or `latent` (chemical), named as in
+    `_feature_selectors`."""
+    return ["genotype" if name.startswith("Y") else "latent" for name in feature_names]
+
+
+# Compact genotype stuff
+## The genotype columns are biallelic markers, so they fit in an int8 (or a single bit)
+## instead of a float64. They are expanded to floats only when handed to a model.
+
+
+def compact_genotypes(df: pl.DataFrame) -> pl.DataFrame:
+    """Casts the genotype columns of a DataFrame to Int8 when that is lossless.
+
+    Parameters
+    ----------
+    df : pl.DataFrame
+        DataFrame with genotype columns (e.g. from `get_data`).
+
+    Returns
+    -------
+    pl.DataFrame
+        The DataFrame with Int8 genotype columns, or unchanged (with a warning) if the
+        genotypes aren't small integers.
+    """
+    genotype_cols = df.select(cs.starts_with("Y")).columns
+    if not genotype_cols:
+        return df
+
+    lossless = df.select(
+        (
+            pl.col(genotype_cols).cast(pl.Int8, strict=False).cast(pl.Float64)
+            == pl.col(genotype_cols).cast(pl.Float64)
+        )
+        .fill_null(False)
+        .all()
+    ).row(0)
+
+    if not all(lossless):
+        warn("Genotype columns are not small integers, keeping their original dtype")
+        return df
+
+    return df.with_columns(pl.col(genotype_cols).cast(pl.Int8))
+
+
+def pack_genotypes(genotypes: ndarray) -> Tuple[ndarray, ndarray]:
+    """Bit-packs a biallelic strain x marker genotype matrix, eight markers per byte.
+
+    Parameters
+    ----------
+    genotypes : ndarray
+        Strain x marker matrix with at most two distinct values.
+
+    Returns
+    -------
+    Tuple[ndarray, ndarray]
+        The packed uint8 matrix (one row per strain) and the two allele values. A set bit
+        means the second allele.
+
+    Raises
+    ------
+    ValueError
+        If there are more than two values, or missing (NaN) genotypes, which a bit can't
+        hold.
+    """
+    alleles = np.unique(genotypes)
+    if np.issubdtype(alleles.dtype, np.floating) and np.isnan(alleles).any():
+        raise ValueError("Genotypes with missing values can't be bit-packed")
+    if len(alleles) > 2:
+        raise ValueError(
+            f"Genotypes must be biallelic to be bit-packed, found values {alleles}"
+        )
+    if len(alleles) == 1:
+        alleles = np.repeat(alleles, 2)
+
+    return np.packbits(genotypes == alleles[1], axis=1), alleles
+
+
+def unpack_genotypes(
+    packed: ndarray, alleles: ndarray, n_markers: int, dtype: Any = np.int8
+) -> ndarray:
+    """Inverse of `pack_genotypes`.
+
+    Parameters
+    ----------
+    packed : ndarray
+        Bit-packed genotypes from `pack_genotypes`.
+    alleles : ndarray
+        The two allele values from `pack_genotypes`.
+    n_markers : int
+        Number of markers (the packed rows are padded to a multiple of 8).
+    dtype : Any, optional
+        dtype of the returned matrix. Defaults to int8.
+
+    Returns
+    -------
+    ndarray
+        The strain x marker genotype matrix.
+    """
+    bits = np.unpackbits(packed, axis=1, count=n_markers)
+    return alleles.astype(dtype)[bits]
+
+
+def get_genotype_matrix(
+    data_path: Union[Path, str],
+) -> Tuple[List[str], List[str], ndarray]:
+    """Reads the genotypes of every strain once from a (Strain, Condition) long table.
+
+    Parameters
+    ----------
+    data_path : Union[Path, str]
+        Path to the data file.
+
+    Returns
+    -------
+    Tuple[List[str], List[str], ndarray]
+        The strains, the marker names and the strain x marker genotype matrix (int8 when
+        lossless, see `compact_genotypes`).
+    """
+    strain_df = compact_genotypes(
+        scan_data(data_path)
+        .select(pl.col("Strain"), cs.starts_with("Y"))
+        .unique("Strain", maintain_order=True)
+        .collect()
+    )
+    genotypes = strain_df.drop("Strain")
+    return strain_df["Strain"].to_list(), genotypes.columns, genotypes.to_numpy()
+
+
+def save_genotypes(
+    path: Union[Path, str],
+    strains: List[str],
+    markers: List[str],
+    genotypes: ndarray,
+) -> None:
+    """Saves a strain x marker genotype matrix bit-packed to an `.npz` file.
+
+    Parameters
+    ----------
+    path : Union[Path, str]
+        Path of the `.npz` file.
+    strains : List[str]
+        Strain of each row.
+    markers : List[str]
+        Marker of each column.
+    genotypes : ndarray
+        The biallelic strain x marker genotype matrix.
+    """
+    packed, alleles = pack_genotypes(genotypes)
+    np.savez(
+        path,
+        strains=np.asarray(strains),
+        markers=np.asarray(markers),
+        packed=packed,
+        alleles=alleles,
+    )
+
+
+def load_genotypes(
+    path: Union[Path, str], dtype: Any = np.int8
+) -> Tuple[List[str], List[str], ndarray]:
+    """Loads a genotype matrix saved by `save_genotypes`.
+
+    Parameters
+    ----------
+    path : Union[Path, str]
+        Path of the `.npz` file.
+    dtype : Any, optional
+        dtype of the returned matrix. Defaults to int8.
+
+    Returns
+    -------
+    Tuple[List[str], List[str], ndarray]
+        The strains, the marker names and the strain x marker genotype matrix.
+    """
+    with np.load(path) as f:
+        markers = f["markers"].tolist()
+        genotypes = unpack_genotypes(f["packed"], f["alleles"], len(markers), dtype)
+        return f["strains"].tolist(), markers, genotypes
+
+
+def _popcount(words: ndarray) -> ndarray:
+    """Number of set bits of every uint64, with the bit tricks of a SWAR popcount."""
+    words = words - ((words >> np.uint64(1)) & np.uint64(0x5555555555555555))
+    words = (words & np.uint64(0x3333333333333333)) + (
+        (words >> np.uint64(2)) & np.uint64(0x3333333333333333)
+    )
+    words = (words + (words >> np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    return (words * np.uint64(0x0101010101010101)) >> np.uint64(56)
+
+
+def hamming_distances(packed: ndarray, block_size: int = 1 << 22) -> ndarray:
+    """Pairwise Hamming distances between the rows of a bit-packed matrix (see
+    `pack_genotypes`), i.e. the number of markers at which two strains differ.
+
+    The rows are compared 64 markers at a time, XOR-ing uint64 words and counting the set
+    bits, block by block of rows so that at most `block_size` words are in flight.
+
+    Parameters
+    ----------
+    packed : ndarray
+        The packed uint8 matrix, one row per strain.
+    block_size : int, optional
+        Number of uint64 words compared at a time. Defaults to 1 << 22.
+
+    Returns
+    -------
+    ndarray
+        The symmetric strain x strain uint32 distance matrix.
+    """
+    n_strains, n_bytes = packed.shape
+    n_words = -(-n_bytes // 8)
+    words = np.zeros((n_strains, n_words * 8), dtype=np.uint8)
+    words[:, :n_bytes] = packed  # Padded with zeros, which never differ
+    words = words.view(np.uint64)
+
+    distances = np.zeros((n_strains, n_strains), dtype=np.uint32)
+    rows = max(1, block_size // max(n_strains * n_words, 1))
+    for start in range(0, n_strains, rows):
+        block = words[start : start + rows]
+        # Only the pairs on and above the diagonal, the others are mirrored
+        diffs = _popcount(block[:, None, :] ^ words[None, start:, :]).sum(
+            axis=2, dtype=np.uint32
+        )
+        distances[start : start + rows, start:] = diffs
+        distances[start:, start : start + rows] = diffs.T
+
+    return distances
+
+
+def get_strain_distances(
+    strains: List[str],
+    genotypes: ndarray,
+    cache_dir: Optional[Union[Path, str]] = None,
+) -> ndarray:
+    """Hamming distances between the genotypes of every pair of strains (see
+    `hamming_distances`), cached on disk.
+
+    For biallelic markers the Hamming distance ranks strain pairs like the cityblock
+    distance, and is computed on the bit-packed genotypes. Other genotypes (e.g. imputed,
+    or with missing values) get the dense cityblock distances, with a warning.
+
+    Parameters
+    ----------
+    strains : List[str]
+        The strains, one per row of `genotypes`.
+    genotypes : ndarray
+        Strain x marker genotype matrix, one row per unique strain.
+    cache_dir : Optional[Union[Path, str]], optional
+        Directory where the distances are saved, keyed by the hash of the strains and their
+        genotypes, and memory-mapped from on later calls. Defaults to None (no caching).
+
+    Returns
+    -------
+    ndarray
+        The strain x strain distance matrix, in the order of `strains`.
+    """
+    try:
+        packed, alleles = pack_genotypes(genotypes)
+        name, arrays = "strain_distances", (packed, alleles)
+
+        def _distances() -> ndarray:
+            return hamming_distances(packed)
+
+    except ValueError as error:
+        warn(f"{error}, computing the dense cityblock distances instead")
+        name, arrays = "strain_distances_dense", (genotypes,)
+
+        def _distances() -> ndarray:
+            return squareform(pdist(genotypes, metric="cityblock"))
+
+    if cache_dir is None:
+        return _distances()
+
+    digest = hashlib.sha256()
+    digest.update("\0".join(strains).encode())
+    for array in arrays:
+        digest.update(np.ascontiguousarray(array).tobytes())
+    cache_path = Path(cache_dir) / f"{name}_{digest.hexdigest()[:16]}.npy"
+
+    if not cache_path.exists():
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = cache_path.with_name(f".{cache_path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, "wb") as f:
+            np.save(f, _distances())
+        tmp_path.replace(cache_path)
+
+    return np.load(cache_path, mmap_mode="r")
+
+
+class FeatureSequence(lgb.Sequence):
+    """Rows of a feature matrix assembled on the fly from compact per-entity tables.
+
+    Each table holds the features of one entity (e.g. the strain x marker genotype matrix)
+    and each index maps the rows of the dataset to a row of its table. Rows are expanded to
+    float32 batch by batch, so LightGBM can build a `Dataset` without the dense matrix ever
+    existing.
+
+    Parameters
+    ----------
+    tables : List[ndarray]
+        Per-entity feature tables. Their columns are concatenated in this order.
+    indices : List[ndarray]
+        Table row of every dataset row, one index array per table.
+    batch_size : int, optional
+        Rows LightGBM reads at a time. Defaults to 4096.
+    dtype : Any, optional
+        dtype of the assembled rows. Defaults to float32.
+    """
+
+    def __init__(
+        self,
+        tables: List[ndarray],
+        indices: List[ndarray],
+        batch_size: int = 4096,
+        dtype: Any = np.float32,
+    ):
+        assert len(tables) == len(indices) > 0, "Need one index array per table"
+        assert (
+            len({len(index) for index in indices}) == 1
+        ), "Index arrays must have the same length"
+
+        self.tables = tables
+        self.indices = indices
+        self.batch_size = batch_size
+        self.dtype = dtype
+
+    def __len__(self) -> int:
+        return len(self.indices[0])
+
+    def __getitem__(self, idx) -> ndarray:
+        # LightGBM samples single rows to find the bin boundaries and needs those as doubles
+        dtype = np.float64 if isinstance(idx, Integral) else self.dtype
+        return np.concatenate(
+            [table[index[idx]] for table, index in zip(self.tables, self.indices)],
+            axis=-1,
+            dtype=dtype,
+        )
+
+
+def _entity_index(keys: pl.Series, entities: List[str]) -> ndarray:
+    return keys.replace(
+        entities, np.arange(len(entities)), default=None, return_dtype=pl.Int32
+    ).to_numpy()
+
+
+def get_lgb_dataset(
+    data_path: Union[Path, str], run_type: str, batch_size: int = 4096, **dataset_kwargs
+) -> lgb.Dataset:
+    """Builds a LightGBM Dataset straight from the compact genotype matrix (and the per-condition
+    chemical features), without materialising the dense feature matrix.
+
+    Parameters
+    ----------
+    data_path : Union[Path, str]
+        Path to the data file, or to a factorized dataset (see `FactorizedData`).
+    run_type : str
+        One of `full`, `geno_only`, `chem_only`
+    batch_size : int, optional
+        Rows LightGBM reads at a time. Defaults to 4096.
+    **dataset_kwargs
+        Passed to `lgb.Dataset`, e.g. `params` or `free_raw_data`.
+
+    Returns
+    -------
+    lgb.Dataset
+        The dataset, with the same features (in the same order) as `get_data`.
+    """
+    return load_factorized(data_path).lgb_dataset(
+        run_type, batch_size=batch_size, **dataset_kwargs
+    )
+
+
+# Factorized data stuff
+## The long tables repeat the genotype of a strain for every condition and the chemical
+## features of a condition for every strain. A factorized dataset stores each of them once
+## (a strain table and a condition table) plus a thin (strain_id, condition_id, Phenotype)
+## fact table, and assembles feature rows when they are needed.
+
+
+class FactorizedData:
+    """A Strain x Condition dataset stored as a strain table, a condition table and a fact
+    table.
+
+    On disk it is a directory with `genotypes.npz` (bit-packed, see `save_genotypes`),
+    `conditions.feather` (Condition and latent columns) and `facts.feather` (strain_id,
+    condition_id, Phenotype). `get_data` and friends accept such a directory wherever they
+    accept a data file.
+
+    Parameters
+    ----------
+    strains : List[str]
+        The strains, one per row of `genotypes`.
+    markers : List[str]
+        The genotype marker names.
+    genotypes : ndarray
+        Strain x marker genotype matrix.
+    condition_df : pl.DataFrame
+        One row per condition with the `Condition` and the latent chemical columns.
+    strain_index : ndarray
+        Row of `genotypes` for every observation.
+    condition_index : ndarray
+        Row of `condition_df` for every observation.
+    phenotype : ndarray
+        Phenotype of every observation.
+    """
+
+    def __init__(
+        self,
+        strains: List[str],
+        markers: List[str],
+        genotypes: ndarray,
+        condition_df: pl.DataFrame,
+        strain_index: ndarray,
+        condition_index: ndarray,
+        phenotype: ndarray,
+    ):
+        self.strains = strains
+        self.markers = markers
+        self.genotypes = genotypes
+        self.conditions = condition_df["Condition"].to_list()
+        self.chemical_names = condition_df.drop("Condition").columns
+        self.chemicals = condition_df.drop("Condition").to_numpy().astype(np.float32)
+        self.strain_index = strain_index
+        self.condition_index = condition_index
+        self.phenotype = phenotype
+
+    @classmethod
+    def load(cls, data_dir: Union[Path, str]) -> "FactorizedData":
+        """Loads a factorized dataset saved with `save`."""
+        data_dir = Path(data_dir)
+        strains, markers, genotypes = load_genotypes(data_dir / "genotypes.npz")
+        facts = pl.read_ipc(data_dir / "facts.feather")
+
+        return cls(
+            strains,
+            markers,
+            genotypes,
+            pl.read_ipc(data_dir / "conditions.feather"),
+            facts["strain_id"].to_numpy(),
+            facts["condition_id"].to_numpy(),
+            facts["Phenotype"].to_numpy(),
+        )
+
+    @classmethod
+    def from_table(cls, data_path: Union[Path, str]) -> "FactorizedData":
+        """Factorizes a (Strain, Condition) long table.
+
+        Raises a ValueError if a strain doesn't have the same genotype in every condition.
+        """
+        lf = scan_data(data_path)
+        strains, markers, genotypes = get_genotype_matrix(data_path)
+
+        n_genotypes = (
+            lf.select(pl.col("Strain"), cs.starts_with("Y")).unique().select(pl.len())
+        )
+        if n_genotypes.collect().item() != len(strains):
+            raise ValueError(
+                "Some strains have different genotypes across conditions, "
+                "the data can't be factorized"
+            )
+
+        condition_df = (
+            lf.select(pl.col("Condition"), cs.contains("latent"))
+            .unique("Condition", maintain_order=True)
+            .collect()
+        )
+        labels = lf.select("Strain", "Condition", "Phenotype").collect()
+
+        return cls(
+            strains,
+            markers,
+            genotypes,
+            condition_df,
+            _entity_index(labels["Strain"], strains),
+            _entity_index(labels["Condition"], condition_df["Condition"].to_list()),
+            labels["Phenotype"].to_numpy(),
+        )
+
+    def save(self, data_dir: Union[Path, str]) -> Path:
+        """Saves the dataset to `data_dir` (see the class docstring for the layout)."""
+        data_dir = Path(data_dir)
+        data_dir.mkdir(parents=True, exist_ok=True)
+
+        save_genotypes(
+            data_dir / "genotypes.npz", self.strains, self.markers, self.genotypes
+        )
+        pl.DataFrame({"Condition": self.conditions}).hstack(
+            pl.DataFrame(self.chemicals, schema=self.chemical_names)
+        ).write_ipc(data_dir / "conditions.feather")
+        pl.DataFrame(
+            {
+                "strain_id": self.strain_index,
+                "condition_id": self.condition_index,
+                "Phenotype": self.phenotype,
+            }
+        ).write_ipc(data_dir / "facts.feather")
+
+        return data_dir
+
+    def __len__(self) -> int:
+        return len(self.phenotype)
+
+    def feature_names(self, run_type: str) -> List[str]:
+        """The feature names of `run_type`, in the same order as `get_data`."""
+        return [name for _, _, names in self._tables(run_type) for name in names]
+
+    def _tables(self, run_type: str) -> List[Tuple[ndarray, ndarray, List[str]]]:
+        # (table, index into the table for every observation, feature names)
+        _feature_selectors(run_type)  # Validate run_type
+        tables = []
+        if run_type != "chem_only":
+            tables.append((self.genotypes, self.strain_index, self.markers))
+        if run_type != "geno_only":
+            tables.append((self.chemicals, self.condition_index, self.chemical_names))
+        return tables
+
+    def _sequence(self, run_type: str, **kwargs) -> FeatureSequence:
+        tables, indices, _ = zip(*self._tables(run_type))
+        return FeatureSequence(list(tables), list(indices), **kwargs)
+
+    def assemble(
+        self, run_type: str, rows: Union[ndarray, slice] = slice(None), dtype=np.float32
+    ) -> ndarray:
+        """Assembles the feature rows `rows` (all by default) of `run_type`."""
+        return self._sequence(run_type, dtype=dtype)[rows]
+
+    def iter_batches(
+        self, run_type: str, batch_size: int = 100_000, dtype: Any = np.float32
+    ) -> Iterator[Tuple[ndarray, slice]]:
+        """Yields the assembled features of `run_type` batch by batch, with the rows they
+        belong to."""
+        for offset in range(0, len(self), batch_size):
+            rows = slice(offset, offset + batch_size)
+            yield self.assemble(run_type, rows, dtype), rows
+
+    def labels(self) -> pl.DataFrame:
+        """The Strain, Condition and Phenotype of every observation."""
+        return pl.DataFrame(
+            {
+                "Strain": np.asarray(self.strains)[self.strain_index],
+                "Condition": np.asarray(self.conditions)[self.condition_index],
+                "Phenotype": self.phenotype,
+            }
+        )
+
+    def to_frame(self, run_type: str) -> pl.DataFrame:
+        """The dataset as a long table, like `get_data(..., return_as_Xy=False)`."""
+        labels = self.labels()
+        features = [
+            pl.DataFrame(table[index], schema=names)  # Genotypes stay int8
+            for table, index, names in self._tables(run_type)
+        ]
+        return pl.concat(
+            [
+                labels.select("Strain"),
+                *features,
+                labels.select("Condition", "Phenotype"),
+            ],
+            how="horizontal",
+        )
+
+    def lgb_dataset(
+        self, run_type: str, batch_size: int = 4096, **dataset_kwargs
+    ) -> lgb.Dataset:
+        """A LightGBM Dataset whose rows are assembled batch by batch, see `FeatureSequence`."""
+        return lgb.Dataset(
+            [self._sequence(run_type, batch_size=batch_size)],
+            label=self.phenotype,
+            feature_name=self.feature_names(run_type),
+            **dataset_kwargs,
+        )
+
+
+def is_factorized(data_path: Union[Path, str]) -> bool:
+    """Whether `data_path` is a factorized dataset directory (see `FactorizedData`)."""
+    return (Path(data_path) / "facts.feather").exists()
+
+
+def load_factorized(data_path: Union[Path, str]) -> FactorizedData:
+    """Loads a factorized dataset, factorizing `data_path` in memory if it is a long table."""
+    if is_factorized(data_path):
+        return FactorizedData.load(data_path)
+    return FactorizedData.from_table(data_path)
+
+
+# Scaler stuff
+## A scaler is the (mean, scale) of every feature, or None for features that are not scaled
+
+
+def get_scaler_path(model_path: Union[Path, str]) -> Path:
+    """Returns the path of the scaler saved next to a model, e.g. Boosting_scaler.npz for
+    Boosting.pkl, or in it for a bundle (see `ModelBundle`)."""
+    model_path = Path(model_path)
+    if model_path.suffix == ".bundle":
+        return model_path / "scaler.npz"
+    return model_path.with_name(f"{model_path.stem}_scaler.npz")
+
+
+def get_model_hash(model_path: Union[Path, str]) -> str:
+    """Returns the SHA-256 digest of a model and of the scaler saved with it, if any (see
+    `get_file_hash`). A bundle covers its scaler already."""
+    model_path = Path(model_path)
+    scaler_path = get_scaler_path(model_path)
+    if model_path.suffix == ".bundle" or not scaler_path.exists():
+        return get_file_hash(model_path)
+
+    digest = hashlib.sha256()
+    digest.update(get_file_hash(model_path).encode())
+    digest.update(get_file_hash(scaler_path).encode())
+    return digest.hexdigest()
+
+
+def fit_scaler(
+    X: ndarray, batch_size: int = 100_000
+) -> Tuple[ndarray[Any, Any], ndarray[Any, Any]]:
+    """Computes the mean and standard deviation of every feature, as `StandardScaler`.
+
+    The statistics are computed on blocks of rows in float64 and merged, so `X` can be int8
+    or memory-mapped without being converted as a whole.
+
+    Parameters
+    ----------
+    X : ndarray
+        The features.
+    batch_size : int, optional
+        Number of rows summed at a time. Defaults to 100_000.
 
-    run_type: str
-        One of `full`, `geno_only`, `chem_only`
+    Returns
+    -------
+    Tuple[ndarray, ndarray]
+        The float64 mean and scale of every feature, features without variance get a scale
+        of 1.
+    """
+    n_rows, mean, sum_sq = 0, np.zeros(X.shape[1]), np.zeros(X.shape[1])
+    for start in range(0, len(X), batch_size):
+        block = X[start : start + batch_size].astype(np.float64)
+        block_mean = block.mean(axis=0)
+        delta = block_mean - mean
 
-    return_as_Xy: bool
-        If you want the data to be returned as [Features, Observations]
+        # Merge the block statistics (Chan et al.), stable for features with a large mean
+        n_total = n_rows + len(block)
+        mean += delta * len(block) / n_total
+        sum_sq += np.square(block - block_mean).sum(axis=0)
+        sum_sq += np.square(delta) * n_rows * len(block) / n_total
+        n_rows = n_total
+
+    scale = np.sqrt(sum_sq / n_rows)
+    scale[scale < 10 * np.finfo(np.float64).eps] = 1.0  # As StandardScaler
+
+    return mean, scale
+
+
+def apply_scaler(
+    X: ndarray,
+    scaler: Optional[Tuple[ndarray, ndarray]],
+    batch_size: int = 100_000,
+) -> ndarray[Any, Any]:
+    """Standardizes `X` in place with a fitted scaler.
+
+    `X` is converted to float32 first if it isn't a writeable float32 array (e.g. int8
+    genotypes or a read-only memory map), otherwise it is overwritten. Blocks of rows are
+    centred and scaled while they are in the cache.
+
+    Parameters
+    ----------
+    X : ndarray
+        The features.
+    scaler : Optional[Tuple[ndarray, ndarray]]
+        The mean and scale of every feature, None to leave `X` as is.
+    batch_size : int, optional
+        Number of rows scaled at a time. Defaults to 100_000.
 
     Returns
     -------
-    Union[pl.DataFrame, Tuple[pl.DataFrame, pl.DataFrame]]
-        The loaded data as a DataFrame.
+    ndarray
+        The standardized float32 features.
     """
+    if scaler is None:
+        return X
 
-    if isinstance(data_path, Path):
-        format = data_path.suffix
-    elif isinstance(data_path, str):
-        format = data_path.split(".")[-1]
+    if X.dtype != np.float32 or not X.flags.writeable:
+        X = X.astype(np.float32)
+
+    mean, scale = scaler
+    mean, inv_scale = mean.astype(np.float32), (1 / scale).astype(np.float32)
+    for start in range(0, len(X), batch_size):
+        block = X[start : start + batch_size]
+        np.subtract(block, mean, out=block)
+        np.multiply(block, inv_scale, out=block)
+
+    return X
+
+
+def save_scaler(
+    scaler_path: Union[Path, str], scaler: Optional[Tuple[ndarray, ndarray]]
+) -> None:
+    """Saves a scaler (see `fit_scaler`), None records that the model uses unscaled features."""
+    if scaler is None:
+        np.savez(scaler_path, scaled=False)
     else:
-        raise ValueError(
-            f"path must be either Path or str but it is of type {type(data_path)}"
-        )
+        np.savez(scaler_path, scaled=True, mean=scaler[0], scale=scaler[1])
 
-    match format:
-        case "feather":
-            df = pl.read_ipc(data_path)
-        case "parquet":
-            df = pl.read_parquet(data_path)
-        case "csv":
-            df = pl.read_csv(data_path)
-        case _:
-            raise NotImplementedError(
-                "File format not supported yet. Most be one of 'feather', 'parquet', 'csv'"
+
+def load_scaler(scaler_path: Union[Path, str]) -> Optional[Tuple[ndarray, ndarray]]:
+    """Loads a scaler saved with `save_scaler`.
+
+    Raises
+    ------
+    FileNotFoundError
+        If there is no scaler at `scaler_path`, e.g. for models saved before scalers were.
+    """
+    with np.load(scaler_path) as scaler:
+        if not scaler["scaled"]:
+            return None
+        return scaler["mean"], scaler["scale"]
+
+
+def get_model_scaler(
+    model_path: Union[Path, str], X: Optional[ndarray] = None
+) -> Optional[Tuple[ndarray, ndarray]]:
+    """Returns the scaler saved next to a model.
+
+    Models saved without one were evaluated on data standardized with its own statistics, so
+    in that case the scaler is fitted on `X`, the data the model is evaluated on.
+    """
+    scaler_path = get_scaler_path(model_path)
+    if scaler_path.exists():
+        return load_scaler(scaler_path)
+
+    if X is None:
+        raise FileNotFoundError(f"No scaler saved for {model_path}, pass X to fit one.")
+    return fit_scaler(X)
+
+
+def get_scalers(
+    model_paths: List[Path], fit_on_data: Callable[[], Tuple[ndarray, ndarray]]
+) -> List[Optional[Tuple[ndarray, ndarray]]]:
+    """Loads the scalers saved with the models, see `get_model_scaler`.
+
+    Parameters
+    ----------
+    model_paths : List[Path]
+        Paths to the models.
+    fit_on_data : Callable[[], Tuple[ndarray, ndarray]]
+        Fits a scaler on the evaluated data, for the models saved without one. Pass a cached
+        function so that the models share it.
+
+    Returns
+    -------
+    List[Optional[Tuple[ndarray, ndarray]]]
+        The scaler of every model, None for models trained on unscaled features.
+    """
+    return [
+        load_scaler(get_scaler_path(path))
+        if get_scaler_path(path).exists()
+        else fit_on_data()
+        for path in model_paths
+    ]
+
+
+def fit_data_scaler(
+    data_path: Union[Path, str], run_type: str, batch_size: int = 100_000
+) -> Tuple[ndarray, ndarray]:
+    """Fits a scaler on a dataset batch by batch (see `iter_batches`), for the models saved
+    without their training scaler (see `get_scalers`).
+
+    Parameters
+    ----------
+    data_path : Union[Path, str]
+        Path to the data file, or to a factorized dataset.
+    run_type : str
+        One of `full`, `geno_only`, `chem_only`
+    batch_size : int, optional
+        Number of rows per batch. Defaults to 100_000.
+
+    Returns
+    -------
+    Tuple[ndarray, ndarray]
+        The mean and scale of every feature.
+    """
+    scaler = StandardScaler()
+    for X, _ in iter_batches(data_path, run_type, batch_size, columns=()):
+        scaler.partial_fit(X)
+
+    return scaler.mean_, scaler.scale_
+
+
+# Model bundle stuff
+## A bundle is a directory, e.g. Boosting.bundle/, holding the native LightGBM model
+## (model.txt), its scaler (scaler.npz, see `save_scaler`) and meta.json
+
+
+def is_bundle(model_path: Union[Path, str]) -> bool:
+    """Whether `model_path` is a model bundle directory (see `ModelBundle`)."""
+    model_path = Path(model_path)
+    return model_path.suffix == ".bundle" and model_path.is_dir()
+
+
+class ModelBundle:
+    """A model saved as a directory with the native LightGBM model, the scaler of its
+    features and metadata.
+
+    `meta.json` holds the feature names, the run_type and the hash of the training data, it
+    is read without loading the model. The model and the scaler are only loaded when they
+    are first accessed.
+
+    Parameters
+    ----------
+    bundle_dir : Union[Path, str]
+        The bundle directory, e.g. `Boosting.bundle`.
+    """
+
+    def __init__(self, bundle_dir: Union[Path, str]):
+        self.path = Path(bundle_dir)
+
+    @cached_property
+    def meta(self) -> Dict[str, Any]:
+        with open(self.path / "meta.json") as f:
+            return json.load(f)
+
+    @property
+    def feature_names(self) -> List[str]:
+        return self.meta["feature_names"]
+
+    @property
+    def run_type(self) -> str:
+        return self.meta["run_type"]
+
+    @property
+    def data_hash(self) -> Optional[str]:
+        return self.meta["data_hash"]
+
+    @cached_property
+    def model(self) -> lgb.Booster:
+        return lgb.Booster(model_file=self.path / "model.txt")
+
+    @cached_property
+    def scaler(self) -> Optional[Tuple[ndarray, ndarray]]:
+        return load_scaler(get_scaler_path(self.path))
+
+    @classmethod
+    def save(
+        cls,
+        bundle_dir: Union[Path, str],
+        model: lgb.Booster,
+        scaler: Optional[Tuple[ndarray, ndarray]],
+        run_type: str,
+        data_hash: Optional[str] = None,
+        feature_names: Optional[List[str]] = None,
+    ) -> "ModelBundle":
+        """Saves a model as a bundle, replacing any bundle already at `bundle_dir`.
+
+        Parameters
+        ----------
+        bundle_dir : Union[Path, str]
+            The bundle directory, e.g. `Boosting.bundle`.
+        model : lgb.Booster
+            The trained model, saved at its best iteration.
+        scaler : Optional[Tuple[ndarray, ndarray]]
+            The scaler of the training features (see `fit_scaler`), None if they are unscaled.
+        run_type : str
+            One of `full`, `geno_only`, `chem_only`
+        data_hash : Optional[str], optional
+            The hash of the training data (see `get_file_hash`), computed once per run by
+            the caller. Defaults to None.
+        feature_names : Optional[List[str]], optional
+            The feature names, by default the names the model was trained with (see
+            `get_feature_names`, models trained on arrays only know `Column_{i}`).
+
+        Returns
+        -------
+        ModelBundle
+            The saved bundle.
+        """
+        bundle_dir = Path(bundle_dir)
+        meta = {
+            "feature_names": feature_names or model.feature_name(),
+            "run_type": run_type,
+            "data_hash": data_hash,
+            "lightgbm_version": lgb.__version__,
+        }
+
+        # Written next to the bundle and swapped in, readers never see half a bundle
+        tmp_dir = bundle_dir.with_name(f".{bundle_dir.name}.{os.getpid()}.tmp")
+        tmp_dir.mkdir(parents=True)
+        model.save_model(tmp_dir / "model.txt")
+        save_scaler(tmp_dir / "scaler.npz", scaler)
+        with open(tmp_dir / "meta.json", "w") as f:
+            json.dump(meta, f, indent=2)
+
+        if bundle_dir.exists():
+            shutil.rmtree(bundle_dir)
+        tmp_dir.rename(bundle_dir)
+
+        return cls(bundle_dir)
+
+
+# Model registry stuff
+## A SQLite index of the saved models, written when they are saved, so that they are found
+## without scanning run directories (see `get_model_paths`)
+
+REGISTRY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS models (
+    path TEXT PRIMARY KEY,
+    run_root TEXT NOT NULL,
+    run_name TEXT NOT NULL,
+    model_type TEXT NOT NULL,
+    savename TEXT,
+    seed INTEGER,
+    run_type TEXT,
+    meta TEXT NOT NULL DEFAULT '{}'
+);
+CREATE INDEX IF NOT EXISTS models_by_run ON models (run_root, model_type, run_name);
+CREATE INDEX IF NOT EXISTS models_by_key ON models (savename, seed, run_type, model_type);
+"""
+
+
+def _glob_escape(text: str) -> str:
+    """Escapes the wildcards of SQLite's GLOB, which has no escape character."""
+    return "".join(f"[{char}]" if char in "*?[" else char for char in text)
+
+
+class ModelRegistry:
+    """An index of the saved models in a SQLite database.
+
+    A model is a row with the directory of its run, split as `{run_root}/{run_name}` (the
+    layout `get_model_paths` expects), its model type (the file name without its extension,
+    e.g. `Boosting` for `Boosting.bundle` or `Boosting_best_params` for the pickled
+    parameters), the dataset (savename), seed and run_type of the run, and metadata as JSON.
+    Registering a path again replaces its row.
+
+    Lookups are indexed queries that never touch the run directories, so models deleted
+    from disk stay registered until `prune` is called.
+
+    Parameters
+    ----------
+    db_path : Union[Path, str]
+        The database file, created on the first write.
+    """
+
+    def __init__(self, db_path: Union[Path, str]):
+        self.path = Path(db_path)
+
+    def _connect(self) -> sqlite3.Connection:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # Runs of a multirun may register their models at the same time
+        connection = sqlite3.connect(self.path, timeout=60)
+        connection.row_factory = sqlite3.Row
+        connection.executescript(REGISTRY_SCHEMA)
+        return connection
+
+    def register(
+        self,
+        model_path: Union[Path, str],
+        savename: Optional[str] = None,
+        seed: Optional[int] = None,
+        run_type: Optional[str] = None,
+        meta: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        """Adds a saved model to the registry.
+
+        Parameters
+        ----------
+        model_path : Union[Path, str]
+            The model, e.g. `{savedir}/Boosting.bundle`.
+        savename : Optional[str], optional
+            The dataset the model was trained on. Defaults to None.
+        seed : Optional[int], optional
+            The seed of the run. Defaults to None.
+        run_type : Optional[str], optional
+            One of `full`, `geno_only`, `chem_only`. Defaults to None.
+        meta : Optional[Dict[str, Any]], optional
+            Metadata of the model. Defaults to the `meta.json` of a bundle, without the
+            feature names but with their number.
+        """
+        model_path = Path(os.path.abspath(model_path))
+        if meta is None and is_bundle(model_path):
+            bundle_meta = ModelBundle(model_path).meta
+            meta = {
+                key: value
+                for key, value in bundle_meta.items()
+                if key != "feature_names"
+            }
+            meta["n_features"] = len(bundle_meta["feature_names"])
+
+        with closing(self._connect()) as connection, connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO models VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    str(model_path),
+                    str(model_path.parent.parent),
+                    model_path.parent.name,
+                    model_path.stem,
+                    savename,
+                    seed,
+                    run_type,
+                    json.dumps(meta or {}),
+                ),
             )
 
-    if not return_as_Xy:
-        # y = df['Phenotype'].to_numpy()
-
-        match run_type:
-            case "geno_only":
-                df = df.select(
-                    pl.col("Strain"),
-                    cs.starts_with(
-                        "Y"
-                    ),  # Only the genotype columns, based on yeast systemic names # TODO: Hardcoded for now. But should be flexible
-                    pl.col("Condition"),
-                    pl.col("Phenotype"),
-                )
-                return df
-
-            case "chem_only":
-                df = df.select(
-                    pl.col("Strain"),
-                    cs.contains(
-                        "latent"
-                    ),  # Only the chemical information # TODO: Hardcoded for now. But should be flexible
-                    pl.col("Condition"),
-                    pl.col("Phenotype"),
-                )
-                return df
-            case "full":
-                return df
-            case _:
-                raise ValueError(
-                    "Invalid run_type. Must be one of ['geno_only', 'chem_only', 'full']"
-                )
+    def get(self, model_path: Union[Path, str]) -> Optional[Dict[str, Any]]:
+        """Returns the row of a model, None if it isn't registered."""
+        rows = self._select("path = ?", [os.path.abspath(model_path)])
+        return rows[0] if rows else None
 
-    else:
-        y = df["Phenotype"].to_numpy()
-
-        match run_type:
-            case "geno_only":
-                X = df.select(cs.starts_with("Y")).to_numpy()
-                return X, y
-            case "chem_only":
-                X = df.select(cs.contains("latent")).to_numpy()
-                return X, y
-            case "full":
-                X = df.select(cs.starts_with("Y"), cs.contains("latent")).to_numpy()
-                return X, y
-            case _:
-                raise ValueError(
-                    "Invalid run_type. Must be one of ['geno_only', 'chem_only', 'full']"
-                )
+    def find(self, **keys: Any) -> List[Dict[str, Any]]:
+        """Returns the rows of the models matching all the given columns, e.g.
+        `find(savename="Carbons_Bloom2013", seed=42, model_type="Boosting")`."""
+        unknown = keys.keys() - {"savename", "seed", "run_type", "model_type"}
+        if unknown:
+            raise ValueError(f"Unknown registry keys: {sorted(unknown)}")
+        return self._select(
+            " AND ".join(f"{key} = ?" for key in keys) or "1", list(keys.values())
+        )
+
+    def find_paths(
+        self, run_path: Union[Path, str], model_type: str, pattern: str
+    ) -> List[Path]:
+        """Returns the paths of the models of the run directories matching
+        `{run_path}/{pattern}/{model_type}.*`, as `Path.glob` would (`*` is the only
+        wildcard of the pattern)."""
+        pattern = "*".join(_glob_escape(part) for part in pattern.split("*"))
+        rows = self._select(
+            "run_root = ? AND model_type = ? AND run_name GLOB ?",
+            [os.path.abspath(run_path), model_type, pattern],
+        )
+        return [Path(row["path"]) for row in rows]
+
+    def prune(self) -> int:
+        """Unregisters the models that no longer exist and returns how many there were."""
+        missing = [
+            (row["path"],) for row in self.find() if not Path(row["path"]).exists()
+        ]
+        with closing(self._connect()) as connection, connection:
+            connection.executemany("DELETE FROM models WHERE path = ?", missing)
+        return len(missing)
+
+    def _select(self, where: str, params: List[Any]) -> List[Dict[str, Any]]:
+        if not self.path.exists():
+            return []
+        with closing(self._connect()) as connection:
+            rows = connection.execute(
+                f"SELECT * FROM models WHERE {where} ORDER BY run_name, path", params
+            ).fetchall()
+        return [dict(row) | {"meta": json.loads(row["meta"])} for row in rows]
+
+
+def register_model(
+    registry: Optional[Union[Path, str]], model_path: Union[Path, str], **keys: Any
+) -> None:
+    """Registers a saved model (see `ModelRegistry.register`), if there is a registry."""
+    if registry is not None:
+        ModelRegistry(registry).register(model_path, **keys)
+
+
+# Parallel stuff
+def available_cores() -> int:
+    """The number of cores this process may run on: its CPU affinity where the platform
+    has one (e.g. the cores a SLURM job was given), otherwise all the cores of the node."""
+    if hasattr(os, "sched_getaffinity"):
+        return max(len(os.sched_getaffinity(0)), 1)
+    return os.cpu_count() or 1
+
+
+def split_threads(
+    n_jobs: int, n_tasks: int, num_threads: Optional[int] = None
+) -> Tuple[int, int]:
+    """Splits a thread budget between concurrent tasks (e.g. the folds of a KFold split).
+
+    Parameters
+    ----------
+    n_jobs : int
+        Requested number of concurrent tasks, negative values count back from the number of
+        cores (see `available_cores`) as in joblib (-1 uses all of them).
+    n_tasks : int
+        Number of tasks to run, more concurrent tasks than this would sit idle.
+    num_threads : Optional[int], optional
+        Total thread budget, by default (or if not positive) the number of cores.
+
+    Returns
+    -------
+    Tuple[int, int]
+        The number of concurrent tasks and the number of threads each of them can use.
+    """
+    n_cores = available_cores()
+    num_threads = int(num_threads) if num_threads and int(num_threads) > 0 else n_cores
+    if n_jobs < 0:
+        n_jobs = max(n_cores + 1 + n_jobs, 1)
+    n_jobs = max(min(n_jobs, n_tasks), 1)
+
+    return n_jobs, max(num_threads // n_jobs, 1)
+
+
+def run_folds(
+    fit_and_score: Callable[..., Any],
+    splits: Sequence[Tuple[Any, ...]],
+    n_jobs: int = 1,
+    backend: str = "loky",
+    **kwargs,
+) -> List[Any]:
+    """Runs `fit_and_score(*split, **kwargs)` for every split, `n_jobs` at a time.
+
+    With the default "loky" backend every fold runs in a separate process and large arrays in
+    `kwargs` are memory-mapped instead of copied to each of them, which suits single threaded
+    estimators. The "threading" backend suits estimators that release the GIL (e.g. LightGBM).
+
+    Parameters
+    ----------
+    fit_and_score : Callable[..., Any]
+        Fits a model on a split and returns its score(s), must be picklable for "loky".
+    splits : Sequence[Tuple[Any, ...]]
+        The data of each fold, e.g. its (train indices, test indices).
+    n_jobs : int, optional
+        Number of folds to run concurrently, by default 1 (serially in this process).
+    backend : str, optional
+        The joblib backend to use, by default "loky".
+
+    Returns
+    -------
+    List[Any]
+        The results of `fit_and_score` in the order of `splits`.
+    """
+    if n_jobs == 1:
+        return [fit_and_score(*split, **kwargs) for split in splits]
+
+    return Parallel(n_jobs=n_jobs, backend=backend)(
+        delayed(fit_and_score)(*split, **kwargs) for split in splits
+    )
+
+
+def _fit_and_score(
+    train_idx: ndarray,
+    test_idx: ndarray,
+    estimator: Any,
+    X: ndarray,
+    y: ndarray,
+    metric: DictConfig,
+) -> float:
+    model = clone(estimator)
+    model.fit(X[train_idx], y[train_idx])
+    return hydra.utils.call(metric, _args_=(y[test_idx], model.predict(X[test_idx])))
+
+
+def cross_validate(estimator: Any, X: ndarray, y: ndarray, config: DictConfig) -> float:
+    """Average score of an sklearn estimator over the KFold splits given in the config.
+
+    Folds run concurrently according to `config.kfold_params.n_jobs`, each in its own process.
+    joblib limits the BLAS/OpenMP threads of each process so that the folds share the cores.
+
+    Parameters
+    ----------
+    estimator : Any
+        An unfitted sklearn estimator, cloned for every fold.
+    X : ndarray
+        The input features.
+    y : ndarray
+        The target variable.
+    config : DictConfig
+        The configuration with the `kfold_params` and the `metric` to score the folds with.
+
+    Returns
+    -------
+    float
+        The mean score over the folds.
+    """
+    splits = KFold(
+        n_splits=config.kfold_params.n_splits,
+        shuffle=config.kfold_params.shuffle,
+        random_state=config.kfold_params.seed,
+    )
+    n_jobs, _ = split_threads(
+        config.kfold_params.get("n_jobs", 1), config.kfold_params.n_splits
+    )
+    scores = run_folds(
+        _fit_and_score,
+        list(splits.split(X, y)),
+        n_jobs=n_jobs,
+        estimator=estimator,
+        X=X,
+        y=y,
+        metric=config.metric,
+    )
+
+    return np.mean(scores)
+
+
+# Study stuff
+FINISHED_STATES = (optuna.trial.TrialState.COMPLETE, optuna.trial.TrialState.PRUNED)
+IMPORTED_ATTR = "imported_from"  # User attribute of trials copied from other studies
+
+
+def get_storage(
+    storage: Optional[str], heartbeat_interval: int = 60
+) -> Optional[optuna.storages.BaseStorage]:
+    """Returns the Optuna storage for a database URL or a journal file path.
+
+    Trials of an RDB study (e.g. "sqlite:///studies.db") send heartbeats, so the trials left
+    running by a preempted job are marked as failed and retried when the study is resumed.
+
+    Parameters
+    ----------
+    storage : Optional[str]
+        A database URL, a path to a journal file or None for an in-memory study.
+    heartbeat_interval : int, optional
+        Seconds between the heartbeats of a running trial, by default 60.
+
+    Returns
+    -------
+    Optional[optuna.storages.BaseStorage]
+        The storage, None if `storage` is None.
+    """
+    if storage is None:
+        return None
+
+    if "://" in storage:
+        return optuna.storages.RDBStorage(
+            storage,
+            engine_kwargs={"connect_args": {"timeout": 60}}
+            if storage.startswith("sqlite")
+            else None,  # Workers wait for the SQLite lock instead of failing
+            heartbeat_interval=heartbeat_interval,
+            grace_period=2 * heartbeat_interval,
+            failed_trial_callback=optuna.storages.RetryFailedTrialCallback(max_retry=3),
+        )
+
+    Path(storage).parent.mkdir(parents=True, exist_ok=True)
+    return optuna.storages.JournalStorage(optuna.storages.JournalFileStorage(storage))
+
+
+def create_study(
+    study_name: str, storage: Optional[str] = None, **study_kwargs
+) -> optuna.Study:
+    """Creates a study, or loads it with its trials if it already exists in `storage`.
+
+    Parameters
+    ----------
+    study_name : str
+        The name of the study.
+    storage : Optional[str], optional
+        Where to keep the study (see `get_storage`), by default None (in memory).
+    **study_kwargs
+        Passed to `optuna.create_study` (e.g. direction, sampler, pruner).
+
+    Returns
+    -------
+    optuna.Study
+        The study.
+    """
+    return optuna.create_study(
+        study_name=study_name,
+        storage=get_storage(storage),
+        load_if_exists=True,
+        **study_kwargs,
+    )
+
+
+def _study_worker(
+    study: optuna.Study,
+    objective: Callable[[optuna.Trial], Any],
+    n_trials: int,
+    storage: str,
+    **optimize_kwargs,
+) -> None:
+    # A fresh connection to the storage, the one of the parent can't be shared after a fork
+    study = optuna.load_study(
+        study_name=study.study_name,
+        storage=get_storage(storage),
+        sampler=study.sampler,
+        pruner=study.pruner,
+    )
+    study.sampler.reseed_rng()  # Or every worker samples the same parameters
+
+    study.optimize(objective, n_trials=n_trials, **optimize_kwargs)
+
+
+def optimize_study(
+    study: optuna.Study,
+    objective: Callable[[optuna.Trial], Any],
+    n_trials: int,
+    storage: Optional[str] = None,
+    n_workers: int = 1,
+    **optimize_kwargs,
+) -> None:
+    """Runs the trials of a study that are left, in `n_workers` processes.
+
+    Trials that already finished (e.g. before the job was preempted) count towards the
+    `n_trials` budget, trials imported from other studies (see `import_trials`) don't. The
+    workers are forked, so `objective` and the data it closes over are shared with them
+    instead of being pickled.
+
+    Parameters
+    ----------
+    study : optuna.Study
+        The study, kept in `storage` if `n_workers` > 1.
+    objective : Callable[[optuna.Trial], Any]
+        The function to optimize.
+    n_trials : int
+        The total number of finished (complete or pruned) trials the study should have.
+    storage : Optional[str], optional
+        The database URL or journal file of the study, by default None.
+    n_workers : int, optional
+        Number of processes pulling trials from the study, by default 1 (this process).
+    **optimize_kwargs
+        Passed to `optuna.Study.optimize` (e.g. catch, n_jobs).
+
+    Raises
+    ------
+    ValueError
+        If several workers are requested for a study that is kept in memory.
+    RuntimeError
+        If one of the workers fails.
+    """
+    n_left = n_trials - len(get_own_trials(study))
+    if n_left <= 0:
+        return None
+
+    if n_workers == 1:
+        study.optimize(objective, n_trials=n_left, **optimize_kwargs)
+        return None
+
+    if storage is None:
+        raise ValueError("Running a study in several workers requires a storage.")
+
+    n_workers = min(n_workers, n_left)
+    context = multiprocessing.get_context("fork")
+    workers = [
+        context.Process(
+            target=_study_worker,
+            args=(study, objective, n_left // n_workers + (i < n_left % n_workers)),
+            kwargs={"storage": storage} | optimize_kwargs,
+        )
+        for i in range(n_workers)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    if any(worker.exitcode != 0 for worker in workers):
+        raise RuntimeError(
+            f"{sum(worker.exitcode != 0 for worker in workers)} workers of study "
+            f"{study.study_name} failed."
+        )
+
+
+def get_own_trials(study: optuna.Study) -> List[optuna.trial.FrozenTrial]:
+    """Returns the finished trials of a study, except the ones imported from other studies."""
+    return [
+        trial
+        for trial in study.get_trials(deepcopy=False, states=FINISHED_STATES)
+        if IMPORTED_ATTR not in trial.user_attrs
+    ]
+
+
+def get_best_trial(study: optuna.Study) -> optuna.trial.FrozenTrial:
+    """Returns the best trial evaluated by the study itself (see `get_own_trials`).
+
+    Raises
+    ------
+    ValueError
+        If the study has no complete trial of its own.
+    """
+    trials = [
+        trial
+        for trial in get_own_trials(study)
+        if trial.state == optuna.trial.TrialState.COMPLETE
+    ]
+    if not trials:
+        raise ValueError(f"Study {study.study_name} has no complete trials.")
+
+    best = max if study.direction == optuna.study.StudyDirection.MAXIMIZE else min
+    return best(trials, key=lambda trial: trial.value)
+
+
+def enqueue_params(study: optuna.Study, param_paths: Sequence[Path]) -> int:
+    """Enqueues the parameters pickled in `param_paths` (e.g. the `*_best_params.pkl` of other
+    seeds or datasets) as the first trials of a study.
+
+    Parameters
+    ----------
+    study : optuna.Study
+        The study to warm start.
+    param_paths : Sequence[Path]
+        Paths to pickled parameter dictionaries.
+
+    Returns
+    -------
+    int
+        The number of parameter sets that were enqueued.
+    """
+    n_enqueued = 0
+    for param_path in param_paths:
+        with open(param_path, "rb") as f:
+            params = pickle.load(f)
+
+        if any(
+            (trial.params or trial.system_attrs.get("fixed_params")) == params
+            for trial in study.get_trials(deepcopy=False)
+        ):
+            continue  # Already evaluated or enqueued, e.g. by a resumed run
+        study.enqueue_trial(params, user_attrs={"warm_start": str(param_path)})
+        n_enqueued += 1
+
+    return n_enqueued
+
+
+def import_trials(
+    study: optuna.Study, storage: str, study_name: Optional[str] = None
+) -> int:
+    """Copies the complete trials of another study into `study`, as a prior for its sampler.
+
+    The copies keep their parameters and values but not their intermediate values, so they
+    guide the sampler without taking part in pruning decisions. They are tagged with the
+    `IMPORTED_ATTR` user attribute and don't count towards the trial budget or the best trial.
+
+    Parameters
+    ----------
+    study : optuna.Study
+        The study to warm start.
+    storage : str
+        Database URL or journal file of the other study (see `get_storage`).
+    study_name : Optional[str], optional
+        Name of the other study, by default the name of `study`.
+
+    Returns
+    -------
+    int
+        The number of trials that were imported.
+    """
+    source = f"{storage}:{study_name or study.study_name}"
+    if any(
+        trial.user_attrs.get(IMPORTED_ATTR) == source
+        for trial in study.get_trials(deepcopy=False)
+    ):
+        return 0  # Imported by an earlier run of a resumed study
+
+    prior = optuna.load_study(
+        study_name=study_name or study.study_name, storage=get_storage(storage)
+    )
+    trials = [
+        optuna.trial.create_trial(
+            params=trial.params,
+            distributions=trial.distributions,
+            value=trial.value,
+            user_attrs=trial.user_attrs | {IMPORTED_ATTR: source},
+        )
+        for trial in prior.get_trials(
+            deepcopy=False, states=(optuna.trial.TrialState.COMPLETE,)
+        )
+        if IMPORTED_ATTR not in trial.user_attrs  # Only what the other study evaluated
+    ]
+    study.add_trials(trials)
+
+    return len(trials)
 
 
 def get_model(model_path: Path) -> lgb.Booster:
-    """Loads a LightGBM model from a pickle file and returns it.
+    """Loads a LightGBM model from a bundle (see `ModelBundle`) or a pickle file and returns
+    it.
 
     Parameters
     ----------
     model_path : Path
-        Path to the pickle file containing the model.
+        Path to the bundle directory or the pickle file containing the model.
 
     Returns
     -------
     lgb.Booster
         The loaded model.
     """
+    if is_bundle(model_path):
+        return ModelBundle(model_path).model
+
     model = pickle.load(open(model_path, "rb"))
     assert isinstance(
         model, lgb.Booster
@@ -127,7 +1970,13 @@ def get_model(model_path: Path) -> lgb.Booster:
 
 
 def get_model_paths(
-    run_path: str, model_type: str, suffix: str, prefix: str, model_names: List[str]
+    run_path: str,
+    model_type: str,
+    suffix: str,
+    prefix: str,
+    model_names: List[str],
+    registry: Optional[str] = None,
+    scan: bool = True,
 ) -> Dict[str, List[Path]]:
     """Retrieves the paths of the models in a given directory based on the provided model type and
     suffix.
@@ -138,19 +1987,53 @@ def get_model_paths(
         suffix (str): The suffix of the model (e.g. full, geno_only, chem_only, dummy).
         prefix (str): The prefix of the model paths (e.g. Bloom2013_).
         model_names (List[str]): The list of models to retrieve.
+        registry (str, optional): A `ModelRegistry` database to look the models up in.
+            Defaults to None.
+        scan (bool, optional): Whether to scan `run_path` too. With a registry, the runs it
+            doesn't have are added with a warning, so that a partially populated registry
+            drops no model. Turn it off once every run is registered. Defaults to True.
 
     Returns:
         Dict[str, List[Path]]: A dictionary with the model names as keys and the
-            paths to the models as values.
+            paths to the models as values, sorted by run directory whether they come from
+            the registry or the scan. A run with both a bundle (`{model_type}.bundle`)
+            and a pickle gives the bundle; bundles are found without being opened.
     """
     # suffix = "" if suffix == "full" else suffix
 
     run_path = Path(run_path)
+    model_registry = None if registry is None else ModelRegistry(registry)
+
+    model_paths = {}
+    for model in model_names:
+        paths = {}  # By absolute path, models found by both are the same
+        if model_registry is not None:
+            for path in model_registry.find_paths(
+                run_path, model_type, f"{prefix}{model}*{suffix}"
+            ):
+                paths[os.path.abspath(path)] = path
+        if scan or model_registry is None:
+            scanned = {
+                os.path.abspath(path): path
+                for path in run_path.glob(f"{prefix}{model}*{suffix}/{model_type}.*")
+            }
+            unregistered = scanned.keys() - paths.keys()
+            if model_registry is not None and unregistered:
+                warn(
+                    f"{len(unregistered)} {model_type} models of {model} are not in the "
+                    f"registry {registry}, e.g. {min(unregistered)}"
+                )
+            paths = scanned | paths
 
-    model_paths = {
-        model: list(run_path.glob(f"{prefix}{model}*{suffix}/{model_type}.pkl"))
-        for model in model_names
-    }
+        run_paths = {}  # One model per run directory
+        for path in sorted(
+            paths.values(), key=lambda path: (path.parent.name, path.name)
+        ):
+            if path.suffix == ".bundle" or (
+                path.suffix == ".pkl" and path.parent not in run_paths
+            ):
+                run_paths[path.parent] = path
+        model_paths[model] = list(run_paths.values())
 
     return model_paths
 
@@ -167,3 +2050,16 @@ def get_corr(preds: ndarray, ytest: ndarray, method: str) -> float:
             return spearmanr(preds, ytest).statistic
         case _:
             raise ValueError("Invalid method. Must be one of ['pearson', 'spearman']")
+
+
+if __name__ == "__main__":
+    # Small application to factorize a long table (see FactorizedData)
+
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser()
+    parser.add_argument("--data_path", type=str)
+    parser.add_argument("--out_dir", type=str)
+    args = parser.parse_args()
+
+    FactorizedData.from_table(args.data_path).save(args.out_dir)